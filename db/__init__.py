@@ -2,10 +2,19 @@
 The 'real' module is actually a class, and implements the __getattr__ to
 intercept attribute calls to generate (and cache) the individual classes.
 
-Currently, the table_lookup contains a class -> table mapping. This will soon
-be augmented with a 'generator' that will derive the table name from the class
-being requested, and if there is no table by that name, it will throw an
-AttributeError.
+Class names are derived from the table names of the appliance's schema, by
+singularizing every word and camel casing them: vms is Vm, metrics_05 is
+Metric05 and the join table hosts_storages is HostStorage. Any table of the
+schema can be used, names that match no table raise an AttributeError.
+
+Table definitions are cached on disk, keyed by the head of the appliance's
+schema_migrations, so they are only reflected once per schema version rather
+than once per table in every process. Call reflect_all() to warm the cache up
+front, scripts/cache_db_schema.py does that from the command line. Every
+schema version gets its own set of classes, so engines pointing at appliances
+of different versions can be used side by side.
+
+Nothing touches the database until the first class is looked up.
 
 Created on Jun 19, 2013
 
@@ -14,249 +23,188 @@ Created on Jun 19, 2013
 # -*- coding: utf-8 -*-
 # pylint: disable=R0903
 # pylint: disable=C0103
+import bisect
+import cPickle as pickle
+import errno
+import os
 import sys
+import tempfile
+import threading
 from sqlalchemy import MetaData
 from sqlalchemy.ext.declarative import declarative_base
 
+
+def classify(table_name):
+    '''Returns the class name of a table, like MiqPolicy for miq_policies
+
+    Every word of the table name is singularized, dropping a trailing s or
+    the es of xes, and capitalized. A trailing ie becomes y.
+    '''
+    words = []
+    for word in table_name.split('_'):
+        if len(word) > 1 and word.endswith('xes'):
+            word = word[:-2]
+        elif len(word) > 1 and word.endswith('s'):
+            word = word[:-1]
+        words.append(word[:1].upper() + word[1:])
+    name = ''.join(words)
+    if name.endswith('ie'):
+        name = name[:-2] + 'y'
+    return name
+
+
+class Schema(object):
+    '''
+    The tables of one schema version, and the classes mapped to them
+    '''
+    def __init__(self, metadata):
+        self.metadata = metadata
+        self.Base = declarative_base(metadata=metadata)
+        # Class name -> table name, the first table in sorted order wins
+        # should two tables singularize to the same name
+        self.tables = {}
+        for table_name in sorted(metadata.tables):
+            self.tables.setdefault(classify(table_name), table_name)
+        self.class_names = sorted(self.tables)
+        self._classes = {}
+        self._lock = threading.Lock()
+
+    def get(self, name):
+        '''Returns the class of a table, mapping it on first use
+
+        Safe to call from several threads, a class is only ever mapped once.
+        '''
+        try:
+            return self._classes[name]
+        except KeyError:
+            pass
+        try:
+            table = self.metadata.tables[self.tables[name]]
+        except KeyError:
+            raise AttributeError(name)
+        with self._lock:
+            if name not in self._classes:
+                attrs = dict(__table__=table, __module__=__name__)
+                if not table.primary_key.columns:
+                    # Join tables have no primary key, their rows are identified by all columns
+                    attrs['__mapper_args__'] = {'primary_key': list(table.columns)}
+                self._classes[name] = type(name, (self.Base,), attrs)
+            return self._classes[name]
+
+    def complete(self, prefix):
+        '''Returns the class names starting with prefix'''
+        names = []
+        for name in self.class_names[bisect.bisect_left(self.class_names, prefix):]:
+            if not name.startswith(prefix):
+                break
+            names.append(name)
+        return names
+
+
 class Db(object):
     '''
     The actual implementation of the 'module'
     '''
+    # Bump when the format of the schema cache files changes
+    schema_cache_version = 1
+
+    classify = staticmethod(classify)
+
     def __init__(self):
-        self.metadata = MetaData()
         self.engine = None
-        self.Base = declarative_base()
+        self.schema_cache_dir = os.path.join(tempfile.gettempdir(), 'cfme_schema_cache')
+        # Schema head -> Schema, for every schema version used so far
+        self.schemas = {}
+        # Engine -> schema head, so that each engine is only asked once
+        self._heads = {}
+        # Held while a schema is loaded or reflected, so threads looking up
+        # their first class at the same time only load it once
+        self._schema_lock = threading.Lock()
+        # Once this instance replaces the module in sys.modules, the module's
+        # globals are cleared unless something still references it
+        self._module = sys.modules[__name__]
 
     def __getattr__(self, name):
-        # Lookup actual table name in dict
-        if name in self.table_lookup.keys():
-            table_name = self.table_lookup[name]
-            self.metadata.reflect(bind=self.engine,only=[table_name])
-            table = self.metadata.tables[table_name]
-            # Now, create the class to represent this thing
-            cls = type(name, (self.Base,),
-                    dict(__table__=table, __module__=self.__module__))
-            setattr(self, name, cls)
-            return cls
-        else:
-            raise AttributeError
+        # Only class names are looked up in the schema, anything else (and
+        # anything before an engine is set up) must not touch the database
+        if not name[:1].isupper() or self.engine is None:
+            raise AttributeError(name)
+        return self.schema.get(name)
+
+    def __dir__(self):
+        names = set(dir(type(self))) | set(self.__dict__)
+        if self.engine is not None:
+            names.update(self.schema.class_names)
+        return sorted(names)
+
+    @property
+    def schema(self):
+        '''The Schema of the database engine points to, loaded on first use'''
+        head = self._head()
+        try:
+            return self.schemas[head]
+        except KeyError:
+            pass
+        with self._schema_lock:
+            if head not in self.schemas and not self.load_schema():
+                self.reflect_all()
+            return self.schemas[head]
+
+    @property
+    def metadata(self):
+        return self.schema.metadata
+
+    @property
+    def Base(self):
+        return self.schema.Base
+
+    def complete(self, prefix):
+        '''Returns the class names starting with prefix, for tab-completion'''
+        return self.schema.complete(prefix)
+
+    def schema_head(self):
+        '''Returns the latest migration applied to the database'''
+        return self.engine.execute('SELECT max(version) FROM schema_migrations').scalar()
+
+    def schema_cache_path(self):
+        '''Returns the schema cache file for the database's schema version'''
+        return os.path.join(self.schema_cache_dir, 'schema-v%d-%s.pickle' % (
+            self.schema_cache_version, self._head()))
+
+    def load_schema(self):
+        '''Loads every table definition from the schema cache
+
+        Returns True if the cache had the database's schema version.
+        '''
+        try:
+            with open(self.schema_cache_path(), 'rb') as cache:
+                metadata = pickle.load(cache)
+        except (IOError, EOFError, pickle.UnpicklingError):
+            return False
+        self.schemas[self._head()] = Schema(metadata)
+        return True
+
+    def reflect_all(self):
+        '''Reflects every table in one go and writes them to the schema cache'''
+        metadata = MetaData()
+        metadata.reflect(bind=self.engine)
+        path = self.schema_cache_path()
+        try:
+            os.makedirs(self.schema_cache_dir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        # Write to a temporary file first so that xdist workers warming the
+        # cache at the same time never read a partial file
+        with tempfile.NamedTemporaryFile(dir=self.schema_cache_dir, delete=False) as cache:
+            pickle.dump(metadata, cache, pickle.HIGHEST_PROTOCOL)
+        os.rename(cache.name, path)
+        self.schemas[self._head()] = Schema(metadata)
+        return path
 
-    table_lookup = {
-        'Account': 'accounts',
-        'AdvancedSetting': 'advanced_settings',
-        'AssignedServerRole': 'assigned_server_roles',
-        'AuditEvent': 'audit_events',
-        'Authentication': 'authentications',
-        'BinaryBlob': 'binary_blobs',
-        'BinaryBlobPart': 'binary_blob_parts',
-        'BottleneckEvent': 'bottleneck_events',
-        'ChargebackRate': 'chargeback_rates',
-        'ChargebackRateDetail': 'chargeback_rate_details',
-        'Classification': 'classifications',
-        'Compliance': 'compliances',
-        'ComplianceDetail': 'compliance_details',
-        'Condition': 'conditions',
-        'ConditionMiqPolicy': 'conditions_miq_policies',
-        'Configuration': 'configurations',
-        'CustomAttribute': 'custom_attributes',
-        'CustomButton': 'custom_buttons',
-        'CustomizationSpec': 'customization_specs',
-        'CustomizationTemplate': 'customization_templates',
-        'DatabaseBackup': 'database_backups',
-        'Dialog': 'dialogs',
-        'DialogField': 'dialog_fields',
-        'DialogGroup': 'dialog_groups',
-        'DialogResource': 'dialog_resources',
-        'DialogTab': 'dialog_tabs',
-        'Disk': 'disks',
-        'DriftState': 'drift_states',
-        'EmCluster': 'ems_clusters',
-        'EmEvent': 'ems_events',
-        'EmFolder': 'ems_folders',
-        'EventLog': 'event_logs',
-        'ExtManagementSystem': 'ext_management_systems',
-        'ExtManagementSystemVdiDesktopPool': 'ext_management_systems_vdi_desktop_pools',
-        'FileDepot': 'file_depots',
-        'Filesystem': 'filesystems',
-        'FirewallRule': 'firewall_rules',
-        'GuestApplication': 'guest_applications',
-        'GuestDevice': 'guest_devices',
-        'Hardware': 'hardwares',
-        'Host': 'hosts',
-        'HostStorage': 'hosts_storages',
-        'IsoDatastore': 'iso_datastores',
-        'IsoImage': 'iso_images',
-        'Job': 'jobs',
-        'Lan': 'lans',
-        'LdapDomain': 'ldap_domains',
-        'LdapGroup': 'ldap_groups',
-        'LdapManagement': 'ldap_managements',
-        'LdapRegion': 'ldap_regions',
-        'LdapServer': 'ldap_servers',
-        'LdapUser': 'ldap_users',
-        'LifecycleEvent': 'lifecycle_events',
-        'LogFile': 'log_files',
-        'Metric': 'metrics',
-        'Metric00': 'metrics_00',
-        'Metric01': 'metrics_01',
-        'Metric02': 'metrics_02',
-        'Metric03': 'metrics_03',
-        'Metric04': 'metrics_04',
-        'Metric05': 'metrics_05',
-        'Metric06': 'metrics_06',
-        'Metric07': 'metrics_07',
-        'Metric08': 'metrics_08',
-        'Metric09': 'metrics_09',
-        'Metric10': 'metrics_10',
-        'Metric11': 'metrics_11',
-        'Metric12': 'metrics_12',
-        'Metric13': 'metrics_13',
-        'Metric14': 'metrics_14',
-        'Metric15': 'metrics_15',
-        'Metric16': 'metrics_16',
-        'Metric17': 'metrics_17',
-        'Metric18': 'metrics_18',
-        'Metric19': 'metrics_19',
-        'Metric20': 'metrics_20',
-        'Metric21': 'metrics_21',
-        'Metric22': 'metrics_22',
-        'Metric23': 'metrics_23',
-        'MetricRollup': 'metric_rollups',
-        'MetricRollup01': 'metric_rollups_01',
-        'MetricRollup02': 'metric_rollups_02',
-        'MetricRollup03': 'metric_rollups_03',
-        'MetricRollup04': 'metric_rollups_04',
-        'MetricRollup05': 'metric_rollups_05',
-        'MetricRollup06': 'metric_rollups_06',
-        'MetricRollup07': 'metric_rollups_07',
-        'MetricRollup08': 'metric_rollups_08',
-        'MetricRollup09': 'metric_rollups_09',
-        'MetricRollup10': 'metric_rollups_10',
-        'MetricRollup11': 'metric_rollups_11',
-        'MetricRollup12': 'metric_rollups_12',
-        'MiqAction': 'miq_actions',
-        'MiqAeClasse': 'miq_ae_classes',
-        'MiqAeField': 'miq_ae_fields',
-        'MiqAeInstance': 'miq_ae_instances',
-        'MiqAeMethod': 'miq_ae_methods',
-        'MiqAeNamespace': 'miq_ae_namespaces',
-        'MiqAeValue': 'miq_ae_values',
-        'MiqAeWorkspace': 'miq_ae_workspaces',
-        'MiqAlert': 'miq_alerts',
-        'MiqAlertStatuse': 'miq_alert_statuses',
-        'MiqApproval': 'miq_approvals',
-        'MiqCimAssociation': 'miq_cim_associations',
-        'MiqCimDerivedMetric': 'miq_cim_derived_metrics',
-        'MiqCimInstance': 'miq_cim_instances',
-        'MiqDatabase': 'miq_databases',
-        'MiqDialog': 'miq_dialogs',
-        'MiqEnterprise': 'miq_enterprises',
-        'MiqEvent': 'miq_events',
-        'MiqGlobal': 'miq_globals',
-        'MiqGroup': 'miq_groups',
-        'MiqLicenseContent': 'miq_license_contents',
-        'MiqPolicy': 'miq_policies',
-        'MiqPolicyContent': 'miq_policy_contents',
-        'MiqProductFeature': 'miq_product_features',
-        'MiqProxieProductUpdate': 'miq_proxies_product_updates',
-        'MiqProxy': 'miq_proxies',
-        'MiqQueue': 'miq_queue',
-        'MiqRegion': 'miq_regions',
-        'MiqReport': 'miq_reports',
-        'MiqReportResult': 'miq_report_results',
-        'MiqReportResultDetail': 'miq_report_result_details',
-        'MiqRequest': 'miq_requests',
-        'MiqRequestTask': 'miq_request_tasks',
-        'MiqRoleFeature': 'miq_roles_features',
-        'MiqSchedule': 'miq_schedules',
-        'MiqScsiLun': 'miq_scsi_luns',
-        'MiqScsiTarget': 'miq_scsi_targets',
-        'MiqSearche': 'miq_searches',
-        'MiqServer': 'miq_servers',
-        'MiqServerProductUpdate': 'miq_servers_product_updates',
-        'MiqSet': 'miq_sets',
-        'MiqShortcut': 'miq_shortcuts',
-        'MiqStorageMetric': 'miq_storage_metrics',
-        'MiqTask': 'miq_tasks',
-        'MiqUserRole': 'miq_user_roles',
-        'MiqWidget': 'miq_widgets',
-        'MiqWidgetContent': 'miq_widget_contents',
-        'MiqWidgetShortcut': 'miq_widget_shortcuts',
-        'MiqWorker': 'miq_workers',
-        'Network': 'networks',
-        'OntapAggregateDerivedMetric': 'ontap_aggregate_derived_metrics',
-        'OntapAggregateMetricRollup': 'ontap_aggregate_metrics_rollups',
-        'OntapDiskDerivedMetric': 'ontap_disk_derived_metrics',
-        'OntapDiskMetricRollup': 'ontap_disk_metrics_rollups',
-        'OntapLunDerivedMetric': 'ontap_lun_derived_metrics',
-        'OntapLunMetricRollup': 'ontap_lun_metrics_rollups',
-        'OntapSystemDerivedMetric': 'ontap_system_derived_metrics',
-        'OntapSystemMetricRollup': 'ontap_system_metrics_rollups',
-        'OntapVolumeDerivedMetric': 'ontap_volume_derived_metrics',
-        'OntapVolumeMetricRollup': 'ontap_volume_metrics_rollups',
-        'OperatingSystem': 'operating_systems',
-        'OProcesse': 'os_processes',
-        'Partition': 'partitions',
-        'Patche': 'patches',
-        'Picture': 'pictures',
-        'PolicyEvent': 'policy_events',
-        'PolicyEventContent': 'policy_event_contents',
-        'ProductUpdate': 'product_updates',
-        'ProxyTask': 'proxy_tasks',
-        'PxeImage': 'pxe_images',
-        'PxeImageType': 'pxe_image_types',
-        'PxeMenu': 'pxe_menus',
-        'PxeServer': 'pxe_servers',
-        'RegistryItem': 'registry_items',
-        'Relationship': 'relationships',
-        'Repository': 'repositories',
-        'Reserve': 'reserves',
-        'ResourceAction': 'resource_actions',
-        'ResourcePool': 'resource_pools',
-        'RsFeed': 'rss_feeds',
-        'ScanHistory': 'scan_histories',
-        'ScanItem': 'scan_items',
-        'SchemaMigration': 'schema_migrations',
-        'ServerRole': 'server_roles',
-        'Service': 'services',
-        'ServiceResource': 'service_resources',
-        'ServiceTemplate': 'service_templates',
-        'ServiceTemplateCatalog': 'service_template_catalogs',
-        'Session': 'sessions',
-        'Snapshot': 'snapshots',
-        'Storage': 'storages',
-        'StorageFile': 'storage_files',
-        'StorageManager': 'storage_managers',
-        'StorageMetricMetadata': 'storage_metrics_metadata',
-        'StorageVmAndTemplate': 'storages_vms_and_templates',
-        'Switche': 'switches',
-        'SystemService': 'system_services',
-        'Tag': 'tags',
-        'Tagging': 'taggings',
-        'TimeProfile': 'time_profiles',
-        'UiTask': 'ui_tasks',
-        'User': 'users',
-        'VdiController': 'vdi_controllers',
-        'VdiDesktop': 'vdi_desktops',
-        'VdiDesktopPool': 'vdi_desktop_pools',
-        'VdiDesktopPoolVdiUser': 'vdi_desktop_pools_vdi_users',
-        'VdiDesktopVdiUser': 'vdi_desktops_vdi_users',
-        'VdiEndpointDevice': 'vdi_endpoint_devices',
-        'VdiFarm': 'vdi_farms',
-        'VdiSession': 'vdi_sessions',
-        'VdiUser': 'vdi_users',
-        'VimPerformanceOperatingRange': 'vim_performance_operating_ranges',
-        'VimPerformanceState': 'vim_performance_states',
-        'VimPerformanceTagValue': 'vim_performance_tag_values',
-        'Vm': 'vms',
-        'VmdbDatabase': 'vmdb_databases',
-        'VmdbDatabaseMetric': 'vmdb_database_metrics',
-        'VmdbIndex': 'vmdb_indexes',
-        'VmdbMetric': 'vmdb_metrics',
-        'VmdbTable': 'vmdb_tables',
-        'Volume': 'volumes',
-        'WindowImage': 'windows_images',
-        'Zone': 'zones'
-    }
+    def _head(self):
+        if self.engine not in self._heads:
+            self._heads[self.engine] = self.schema_head()
+        return self._heads[self.engine]
 
-sys.modules[__name__] = Db()
\ No newline at end of file
+sys.modules[__name__] = Db()
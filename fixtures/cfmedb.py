@@ -1,11 +1,28 @@
+import os
 from urlparse import urlparse
 
 import pytest
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import create_engine, event, exc
+from sqlalchemy.orm import scoped_session, sessionmaker
 
 from utils import conf
 
+# Connections shared by all the xdist workers, the appliance needs the rest of
+# its max_connections for itself. Override with cfme_db_pool_size in env.yaml
+DEFAULT_POOL_SIZE = 20
+
+# Connections each worker may open beyond its share of the pool while it is
+# all checked out, closed again once returned. A worker can need three at once:
+# the db_session's, a db_wait LISTEN and the query polling next to it. The
+# appliance sees at most cfme_db_pool_size plus this many per worker.
+# Override with cfme_db_pool_overflow in env.yaml
+DEFAULT_POOL_OVERFLOW = 3
+
+# Seconds a pooled connection is kept before being replaced, so connections
+# dropped by a postgres restart on the appliance are eventually recycled.
+# Override with cfme_db_pool_recycle in env.yaml
+DEFAULT_POOL_RECYCLE = 3600
+
 
 def pytest_sessionstart(session):
     '''Setup run for tests'''
@@ -16,10 +33,58 @@ def pytest_sessionstart(session):
         baseurl = conf.env['base_url']
         baseip = urlparse(baseurl).hostname
         db.cfme_db_url = "postgres://root:smartvm@%s:5432/vmdb_production" % baseip
-    db.engine = create_engine(db.cfme_db_url)
+    db.engine = create_engine(db.cfme_db_url,
+        pool_size=pool_size(session.config),
+        max_overflow=conf.env.get('cfme_db_pool_overflow', DEFAULT_POOL_OVERFLOW),
+        pool_recycle=conf.env.get('cfme_db_pool_recycle', DEFAULT_POOL_RECYCLE))
+    db.pool_metrics = {'checkouts': 0, 'checked_out': 0, 'max_checked_out': 0,
+                       'disconnects': 0}
+    event.listen(db.engine, 'checkout', _ping_connection)
+    event.listen(db.engine, 'checkin', _count_checkin)
+    db.session_factory = scoped_session(sessionmaker(bind=db.engine))
+
+
+def pytest_sessionfinish(session):
+    import db
+    if getattr(db, 'session_factory', None) is not None:
+        db.session_factory.remove()
+        db.engine.dispose()
 
 
-@pytest.fixture
+def pool_size(config):
+    '''Splits the connection budget evenly between the xdist workers
+
+    Every worker keeps at least one connection, plus the overflow on top.
+    '''
+    workers = int(os.environ.get('PYTEST_XDIST_WORKER_COUNT') or
+                  getattr(config.option, 'numprocesses', None) or 1)
+    total = conf.env.get('cfme_db_pool_size', DEFAULT_POOL_SIZE)
+    return max(total // workers, 1)
+
+
+def _ping_connection(dbapi_connection, connection_record, connection_proxy):
+    '''Checks pooled connections are still alive before handing them out'''
+    import db
+    try:
+        cursor = dbapi_connection.cursor()
+        cursor.execute('SELECT 1')
+        cursor.close()
+    except Exception:
+        db.pool_metrics['disconnects'] += 1
+        # The pool drops this connection and retries with a new one
+        raise exc.DisconnectionError()
+    db.pool_metrics['checkouts'] += 1
+    db.pool_metrics['checked_out'] += 1
+    db.pool_metrics['max_checked_out'] = max(db.pool_metrics['max_checked_out'],
+                                             db.pool_metrics['checked_out'])
+
+
+def _count_checkin(dbapi_connection, connection_record):
+    import db
+    db.pool_metrics['checked_out'] = max(db.pool_metrics['checked_out'] - 1, 0)
+
+
+@pytest.yield_fixture
 def db_session():
     '''Creates a database session based on the db url passed on the CLI
 
@@ -31,6 +96,10 @@ def db_session():
     The available classes are dynamically generated from the database. Consult
     db/__init__.py for a list of available class -> table mappings.
 
+    The session is shared by every test in the process. Anything not committed
+    by a test is rolled back afterwards, which also returns its connection to
+    the pool.
+
     An example test:
 
     @pytest.mark.nondestructive
@@ -44,8 +113,41 @@ def db_session():
     This 'test' prints the management systems from the database.
     '''
     import db
-    Session = sessionmaker(bind=db.engine)
-    return Session()
+    session = db.session_factory()
+    try:
+        yield session
+    finally:
+        session.rollback()
+
+
+@pytest.fixture
+def db_pool_metrics():
+    '''Returns the connection pool utilisation of this process
+
+    A dict of the pool size, connections checked out now and at most, total
+    checkouts and dead connections replaced by the checkout ping.
+    '''
+    import db
+    metrics = dict(db.pool_metrics)
+    metrics['pool_size'] = db.engine.pool.size()
+    return metrics
+
+
+@pytest.yield_fixture(scope='session')
+def db_router():
+    '''Returns a :py:class:`utils.db_router.SessionRouter` over several appliances
+
+    It routes to the appliance under test as 'default', with the engine of
+    db_session, and to every appliance of cfme_db_urls in env.yaml. See
+    utils/db_router.py for how to query them all at once.
+    '''
+    import db
+    from utils.db_router import SessionRouter
+    router = SessionRouter.from_conf(engines={'default': db.engine})
+    try:
+        yield router
+    finally:
+        router.close()
 
 
 @pytest.fixture
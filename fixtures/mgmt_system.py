@@ -4,10 +4,12 @@ import time
 import pytest
 from unittestzero import Assert
 
+from utils import db_wait
 from utils.providers import (
     infra_provider_type_map,
     cloud_provider_type_map,
-    provider_factory
+    connect_providers,
+    provider_pool
 )
 
 logger = logging.getLogger(__name__)
@@ -65,6 +67,10 @@ def setup_infrastructure_providers(infra_providers_pg, cfme_data):
             prov_added = True
 
             # wait for the quadicon to show up
+            if db_wait.enabled():
+                # The quadicon shows up once the provider is in the database
+                db_wait.wait_for_provider(prov_data['name'], timeout=300)
+                infra_providers_pg.selenium.refresh()
             sleep_time = 0
             infra_providers_pg.taskbar_region.view_buttons.change_to_grid_view()
             Assert.true(infra_providers_pg.taskbar_region.view_buttons.is_grid_view)
@@ -152,6 +158,10 @@ def setup_cloud_providers(cloud_providers_pg, cfme_data):
             prov_added = True
 
             # wait for the quadicon to show up
+            if db_wait.enabled():
+                # The quadicon shows up once the provider is in the database
+                db_wait.wait_for_provider(prov_data['name'], timeout=300)
+                cloud_providers_pg.selenium.refresh()
             sleep_time = 0
             cloud_providers_pg.taskbar_region.view_buttons.change_to_grid_view()
             Assert.true(cloud_providers_pg.taskbar_region.view_buttons.is_grid_view)
@@ -194,13 +204,15 @@ def setup_cloud_providers(cloud_providers_pg, cfme_data):
             sub_navigation_menu('Providers').click()
 
 
-@pytest.fixture(scope='module')  # IGNORE:E1101
+@pytest.yield_fixture(scope='module')  # IGNORE:E1101
 def mgmt_sys_api_clients(cfme_data):
-    '''Returns a list of management system api clients'''
-    clients = {}
-    for sys_name in cfme_data['management_systems']:
-        if sys_name in clients:
-            # Overlapping sys_name entry in cfme_data.yaml
-            logger.warning('Overriding existing entry for %s.' % sys_name)
-        clients[sys_name] = provider_factory(sys_name)
-    return clients
+    '''Returns a dict of management system api clients
+
+    All clients are checked out of the provider pool concurrently, see
+    utils.providers.provider_fanout, and returned to it after the module
+    so the next module reuses their sessions.
+    '''
+    clients = connect_providers(cfme_data['management_systems'].keys())
+    yield clients
+    for client in clients.itervalues():
+        provider_pool.put(client)
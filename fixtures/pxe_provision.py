@@ -4,6 +4,7 @@ import pytest
 import db
 import os
 from datetime import datetime
+from utils.db_queries import find_by_name, find_pxe_server, latest_id
 
 
 @pytest.fixture(scope="module",  # IGNORE:E1101
@@ -16,15 +17,11 @@ def provisioning_setup_data(request, cfme_data):
 def setup_pxe_server(db_session, provisioning_setup_data):
     session = db_session
 
-    row_val = None
-    for row in session.query(db.PxeImageType):
-        if row.name == provisioning_setup_data['pxe_image_type_name']:
-            row_val = row.id
+    image_type = find_by_name(session, db.PxeImageType,
+                              provisioning_setup_data['pxe_image_type_name'])
+    row_val = image_type.id if image_type is not None else None
 
-    server_name = []
-    for row in session.query(db.PxeServer):
-        server_name.append(row.name)
-    if not provisioning_setup_data['pxe_server_name'] in server_name:
+    if find_pxe_server(session, provisioning_setup_data['pxe_server_name']) is None:
 
         '''Add a PXE Server'''
         new_pxe_server = db.PxeServer(
@@ -40,10 +37,7 @@ def setup_pxe_server(db_session, provisioning_setup_data):
             updated_at=datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S.%M%m"))
         session.add(new_pxe_server)
         session.commit()
-        server_id = []
-        for row in session.query(db.PxeServer):
-            server_id.append(row.id)
-        server_last_id = server_id.pop()
+        server_last_id = latest_id(session, db.PxeServer)
         return row_val, server_last_id
     return row_val, False
 
@@ -64,10 +58,7 @@ def setup_pxe_menu(db_session, provisioning_setup_data, server_last_id):
         contents=f.read())
     session.add(new_pxe_menu)
     session.commit()
-    menu_id = []
-    for row in session.query(db.PxeMenu):
-        menu_id.append(row.id)
-    menu_last_id = menu_id.pop()
+    menu_last_id = latest_id(session, db.PxeMenu)
     return menu_last_id
 
 
@@ -98,15 +89,12 @@ def setup_pxe_image(db_session, provisioning_setup_data, server_last_id, menu_la
 def setup_customization_template(db_session, provisioning_setup_data, row_val):
     session = db_session
 
-    row_val = None
-    for row in session.query(db.PxeImageType):
-        if row.name == provisioning_setup_data['pxe_image_type_name']:
-            row_val = row.id
+    image_type = find_by_name(session, db.PxeImageType,
+                              provisioning_setup_data['pxe_image_type_name'])
+    row_val = image_type.id if image_type is not None else None
 
-    customization_template = []
-    for row in session.query(db.CustomizationTemplate):
-        customization_template.append(row.name)
-    if not provisioning_setup_data['ct_name'] in customization_template:
+    if find_by_name(session, db.CustomizationTemplate,
+                    provisioning_setup_data['ct_name']) is None:
 
         '''Add a Customization Template'''
         f_ks = open(provisioning_setup_data['ks_file'], 'r+')
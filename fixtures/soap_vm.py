@@ -1,8 +1,8 @@
 # -*- coding: utf-8 -*-
 # pylint: disable=W0621
 import pytest
-import db
 from unittestzero import Assert
+from utils.db_queries import find_vm
 from time import time, sleep
 
 
@@ -16,25 +16,20 @@ def setup_soap_create_vm(
         vmware_linux_setup_data):
     '''Sets up first VM for clone/retirement tests'''
     # Check if VM already exists
-    for name, guid, power_state in db_session.query(
-            db.Vm.name, db.Vm.guid, db.Vm.power_state).filter(
-            db.Vm.template is False):
-        if vmware_linux_setup_data['vm_name'] in name:
-            # VM exists
-            print "VM exits"
-            if power_state == 'on':
-                result = soap_client.service.EVMSmartStop(guid)
-                Assert.equal(result.result, 'true')
-            break
+    vm = find_vm(db_session, vmware_linux_setup_data['vm_name'], template=False, contains=True)
+    if vm is not None:
+        # VM exists
+        print "VM exits"
+        if vm.power_state == 'on':
+            result = soap_client.service.EVMSmartStop(vm.guid)
+            Assert.equal(result.result, 'true')
     else:
         # Find template guid
-        template_guid = None
-        for name, guid in db_session.query(db.Vm.name, db.Vm.guid).filter(db.Vm.template is True):
-            if provisioning_data_basic_only['template'] in name:
-                template_guid = guid.strip()
-                break
-        else:
+        template = find_vm(db_session, provisioning_data_basic_only['template'],
+                           template=True, columns=('guid',), contains=True)
+        if template is None:
             raise Exception("Couldn't find CFME template for provisioning smoke test")
+        template_guid = template.guid.strip()
         Assert.not_none(template_guid)
 
         # Generate provision request
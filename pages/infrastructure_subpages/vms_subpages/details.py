@@ -5,6 +5,7 @@ from pages.infrastructure_subpages.vms_subpages.common import VmCommonComponents
 from selenium.webdriver.common.by import By
 from selenium.webdriver.common.action_chains import ActionChains
 from pages.base import Base
+from utils import db_wait
 
 class VirtualMachineDetails(VmCommonComponents):
     _details_locator = (By.CSS_SELECTOR, "div#textual_div")
@@ -90,7 +91,17 @@ class VirtualMachineDetails(VmCommonComponents):
             import VirtualMachineUtil
         return VirtualMachineUtil(self.testsetup)
 
-    def wait_for_vm_state_change(self, desired_state, timeout_in_minutes):
+    def wait_for_vm_state_change(self, desired_state, timeout_in_minutes,
+            vm_name=None):
+        '''Waits for the power state shown to be desired_state
+
+        Given the vm_name, and with db_waits in env.yaml, the vm's power state
+        is watched in the database first so that the page is only reloaded once.
+        '''
+        if vm_name is not None and db_wait.enabled():
+            db_wait.wait_for_vm_state(vm_name, desired_state.lower(),
+                timeout_in_minutes * 60)
+            self.refresh()
         current_state = self.power_state
         print "Desired state: " + desired_state + \
             "    Current state: " + current_state
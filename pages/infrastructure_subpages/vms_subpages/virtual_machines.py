@@ -9,6 +9,7 @@ from pages.regions.quadiconitem import QuadiconItem
 from pages.infrastructure_subpages.vms_subpages.common import VmCommonComponents
 from selenium.webdriver.common.by import By
 from selenium.webdriver.common.action_chains import ActionChains
+from utils import db_wait
 
 class VirtualMachines(VmCommonComponents):
 
@@ -175,7 +176,16 @@ class VirtualMachines(VmCommonComponents):
             return found.click()
 
     def wait_for_vm_state_change(self, vm_quadicon_title, 
-                desired_state, timeout_in_minutes):
+                desired_state, timeout_in_minutes, use_db=None):
+        '''Waits for the vm's quadicon to show desired_state
+
+        With use_db, or db_waits in env.yaml, the vm's power state is watched
+        in the database first so that the page is only reloaded once.
+        '''
+        if use_db or (use_db is None and db_wait.enabled()):
+            db_wait.wait_for_vm_state(vm_quadicon_title, desired_state,
+                timeout_in_minutes * 60)
+            self.refresh()
         self.find_vm_page(vm_quadicon_title, None, False)
         current_state = self.quadicon_region.get_quadicon_by_title(
             vm_quadicon_title).current_state
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+"""
+Benchmark the provider client code against the in-process fake provider.
+
+Calls list_vm, vm_status, deploy_template and delete_vm on a simulated
+provider with a large inventory and reports calls/sec and the p50/p99
+latency of each, so regressions in utils/mgmt_system.py show up without
+needing a live provider.
+
+Example usage:
+
+    scripts/benchmark_providers.py
+    scripts/benchmark_providers.py --vms 50000 --latency 0.01 --threads 20
+    scripts/benchmark_providers.py --failure-rate 0.01 --task-delay 0.5
+
+"""
+import argparse
+import os
+import sys
+import time
+from multiprocessing.pool import ThreadPool
+
+# Make sure the parent dir is on the path before importing provider_type_map
+cfme_tests_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, cfme_tests_path)
+
+from utils.providers import provider_type_map
+
+
+def main():
+    parser = argparse.ArgumentParser(epilog=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--vms', type=int, default=20000,
+        help='number of vms in the fake inventory')
+    parser.add_argument('--templates', type=int, default=100,
+        help='number of templates in the fake inventory')
+    parser.add_argument('--hosts', type=int, default=50,
+        help='number of hosts in the fake inventory')
+    parser.add_argument('--datastores', type=int, default=50,
+        help='number of datastores in the fake inventory')
+    parser.add_argument('--latency', type=float, default=0.001,
+        help='seconds each simulated API call takes')
+    parser.add_argument('--failure-rate', type=float, default=0,
+        help='fraction of simulated API calls that fail')
+    parser.add_argument('--task-delay', type=float, default=0.05,
+        help='seconds a simulated power operation, deploy or delete takes')
+    parser.add_argument('--calls', type=int, default=1000,
+        help='number of vm_status calls, list_vm gets a tenth of these')
+    parser.add_argument('--deploys', type=int, default=50,
+        help='number of templates deployed, and vms then deleted')
+    parser.add_argument('--threads', type=int, default=10,
+        help='number of concurrent callers')
+    parser.add_argument('--seed', type=int, default=0,
+        help='seed for the failure injection')
+
+    args = parser.parse_args()
+    provider = provider_type_map['fake'](num_vm=args.vms, num_template=args.templates,
+        num_host=args.hosts, num_datastore=args.datastores, latency=args.latency,
+        failure_rate=args.failure_rate, task_delay=args.task_delay, seed=args.seed)
+
+    vm_names = ['vm%d' % (i % args.vms) for i in range(args.calls)]
+    deployed = ['benchmark_vm%d' % i for i in range(args.deploys)]
+    templates = provider.list_template()
+
+    print '%-16s %8s %8s %10s %10s %10s' % (
+        'action', 'calls', 'errors', 'calls/sec', 'p50 (ms)', 'p99 (ms)')
+    for action, call, call_args in [
+            ('list_vm', lambda _: provider.list_vm(), range(max(args.calls / 10, 1))),
+            ('vm_status', provider.vm_status, vm_names),
+            ('deploy_template', lambda vm_name: provider.deploy_template(
+                templates[hash(vm_name) % len(templates)], vm_name=vm_name), deployed),
+            ('delete_vm', provider.delete_vm, deployed)]:
+        result = benchmark(call, call_args, args.threads)
+        print '%-16s %8d %8d %10.1f %10.2f %10.2f' % (action, result['calls'],
+            result['errors'], result['calls_per_sec'], result['p50'] * 1000,
+            result['p99'] * 1000)
+
+
+def benchmark(call, call_args, threads):
+    """Calls call once per item of call_args from several threads
+
+    Returns:
+        A dict of calls, errors, calls_per_sec and the p50 and p99 latency in seconds
+
+    """
+    def timed(arg):
+        start = time.time()
+        try:
+            call(arg)
+            return time.time() - start, False
+        except Exception:
+            return time.time() - start, True
+
+    pool = ThreadPool(threads)
+    start = time.time()
+    try:
+        results = pool.map(timed, call_args)
+    finally:
+        pool.close()
+        pool.join()
+    elapsed = time.time() - start
+
+    latencies = sorted(latency for latency, failed in results)
+    return {
+        'calls': len(results),
+        'errors': len([failed for latency, failed in results if failed]),
+        'calls_per_sec': len(results) / elapsed if elapsed else 0,
+        'p50': percentile(latencies, 50),
+        'p99': percentile(latencies, 99),
+    }
+
+
+def percentile(values, percent):
+    """Nearest rank percentile of an already sorted list"""
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(len(values) * percent / 100.))]
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -11,7 +11,8 @@ def main():
     parser.add_argument('--provider', dest='provider_name',
         help='provider name in cfme_data')
     parser.add_argument('--template', help='the name of the template to clone')
-    parser.add_argument('--vm_name', help='the name of the VM on which to act')
+    parser.add_argument('--vm_name', help='the name of the VM on which to act, '
+        'several comma separated names are deployed together')
     parser.add_argument('--rhev_cluster', help='the name of the VM on which to act', default=None)
     parser.add_argument('--ec2_flavor', help='ec2 flavor', default=None)
     parser.add_argument('--rhos_flavor', help='rhos flavor', default=None)
@@ -55,7 +56,8 @@ def main():
         # passing unused args to ec2 provider would blow up so I
         #   had to make it a little more specific
         deply_args = {}
-        if args.vm_name is not None:
+        vm_names = args.vm_name.split(',') if args.vm_name else []
+        if len(vm_names) == 1:
             deply_args.update(vm_name=args.vm_name)
         if args.rhos_flavor is not None:
             deply_args.update(flavour_name=args.rhos_flavor)
@@ -66,6 +68,9 @@ def main():
         if args.ec2_flavor is not None:
             deply_args.update(instance_type=args.ec2_flavor)
 
+        if len(vm_names) > 1:
+            return deploy_several(provider, args.template, vm_names, deply_args, args.outfile)
+
         vm = provider.deploy_template(args.template, **deply_args)
         if not provider.is_vm_running(vm):
             logging.error("VM is not running")
@@ -78,5 +83,26 @@ def main():
                 outfile.write("appliance_ip_address=%s\n" % ip)
     return 0
 
+
+def deploy_several(provider, template, vm_names, deploy_args, outfile_name):
+    """Deploys several vms at once, logging each one as soon as it is ready"""
+    ips = {}
+    for event in provider.deploy_templates(template, vm_names, **deploy_args):
+        if event.stage == 'failed':
+            logging.error('VM %s failed to deploy (%s)', event.vm_name, event.error)
+        elif event.stage == 'ready':
+            logging.info('VM %s is running with IP Address %s', event.vm_name, event.ip)
+            ips[event.vm_name] = event.ip
+        else:
+            logging.info('VM %s is %s', event.vm_name, event.stage)
+    if outfile_name:
+        with open(outfile_name, 'w') as outfile:
+            for vm_name in vm_names:
+                if vm_name in ips:
+                    outfile.write("appliance_ip_address_%s=%s\n" % (vm_name, ips[vm_name]))
+    if len(ips) < len(vm_names):
+        return 10
+    return 0
+
 if __name__ == "__main__":
     sys.exit(main())
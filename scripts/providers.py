@@ -11,6 +11,12 @@ Example usage:
 
     scripts/providers.py providername stop_vm vm-name
 
+Several providers can be acted on concurrently by passing a comma separated
+list of provider names, or "all" for every provider in cfme_data:
+
+    scripts/providers.py vsphere5,rhevm32 list_vm
+    scripts/providers.py all delete_vm vm-name
+
 Note that attempts to be clever will likely be successful, but fruitless.
 For example, this will work but not do anyhting helpful:
 
@@ -25,46 +31,75 @@ import sys
 cfme_tests_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 sys.path.insert(0, cfme_tests_path)
 
-from utils.providers import provider_factory
+from utils import conf
+from utils.providers import provider_factory, provider_fanout
 
 
 def main():
     parser = argparse.ArgumentParser(epilog=__doc__,
         formatter_class=argparse.RawDescriptionHelpFormatter)
     parser.add_argument('provider_name',
-        help='provider name in cfme_data')
+        help='provider name in cfme_data, comma separated names, or "all"')
     parser.add_argument('action',
         help='action to take (list_vm, stop_vm, delete_vm, etc.)')
     parser.add_argument('action_args', nargs='*',
         help='foo')
 
     args = parser.parse_args()
-    try:
-        result = call_provider(args.provider_name, args.action, *args.action_args)
-        if isinstance(result, list):
-            exit = 0
-            for entry in result:
-                print entry
-        elif isinstance(result, str):
-            exit = 0
-            print result
-        elif isinstance(result, bool):
-            # 'True' result becomes flipped exit 0, and vice versa for False
-            exit = int(not result)
-        else:
-            # Unknown type, explode
-            raise Exception('Unknown return type for "%s"' % args.action)
-    except Exception as e:
-        exit = 1
-        exc_type = type(e).__name__
-        if e.message:
-            sys.stderr.write('%s: %s\n' % (exc_type, e.message))
-        else:
-            sys.stderr.write('%s\n' % exc_type)
+    if args.provider_name == 'all':
+        provider_names = conf.cfme_data['management_systems'].keys()
+    else:
+        provider_names = args.provider_name.split(',')
+
+    if len(provider_names) == 1:
+        try:
+            result = call_provider(provider_names[0], args.action, *args.action_args)
+            return print_result(result, args.action)
+        except Exception as e:
+            print_error(e)
+            return 1
+
+    # Act on all the providers concurrently, report each one as it's printed
+    results = provider_fanout(args.action, provider_names, args.action_args)
+    exit = 0
+    for provider_name in provider_names:
+        result = results[provider_name]
+        print '[%s] (%.2fs)' % (provider_name, result.elapsed)
+        try:
+            if result.error is not None:
+                raise result.error
+            exit = print_result(result.result, args.action) or exit
+        except Exception as e:
+            print_error(e)
+            exit = 1
+    return exit
 
+
+def print_result(result, action):
+    if isinstance(result, list):
+        exit = 0
+        for entry in result:
+            print entry
+    elif isinstance(result, str):
+        exit = 0
+        print result
+    elif isinstance(result, bool):
+        # 'True' result becomes flipped exit 0, and vice versa for False
+        exit = int(not result)
+    else:
+        # Unknown type, explode
+        raise Exception('Unknown return type for "%s"' % action)
     return exit
 
 
+def print_error(e):
+    exc_type = type(e).__name__
+    if e.message:
+        sys.stderr.write('%s: %s\n' % (exc_type, e.message))
+    else:
+        sys.stderr.write('%s\n' % exc_type)
+
+
 def call_provider(provider_name, action, *args):
     # Given a provider class, find the named method and call it with
     # *args. This could possibly be generalized for other CLI tools.
@@ -15,7 +15,7 @@ import argparse
 import sys
 import time
 
-from utils.providers import provider_factory
+from utils.providers import provider_pool
 
 
 def main():
@@ -32,59 +32,40 @@ def main():
     args = parser.parse_args()
 
     # Make sure the VM is off to start
-    provider = provider_factory(args.provider_name)
-
-    if provider.is_vm_running(args.vm_name):
-        provider.stop_vm(args.vm_name)
-        provider.vm_status(args.vm_name)
+    with provider_pool.checkout(args.provider_name) as provider:
+        if provider.is_vm_running(args.vm_name):
+            provider.stop_vm(args.vm_name)
+            provider.vm_status(args.vm_name)
 
     # Toggle the VM On and Off based on the Uptime and Downtime input arguments
-    # The script diconnects from the provider before each sleep and reconnects after
-    # each sleep to prevent it from timing out
+    # The provider goes back to the pool before each sleep; the pool checks the
+    # session when it's handed out again and logs back in if it timed out
     while True:
         try:
-            # Initialize start_success to False so it enters the first while loop
-            # and the times_failed_counter to 0
-            start_success = False
-            times_failed_counter = 0
-            # Turn the VM on for the specified amount of time
-            # If it can't find the VM, keep trying for 30 minutes
-            while not start_success:
-                try:
-                    provider.start_vm(args.vm_name)
-                    provider.vm_status(args.vm_name)
-                    start_success = True
-                    provider.disconnect()
-                    time.sleep(args.uptime)
-                    provider = provider_factory(args.provider_name)
-                except Exception:
-                    time.sleep(60)
-                    times_failed_counter += 1
-                    if(times_failed_counter == 30):
-                        raise
-
-            # Initialize stop_success to False so it enters the first while loop
-            # and the times_failed_counter to 0
-            stop_success = False
-            times_failed_counter = 0
-            # Turn the VM off for the specified amount of time
-            # If it can't find the VM, keep trying for 30 minutes
-            while not stop_success:
-                try:
-                    provider.stop_vm(args.vm_name)
-                    provider.vm_status(args.vm_name)
-                    stop_success = True
-                    provider.disconnect()
-                    time.sleep(args.downtime)
-                    provider = provider_factory(args.provider_name)
-                except Exception:
-                    time.sleep(60)
-                    times_failed_counter += 1
-                    if(times_failed_counter == 30):
-                        raise
+            toggle(args.provider_name, args.vm_name, 'start_vm')
+            time.sleep(args.uptime)
+            toggle(args.provider_name, args.vm_name, 'stop_vm')
+            time.sleep(args.downtime)
         except(KeyboardInterrupt):
             return 0
 
 
+def toggle(provider_name, vm_name, action):
+    """Starts or stops the VM, retrying every minute for 30 minutes if that fails"""
+    times_failed_counter = 0
+    while True:
+        try:
+            with provider_pool.checkout(provider_name) as provider:
+                getattr(provider, action)(vm_name)
+                provider.vm_status(vm_name)
+            return
+        except Exception:
+            # The pool has already dropped the client if its session was lost
+            time.sleep(60)
+            times_failed_counter += 1
+            if(times_failed_counter == 30):
+                raise
+
+
 if __name__ == '__main__':
     sys.exit(main())
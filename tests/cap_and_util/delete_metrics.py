@@ -1,17 +1,11 @@
-import db
+from utils.purge import purge
 
 def delete_raw_metric_data(db_session, resource_id):
-    resource_id = resource_id
-    session = db_session
-    session.query(db.Metric).filter(db.Metric.resource_id == resource_id).delete()
-
-    session.commit()
+    # Commit first, the purge deletes on connections of its own. Rows of any
+    # resource type with that id go, hosts' and clusters' as well as vms'
+    db_session.commit()
+    purge(db_session.get_bind(), ['metrics'], resources=[resource_id], resource_type=None)
 
 def delete_metric_rollup_data(db_session, resource_id):
-    resource_id = resource_id
-    session = db_session
-    session.query(db.MetricRollup).filter(db.MetricRollup.resource_id == resource_id).delete()
-
-    session.commit()
-
-
+    db_session.commit()
+    purge(db_session.get_bind(), ['rollups'], resources=[resource_id], resource_type=None)
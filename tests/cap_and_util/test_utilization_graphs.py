@@ -8,6 +8,7 @@ from add_metrics import insert_previous_hour_raw_metric_data
 from add_metrics import insert_previous_weeks_hourly_rollups
 from add_metrics import insert_previous_weeks_daily_rollups
 from selenium.webdriver.common.keys import Keys
+from utils.metrics import read_metrics
 
 
 @pytest.fixture
@@ -46,6 +47,13 @@ def test_add_previous_weeks_hourly_metrics(infra_vms_pg, db_session, vm_info):
         'cpu_used_delta_summation': 2143234.66666667
     }
     insert_previous_weeks_hourly_rollups(db_session, resource_id, columns)
+    series = read_metrics(db_session.connection(), 'hourly',
+        ['cpu_usagemhz_rate_average', 'net_usage_rate_average'],
+        datetime.datetime.utcnow() - datetime.timedelta(days = 8),
+        resources = [resource_id])
+    # The appliance may have captured real samples of the vm as well
+    Assert.true((series.columns['cpu_usagemhz_rate_average'] == 200).sum() >= 168)
+    Assert.true((series.columns['net_usage_rate_average'] == 500).sum() >= 168)
 
     Assert.true(infra_vms_pg.is_the_current_page)
     vm_details_pg = infra_vms_pg.find_vm_page(vm_name,None, False,True)
@@ -81,6 +89,11 @@ def test_add_previous_hour_raw_metrics(infra_vms_pg, db_session, vm_info):
         'cpu_used_delta_summation': 2143234.66666667
     }
     insert_previous_hour_raw_metric_data(db_session, resource_id, columns)
+    series = read_metrics(db_session.connection(), 'realtime',
+        ['cpu_usagemhz_rate_average'],
+        datetime.datetime.utcnow() - datetime.timedelta(hours = 2),
+        resources = [resource_id])
+    Assert.true((series.columns['cpu_usagemhz_rate_average'] == 700).sum() >= 180)
 
     Assert.true(infra_vms_pg.is_the_current_page)
     vm_details_pg = infra_vms_pg.find_vm_page(vm_name,None, False,True)
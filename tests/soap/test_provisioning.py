@@ -10,7 +10,7 @@ from time import time, sleep
 import pytest
 from unittestzero import Assert
 
-import db
+from utils.db_queries import find_vm
 
 pytestmark = [
     pytest.mark.slow,
@@ -36,14 +36,12 @@ def test_create_request(db_session, soap_client):
     global request_id
 
     # Find template guid
-    template_guid = None
-    for name, guid in db_session.query(db.Vm.name, db.Vm.guid).filter(db.Vm.template==True):
-        if 'cfme' in name.lower():
-            template_guid = guid.strip()
-            logging.info('Using (%s,%s) template.' % (name, guid))
-            break
-    else:
+    template = find_vm(db_session, 'cfme', template=True, columns=('name', 'guid'),
+                       contains=True, ignore_case=True)
+    if template is None:
         raise Exception("Couldn't find CFME template for provisioning smoke test")
+    template_guid = template.guid.strip()
+    logging.info('Using (%s,%s) template.' % (template.name, template.guid))
 
     Assert.not_none(template_guid)
     # Generate provision request
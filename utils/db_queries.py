@@ -0,0 +1,103 @@
+"""Read-only lookups of common rows in the appliance database
+
+Every lookup filters on the database side and only fetches the columns it
+needs. Statements are built once per shape with bound parameters, and their
+compiled form is cached, so repeated lookups only send the query.
+
+Example::
+
+    from utils import db_queries
+    template = db_queries.find_vm(db_session, 'cfme', template=True, contains=True,
+                                  ignore_case=True)
+    if template is not None:
+        print template.name, template.guid
+
+"""
+from sqlalchemy import bindparam, func, select
+
+# Statements by schema and lookup shape, and their compiled forms by schema.
+# Every schema version has Table objects of its own, so a statement built for
+# one appliance's schema is never run against another's.
+_statements = {}
+_compiled_caches = {}
+
+
+def find_vm(session, name, template=None, columns=('name', 'guid', 'power_state'),
+            contains=False, ignore_case=False):
+    """Returns the first vm with the given name, or None
+
+    Args:
+        session: A database session, ``db_session`` in tests
+        name: Name of the vm, matched exactly
+        template: True for templates only, False for vms only, None for both
+        columns: Names of the vms columns to return
+        contains: Match the vms whose name contains name instead. ``_`` and
+            ``%`` in name match themselves only.
+        ignore_case: Ignore case when matching with contains
+
+    Returns:
+        A row with the requested columns as attributes
+
+    """
+    import db
+
+    def build(table):
+        if not contains:
+            condition = table.c.name == bindparam('name')
+        elif ignore_case:
+            condition = table.c.name.ilike(bindparam('name'), escape='\\')
+        else:
+            condition = table.c.name.like(bindparam('name'), escape='\\')
+        statement = select([table.c[column] for column in columns]).where(condition)
+        if template is not None:
+            statement = statement.where(table.c.template == template)
+        return statement.order_by(table.c.id).limit(1)
+    if contains:
+        name = '%%%s%%' % _escape_like(name)
+    key = ('find_vm', template, tuple(columns), contains, contains and ignore_case)
+    return _execute(session, db.Vm.__table__, key, build, name=name).first()
+
+
+def find_by_name(session, model, name, columns=('id',)):
+    """Returns the row of a model with the given name, or None
+
+    Args:
+        session: A database session, ``db_session`` in tests
+        model: A class of the db module, like ``db.PxeImageType``
+        name: Exact name to look for
+        columns: Names of the columns to return
+
+    """
+    def build(table):
+        return select([table.c[column] for column in columns]).where(
+            table.c.name == bindparam('name')).order_by(table.c.id).limit(1)
+    key = ('find_by_name', model.__table__.name, tuple(columns))
+    return _execute(session, model.__table__, key, build, name=name).first()
+
+
+def find_pxe_server(session, name, columns=('id', 'name')):
+    """Returns the PXE server with the given name, or None"""
+    import db
+    return find_by_name(session, db.PxeServer, name, columns)
+
+
+def latest_id(session, model):
+    """Returns the highest id of a model, None if it has no rows"""
+    key = ('latest_id', model.__table__.name)
+    return _execute(session, model.__table__, key,
+                    lambda table: select([func.max(table.c.id)])).scalar()
+
+
+def _escape_like(value):
+    """Escapes the wildcards of a LIKE pattern, with backslashes"""
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def _execute(session, table, key, build, **params):
+    """Runs the statement build(table) returns, built once per schema and key"""
+    statements = _statements.setdefault(table.metadata, {})
+    if key not in statements:
+        statements[key] = build(table)
+    compiled_cache = _compiled_caches.setdefault(table.metadata, {})
+    connection = session.connection().execution_options(compiled_cache=compiled_cache)
+    return connection.execute(statements[key], **params)
@@ -0,0 +1,203 @@
+"""Waiting on the appliance database instead of refreshing the UI
+
+A waiter reads one column of one row with a small indexed query, and returns
+as soon as it holds the wanted value. On postgres, tables with a notify
+trigger (see install_notify) wake the waiter the moment a row changes, other
+tables are polled with a short backoff. Either way a change is usually seen
+within a second, where the UI loops sleep for tens of seconds between refreshes.
+
+Fixtures and pages wait this way when ``db_waits`` is set in env.yaml, which
+needs the database to be reachable, see fixtures/cfmedb.py.
+
+Example::
+
+    from utils import db_wait
+    db_wait.wait_for_vm_state('my_vm', 'on', timeout=600)
+
+"""
+import select as select_module
+import time
+
+from sqlalchemy import bindparam, select
+
+import db
+from utils import conf
+from utils.wait import TimedOutError
+
+# Bounds in seconds of the backoff between polls. With notify triggers the
+# upper bound is how long a waiter goes without a notification before
+# checking anyway
+POLL_MIN_DELAY = 0.25
+POLL_MAX_DELAY = 5
+
+# Prefix of the notify function, triggers and channels
+NOTIFY_PREFIX = 'cfme_tests_notify'
+
+# Statements by (table, column, key column), and their compiled forms
+_statements = {}
+_compiled_cache = {}
+
+# Table name -> whether it has a notify trigger
+_notify_tables = {}
+
+
+def enabled():
+    """Whether fixtures and pages should wait on the database"""
+    return bool(conf.env.get('db_waits', False))
+
+
+def wait_for_vm_state(vm_name, states, timeout=600, engine=None):
+    """Waits for a vm's power_state, 'on', 'off', 'suspended', etc., to be one of states"""
+    if isinstance(states, basestring):
+        states = [states]
+    return wait_for_row(db.Vm, 'power_state', 'name', vm_name, lambda state: state in states,
+                        timeout, engine, 'vm %s to be %s' % (vm_name, ' or '.join(states)))
+
+
+def wait_for_provider(name, timeout=600, engine=None):
+    """Waits for a management system to be added, returns its id"""
+    return wait_for_row(db.ExtManagementSystem, 'id', 'name', name,
+                        lambda provider_id: provider_id is not None, timeout, engine,
+                        'provider %s to be added' % name)
+
+
+def wait_for_task_state(task_id, states, timeout=600, engine=None):
+    """Waits for the state of a MiqTask to be one of states, like 'Finished'"""
+    if isinstance(states, basestring):
+        states = [states]
+    return wait_for_row(db.MiqTask, 'state', 'id', task_id, lambda state: state in states,
+                        timeout, engine, 'task %s to be %s' % (task_id, ' or '.join(states)))
+
+
+def wait_for_request_state(request_id, states, timeout=600, engine=None):
+    """Waits for the request_state of a MiqRequest to be one of states, like 'finished'"""
+    if isinstance(states, basestring):
+        states = [states]
+    return wait_for_row(db.MiqRequest, 'request_state', 'id', request_id,
+                        lambda state: state in states, timeout, engine,
+                        'request %s to be %s' % (request_id, ' or '.join(states)))
+
+
+def wait_for_row(model, column, key_column, key, condition, timeout=600, engine=None,
+                 message=None):
+    """Waits for a column of a row to satisfy condition
+
+    Args:
+        model: A class of the db module, like ``db.Vm``
+        column: Name of the column to watch
+        key_column: Name of the column identifying the row, ideally indexed.
+            The newest row wins when several match.
+        key: Value of key_column of the row
+        condition: Callable taking the column value, None if there is no row yet
+        timeout: Seconds to wait
+        engine: SQLAlchemy engine, ``db.engine`` by default
+        message: What is being waited for, for the timeout error
+
+    Returns:
+        The column value that satisfied condition
+
+    """
+    engine = engine or db.engine
+    table = model.__table__
+    statement = _statement(table, column, key_column)
+    execute = engine.execution_options(compiled_cache=_compiled_cache).execute
+    listener = None
+    if engine.dialect.name == 'postgresql' and _has_notify(engine, table.name):
+        listener = _Listener(engine, '%s_%s' % (NOTIFY_PREFIX, table.name))
+    start = time.time()
+    delay = POLL_MIN_DELAY
+    try:
+        while True:
+            value = execute(statement, key=key).scalar()
+            if condition(value):
+                return value
+            remaining = timeout - (time.time() - start)
+            if remaining <= 0:
+                raise TimedOutError('Could not wait for %s in time' % (
+                    message or '%s.%s' % (table.name, column)))
+            if listener is not None:
+                listener.wait(min(remaining, POLL_MAX_DELAY))
+            else:
+                time.sleep(min(delay, remaining))
+                delay = min(delay * 2, POLL_MAX_DELAY)
+    finally:
+        if listener is not None:
+            listener.close()
+
+
+def install_notify(model, engine=None):
+    """Makes postgres notify waiters whenever a row of model is inserted or updated
+
+    This adds a trigger to the appliance database, which stays until
+    uninstall_notify is called.
+
+    """
+    engine = engine or db.engine
+    table_name = model.__table__.name
+    engine.execute("""
+        CREATE OR REPLACE FUNCTION %(prefix)s() RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_notify('%(prefix)s_' || TG_TABLE_NAME, '');
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+        DROP TRIGGER IF EXISTS %(prefix)s ON %(table)s;
+        CREATE TRIGGER %(prefix)s AFTER INSERT OR UPDATE ON %(table)s
+            FOR EACH STATEMENT EXECUTE PROCEDURE %(prefix)s();
+        """ % {'prefix': NOTIFY_PREFIX, 'table': table_name})
+    _notify_tables[table_name] = True
+
+
+def uninstall_notify(model, engine=None):
+    engine = engine or db.engine
+    table_name = model.__table__.name
+    engine.execute('DROP TRIGGER IF EXISTS %s ON %s' % (NOTIFY_PREFIX, table_name))
+    _notify_tables[table_name] = False
+
+
+def _has_notify(engine, table_name):
+    if table_name not in _notify_tables:
+        _notify_tables[table_name] = bool(engine.execute(
+            "SELECT 1 FROM pg_trigger t JOIN pg_class c ON t.tgrelid = c.oid "
+            "WHERE t.tgname = %s AND c.relname = %s", (NOTIFY_PREFIX, table_name)).scalar())
+    return _notify_tables[table_name]
+
+
+def _statement(table, column, key_column):
+    key = (table.name, column, key_column)
+    if key not in _statements:
+        _statements[key] = select([table.c[column]]).where(
+            table.c[key_column] == bindparam('key')).order_by(table.c.id.desc()).limit(1)
+    return _statements[key]
+
+
+class _Listener(object):
+    """LISTENs on a channel on a pooled connection switched to autocommit
+
+    The waiter polls on another connection meanwhile, so a wait takes two
+    connections of the pool; the pool overflow in fixtures/cfmedb.py allows
+    for that.
+
+    """
+    def __init__(self, engine, channel):
+        self._raw = engine.raw_connection()
+        self.connection = self._raw.connection
+        self._isolation_level = self.connection.isolation_level
+        # Notifications are only delivered outside of transactions
+        self.connection.set_isolation_level(0)
+        cursor = self.connection.cursor()
+        cursor.execute('LISTEN %s' % channel)
+        cursor.close()
+
+    def wait(self, timeout):
+        """Returns after a notification arrives, or timeout seconds"""
+        if select_module.select([self.connection], [], [], timeout)[0]:
+            self.connection.poll()
+            del self.connection.notifies[:]
+
+    def close(self):
+        cursor = self.connection.cursor()
+        cursor.execute('UNLISTEN *')
+        cursor.close()
+        self.connection.set_isolation_level(self._isolation_level)
+        self._raw.close()
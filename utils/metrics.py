@@ -0,0 +1,506 @@
+"""Bulk generation of capacity and utilization metrics
+
+Realtime samples are written straight into the hourly partitions of the
+metrics table (metrics_00 to metrics_23, by the hour of their timestamp) and
+hourly and daily rollups into the monthly partitions of metric_rollups
+(metric_rollups_01 to metric_rollups_12), the same way the appliance stores
+them. Values are computed with numpy a batch of resources at a time and
+written with a postgres COPY, or an executemany on other databases.
+
+Example, three months of hourly rollups for every vm::
+
+    from utils import metrics
+    vms = dict(db_session.query(db.Vm.id, db.Vm.name))
+    metrics.insert_metrics(db_session.connection(), vms, 'hourly',
+        start, end, {
+            'cpu_usagemhz_rate_average': metrics.sinusoid(500, 300, 86400),
+            'derived_memory_used': metrics.random_walk(1024, 16, low=0),
+            'disk_usage_rate_average': metrics.step([10, 80], 3600 * 6),
+            'net_usage_rate_average': metrics.constant(100),
+        })
+    db_session.commit()
+
+Series are read back the same way, as numpy arrays with a column per counter,
+to check what the appliance stored or rolled up::
+
+    series = metrics.read_metrics(db.engine, 'hourly',
+        ['cpu_usagemhz_rate_average'], start, end, resources=[vm_id])
+    print series.columns['cpu_usagemhz_rate_average'].mean()
+    mismatches = metrics.verify_rollups(db.engine, 'hourly',
+        ['cpu_usagemhz_rate_average'], start, end, resources=[vm_id])
+
+"""
+import datetime
+import hashlib
+import itertools
+import os
+from collections import namedtuple
+from cStringIO import StringIO
+
+import numpy as np
+from sqlalchemy import and_, select
+from sqlalchemy.engine import Engine
+
+import db
+
+# Seconds between two samples of each capture interval
+INTERVALS = {
+    'realtime': 20,
+    'hourly': 3600,
+    'daily': 86400,
+}
+
+# Resources whose series are computed and written together
+BATCH_SIZE = 100
+
+# Rows fetched per round trip when reading metrics back
+FETCH_SIZE = 10000
+
+# How each rollup interval groups the samples it is computed from
+ROLLUP_UNITS = {
+    'hourly': 'h',
+    'daily': 'D',
+}
+
+# A stored rollup value that differs from the one recomputed from realtime
+# samples; stored is nan when the appliance has no rollup for that time
+RollupMismatch = namedtuple('RollupMismatch',
+                            ['resource_id', 'timestamp', 'column', 'expected', 'stored'])
+
+
+def constant(value):
+    """Generates the same value for every sample"""
+    def generate(times, random):
+        return np.repeat(float(value), len(times))
+    return generate
+
+
+def sinusoid(mean, amplitude, period, phase=0):
+    """Generates a sine wave
+
+    Args:
+        mean: Value the wave oscillates around
+        amplitude: Largest distance from the mean
+        period: Length of a full wave in seconds, 86400 for a daily cycle
+        phase: Offset of the wave in radians
+
+    """
+    def generate(times, random):
+        return mean + amplitude * np.sin(2 * np.pi * times / float(period) + phase)
+    return generate
+
+
+def random_walk(start, step, low=None, high=None):
+    """Generates a random walk with normally distributed steps
+
+    Args:
+        start: Value of the first sample
+        step: Standard deviation of the change between two samples
+        low: Values are clipped to be at least this, if given
+        high: Values are clipped to be at most this, if given
+
+    """
+    def generate(times, random):
+        steps = random.normal(0, step, len(times))
+        steps[0] = 0
+        values = start + np.cumsum(steps)
+        if low is not None or high is not None:
+            values = np.clip(values, low, high)
+        return values
+    return generate
+
+
+def step(values, every):
+    """Cycles through values, changing to the next one every so many seconds"""
+    values = np.asarray(values, dtype=float)
+
+    def generate(times, random):
+        return values[((times - times[0]) // every).astype(int) % len(values)]
+    return generate
+
+
+def insert_metrics(bind, resources, interval, start, end, columns,
+                   resource_type='VmOrTemplate', seed=None):
+    """Writes a series of metrics for every resource between two times
+
+    Args:
+        bind: A SQLAlchemy engine, whose rows are committed when all are
+            written, or a connection, ``db_session.connection()`` to write in
+            the session's transaction and leave committing to the caller
+        resources: Resource ids, or a dict of resource id -> resource name
+        interval: Capture interval, one of the INTERVALS
+        start: First sample time, a datetime in UTC
+        end: Last possible sample time, a datetime in UTC
+        columns: Dict of column name -> value, or generator from this module
+            to compute a series of values for each resource
+        resource_type: Type of the resources
+        seed: Seed for the random generators, for repeatable data
+
+    Returns:
+        A dict of table name -> number of rows written
+
+    """
+    if not isinstance(resources, dict):
+        resources = dict((resource_id, None) for resource_id in resources)
+    if 'resource_name' in columns:
+        resources = dict((resource_id, columns['resource_name']) for resource_id in resources)
+    random = np.random.RandomState(seed)
+    epoch = datetime.datetime(1970, 1, 1)
+    first = int((start - epoch).total_seconds())
+    last = int((end - epoch).total_seconds())
+    times = np.arange(first, last + 1, INTERVALS[interval])
+    stamps = times.astype('datetime64[s]')
+    if interval == 'realtime':
+        partitions = (times // 3600) % 24
+        names = ['metrics_%02d' % hour for hour in range(24)]
+    else:
+        partitions = stamps.astype('datetime64[M]').astype(int) % 12
+        names = ['metric_rollups_%02d' % (month + 1) for month in range(12)]
+    partition_times = [np.flatnonzero(partitions == i) for i in range(len(names))]
+
+    series = dict((name, value) for name, value in columns.iteritems() if callable(value))
+    fixed = dict((name, value) for name, value in columns.iteritems()
+                 if not callable(value) and name != 'resource_name')
+    fixed.setdefault('resource_type', resource_type)
+    fixed['capture_interval_name'] = interval
+    column_names = ['resource_id', 'resource_name', 'timestamp'] + sorted(fixed) + sorted(series)
+
+    counts = {}
+    connection = bind.connect()
+    # A connection of the caller's writes in its transaction. One of an engine
+    # needs a transaction of its own, or returning it to the pool rolls back
+    # the rows COPY wrote on its raw cursor
+    transaction = connection.begin() if isinstance(bind, Engine) else None
+    try:
+        ids = sorted(resources)
+        for i in range(0, len(ids), BATCH_SIZE):
+            batch = ids[i:i + BATCH_SIZE]
+            values = dict((name, np.array([generate(times, random) for resource_id in batch]))
+                          for name, generate in series.iteritems())
+            for name, indexes in zip(names, partition_times):
+                if not len(indexes):
+                    continue
+                columns = {
+                    'resource_id': np.repeat(batch, len(indexes)),
+                    'resource_name': np.repeat([resources[r] for r in batch], len(indexes)),
+                    'timestamp': np.tile(stamps[indexes], len(batch)),
+                }
+                for column, value in values.iteritems():
+                    columns[column] = value[:, indexes].ravel()
+                rows = len(batch) * len(indexes)
+                _write_rows(connection, name, column_names, columns, fixed, rows)
+                counts[name] = counts.get(name, 0) + rows
+        if transaction is not None:
+            transaction.commit()
+    finally:
+        connection.close()
+    return counts
+
+
+def _partition_table(name):
+    """Returns the mapped Table of a partition, Metric05 for metrics_05 and so on"""
+    if name.startswith('metrics_'):
+        cls = getattr(db, 'Metric%s' % name[len('metrics_'):])
+    else:
+        cls = getattr(db, 'MetricRollup%s' % name[len('metric_rollups_'):])
+    return cls.__table__
+
+
+def _write_rows(connection, name, column_names, columns, fixed, rows):
+    """Writes one partition's rows, given as arrays of each column plus the fixed values"""
+    if connection.dialect.name == 'postgresql':
+        _copy_rows(connection, name, column_names, columns, fixed, rows)
+    else:
+        columns = dict((column, value.astype(object) if column == 'timestamp' else value)
+                       for column, value in columns.iteritems())
+        values = [columns[column].tolist() if column in columns
+                  else itertools.repeat(fixed[column]) for column in column_names]
+        connection.execute(_partition_table(name).insert(),
+                           [dict(zip(column_names, row)) for row in itertools.izip(*values)])
+
+
+def _copy_rows(connection, name, column_names, columns, fixed, rows):
+    """Streams rows into a table with COPY, in postgres' text format
+
+    Every column is turned into text in one go, the rows are only joined up.
+
+    """
+    text = []
+    for column in column_names:
+        if column == 'timestamp':
+            text.append(np.datetime_as_string(columns[column]).tolist())
+        elif column == 'resource_name':
+            names = columns[column]
+            escaped = dict((name, _copy_value(name)) for name in set(names.tolist()))
+            text.append([escaped[name] for name in names.tolist()])
+        elif column in columns:
+            # numpy prints the shortest repr of floats, without a python call each
+            text.append(columns[column].astype(str).tolist())
+        else:
+            text.append(itertools.repeat(_copy_value(fixed[column]), rows))
+    data = StringIO('\n'.join('\t'.join(row) for row in itertools.izip(*text)) + '\n')
+    cursor = connection.connection.cursor()
+    try:
+        cursor.copy_from(data, name, columns=column_names)
+    finally:
+        cursor.close()
+
+
+def _copy_value(value):
+    if value is None:
+        return '\\N'
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n')
+
+
+class MetricSeries(object):
+    """Metrics as contiguous arrays, sorted by resource and then by time
+
+    Attributes:
+        resource_ids: int64 array of the resource of every sample
+        timestamps: datetime64[s] array of the time of every sample, in UTC
+        columns: Dict of column name -> float64 array, nan where the
+            appliance stored NULL
+
+    """
+    def __init__(self, resource_ids, timestamps, columns):
+        self.resource_ids = resource_ids
+        self.timestamps = timestamps
+        self.columns = columns
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def resource(self, resource_id):
+        """Returns the samples of one resource"""
+        start, end = np.searchsorted(self.resource_ids, [resource_id, resource_id + 1])
+        return MetricSeries(self.resource_ids[start:end], self.timestamps[start:end],
+            dict((name, values[start:end]) for name, values in self.columns.iteritems()))
+
+    def rollup(self, interval, aggregates=None):
+        """Aggregates the samples of every resource per hour or per day
+
+        Daily values are computed from the hourly ones, the way the
+        appliance rolls them up. NULL samples are left out.
+
+        Args:
+            interval: 'hourly' or 'daily'
+            aggregates: Dict of column name -> 'mean', 'sum', 'min' or 'max',
+                columns not in it are averaged
+
+        Returns:
+            A :py:class:`MetricSeries` stamped with the start of each hour or day
+
+        """
+        aggregates = aggregates or {}
+        series = self
+        if interval == 'daily':
+            series = series.rollup('hourly', aggregates)
+        buckets = series.timestamps.astype('datetime64[%s]' % ROLLUP_UNITS[interval])
+        if not len(buckets):
+            return series
+        changes = np.ones(len(buckets), dtype=bool)
+        changes[1:] = ((series.resource_ids[1:] != series.resource_ids[:-1]) |
+                       (buckets[1:] != buckets[:-1]))
+        starts = np.flatnonzero(changes)
+        columns = {}
+        for name, values in series.columns.iteritems():
+            columns[name] = _aggregate(values, starts, aggregates.get(name, 'mean'))
+        return MetricSeries(series.resource_ids[starts],
+                            buckets[starts].astype('datetime64[s]'), columns)
+
+    def save(self, path):
+        """Writes the arrays to a compressed numpy file"""
+        arrays = dict(('column_%s' % name, values) for name, values in self.columns.iteritems())
+        # Written under a temporary name first so a reader never sees half a file
+        with open(path + '.tmp', 'wb') as cache:
+            np.savez_compressed(cache, resource_ids=self.resource_ids,
+                                timestamps=self.timestamps, **arrays)
+        os.rename(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, path):
+        """Reads arrays written by :py:meth:`save`"""
+        with np.load(path) as arrays:
+            return cls(arrays['resource_ids'], arrays['timestamps'],
+                       dict((name[len('column_'):], arrays[name]) for name in arrays.files
+                            if name.startswith('column_')))
+
+
+def read_metrics(bind, interval, columns, start=None, end=None, resources=None,
+                 resource_type='VmOrTemplate', cache_dir=None):
+    """Reads a series of metrics into numpy arrays
+
+    Only the partitions that can hold samples of the window are queried, and
+    rows are streamed from a server-side cursor on postgres, FETCH_SIZE at a
+    time, so reading months of realtime samples never holds them all as
+    python objects.
+
+    Args:
+        bind: A SQLAlchemy engine or connection
+        interval: Capture interval, one of the INTERVALS
+        columns: Names of the counters to read
+        start: Only read samples from this datetime on, in UTC
+        end: Only read samples before this datetime, in UTC
+        resources: Ids of the resources to read, all by default
+        resource_type: Type of the resources
+        cache_dir: Directory to keep the arrays in. A read with the same
+            arguments against the same database loads them from there
+            instead, so only use it for windows that are complete.
+
+    Returns:
+        A :py:class:`MetricSeries`
+
+    """
+    columns = list(columns)
+    if cache_dir is not None:
+        key = repr((str(bind.engine.url), interval, columns, start, end,
+                    sorted(resources) if resources is not None else None, resource_type))
+        path = os.path.join(cache_dir, 'metrics-%s.npz' % hashlib.sha1(key).hexdigest())
+        if os.path.exists(path):
+            return MetricSeries.load(path)
+
+    chunks = []
+    connection = bind.connect().execution_options(stream_results=True)
+    try:
+        for name in _read_partitions(interval, start, end):
+            table = _partition_table(name)
+            conditions = [table.c.capture_interval_name == interval,
+                          table.c.resource_type == resource_type]
+            if resources is not None:
+                conditions.append(table.c.resource_id.in_(list(resources)))
+            if start is not None:
+                conditions.append(table.c.timestamp >= start)
+            if end is not None:
+                conditions.append(table.c.timestamp < end)
+            result = connection.execute(select(
+                [table.c.resource_id, table.c.timestamp] + [table.c[column] for column in columns]
+            ).where(and_(*conditions)))
+            while True:
+                rows = result.fetchmany(FETCH_SIZE)
+                if not rows:
+                    break
+                chunks.append(_row_arrays(rows, len(columns)))
+    finally:
+        connection.close()
+
+    if chunks:
+        arrays = [np.concatenate(chunk) for chunk in zip(*chunks)]
+    else:
+        arrays = [np.array([], dtype=np.int64), np.array([], dtype='datetime64[s]')]
+        arrays += [np.array([], dtype=float) for column in columns]
+    order = np.lexsort((arrays[1], arrays[0]))
+    series = MetricSeries(arrays[0][order], arrays[1][order],
+                          dict((column, values[order])
+                               for column, values in zip(columns, arrays[2:])))
+    if cache_dir is not None:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        series.save(path)
+    return series
+
+
+def verify_rollups(bind, interval, columns, start, end, resources=None,
+                   resource_type='VmOrTemplate', aggregates=None, rtol=0.01):
+    """Compares the stored rollups to ones recomputed from realtime samples
+
+    Only the hours or days completely inside the window are compared.
+
+    Args:
+        bind: A SQLAlchemy engine or connection
+        interval: 'hourly' or 'daily'
+        columns: Names of the counters to compare
+        start: Start of the window, a datetime in UTC
+        end: End of the window, a datetime in UTC
+        resources: Ids of the resources to check, all by default
+        resource_type: Type of the resources
+        aggregates: How to aggregate each column, see :py:meth:`MetricSeries.rollup`
+        rtol: Relative difference allowed between the two values
+
+    Returns:
+        A list of :py:class:`RollupMismatch`, empty if the rollups are right
+
+    """
+    expected = read_metrics(bind, 'realtime', columns, start, end, resources,
+                            resource_type).rollup(interval, aggregates)
+    unit = ROLLUP_UNITS[interval]
+    # The buckets cut by the window's edges are missing samples
+    first = np.datetime64(start, unit)
+    if first < np.datetime64(start, 's'):
+        first += 1
+    last = np.datetime64(end, unit)
+    complete = ((expected.timestamps >= first) & (expected.timestamps < last))
+    expected = MetricSeries(expected.resource_ids[complete], expected.timestamps[complete],
+        dict((name, values[complete]) for name, values in expected.columns.iteritems()))
+    stored = read_metrics(bind, interval, columns, start, end, resources, resource_type)
+
+    key_type = [('resource_id', np.int64), ('timestamp', np.int64)]
+    expected_keys = _series_keys(expected, key_type)
+    stored_keys = _series_keys(stored, key_type)
+    # Both are sorted by resource and time, find each expected row among the stored
+    positions = np.searchsorted(stored_keys, expected_keys)
+    found = positions < len(stored_keys)
+    found[found] = stored_keys[positions[found]] == expected_keys[found]
+
+    mismatches = []
+    for column in columns:
+        stored_values = np.repeat(np.nan, len(expected))
+        stored_values[found] = stored.columns[column][positions[found]]
+        expected_values = expected.columns[column]
+        wrong = ~np.isclose(stored_values, expected_values, rtol=rtol, equal_nan=True)
+        for i in np.flatnonzero(wrong):
+            mismatches.append(RollupMismatch(int(expected.resource_ids[i]),
+                                             expected.timestamps[i].astype(datetime.datetime),
+                                             column, expected_values[i], stored_values[i]))
+    return mismatches
+
+
+def _read_partitions(interval, start, end):
+    """Returns the names of the partitions that can hold samples between start and end"""
+    if interval == 'realtime':
+        count, unit, name = 24, 'h', 'metrics_%02d'
+    else:
+        count, unit, name = 12, 'M', 'metric_rollups_%02d'
+    if start is None or end is None:
+        indexes = range(count)
+    else:
+        first = np.datetime64(start, unit).astype(int)
+        last = np.datetime64(end, unit).astype(int)
+        indexes = sorted(set(i % count for i in range(first, min(last, first + count - 1) + 1)))
+    if interval != 'realtime':
+        return [name % (index + 1) for index in indexes]
+    return [name % index for index in indexes]
+
+
+def _row_arrays(rows, columns):
+    """Turns fetched rows into a resource id, a timestamp and a float array per column"""
+    values = zip(*rows)
+    arrays = [np.array(values[0], dtype=np.int64),
+              np.array(values[1], dtype='datetime64[s]')]
+    arrays += [np.array(values[i], dtype=float) for i in range(2, columns + 2)]
+    return arrays
+
+
+def _aggregate(values, starts, how):
+    """Aggregates the groups of values beginning at starts, leaving nan out"""
+    missing = np.isnan(values)
+    counts = np.add.reduceat(~missing, starts).astype(float)
+    if how in ('mean', 'sum'):
+        sums = np.add.reduceat(np.where(missing, 0, values), starts)
+        result = sums / counts if how == 'mean' else sums
+    elif how == 'max':
+        result = np.maximum.reduceat(np.where(missing, -np.inf, values), starts)
+    elif how == 'min':
+        result = np.minimum.reduceat(np.where(missing, np.inf, values), starts)
+    else:
+        raise ValueError('Unknown aggregate %s' % how)
+    result[counts == 0] = np.nan
+    return result
+
+
+def _series_keys(series, key_type):
+    keys = np.empty(len(series), dtype=key_type)
+    keys['resource_id'] = series.resource_ids
+    keys['timestamp'] = series.timestamps.astype(np.int64)
+    return keys
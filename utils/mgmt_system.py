@@ -1,18 +1,26 @@
 # coding: utf-8
 """Base module for Management Systems classes"""
+import bisect
+import random
 import re
+import threading
 import time
+import uuid
 import boto
 from abc import ABCMeta, abstractmethod
+from collections import Counter, namedtuple, OrderedDict
+from multiprocessing.pool import ThreadPool
 from boto.ec2 import EC2Connection, get_region
+from boto.exception import EC2ResponseError
 from ovirtsdk.api import API
 from ovirtsdk.xml import params
 from pysphere import VIServer, MORTypes
 from pysphere.resources import VimService_services as VI
 from pysphere.resources.vi_exception import VIException
 from pysphere.vi_task import VITask
+from novaclient import exceptions as osexceptions
 from novaclient.v1_1 import client as osclient
-from utils.wait import wait_for
+from utils.wait import wait_for, TimedOutError
 
 
 class MgmtSystemAPIBase(object):
@@ -31,6 +39,82 @@ class MgmtSystemAPIBase(object):
     # default True
     can_suspend = True
 
+    # Maps generic state names to the statuses vm_status reports for them,
+    # used by wait_for_vm_state
+    states = {}
+
+    # Bounds in seconds of the backoff between status polls
+    state_poll_min_delay = 1
+    state_poll_max_delay = 30
+
+    # Longest a deploy_templates stage waits before checking on the others
+    deploy_poll_interval = 5
+
+    # Most IP addresses resolved at the same time by deploy_templates
+    deploy_ip_threads = 20
+
+    # Number of seconds a name -> handle lookup stays cached, 0 disables it
+    handle_cache_ttl = 60
+
+    # Maximum number of handles cached, least recently used are evicted first
+    handle_cache_size = 1000
+
+    # Backend query name -> callable taking the mgmt system, run by stats()
+    _stats_queries = {}
+
+    # Stat name -> (name of the query in _stats_queries it is computed from,
+    # callable reducing the query result to the stat value)
+    _stats_available = {}
+
+    # Name of the provider in cfme_data, set by provider_factory and
+    # reported on every VmRecord
+    provider_name = None
+
+    # Number of vms whose statuses are fetched together by iter_vm_records
+    record_batch_size = 100
+
+    # Address of the API the client talks to, requests to the same endpoint
+    # share a limit in ConcurrentMgmtSystem
+    endpoint = None
+
+    # Number of past inventory states kept to answer inventory_since tokens
+    inventory_token_history = 10
+
+    _inventory_tokens = None
+    _inventory_state = None
+
+    @property
+    def handle_cache(self):
+        """The :py:class:`HandleCache` of this management system"""
+        try:
+            return self._handle_cache
+        except AttributeError:
+            self._handle_cache = HandleCache(self.handle_cache_ttl, self.handle_cache_size)
+            return self._handle_cache
+
+    def is_session_alive(self):
+        """Checks whether the connection to the mgmt system is still usable
+
+        Used by the provider pool before handing out a pooled client.
+
+        :return: whether the session is alive
+        :rtype: boolean
+
+        """
+        try:
+            self.info()
+            return True
+        except Exception:
+            return False
+
+    def _cached_handle(self, name, lookup):
+        """Returns the handle for name, calling lookup(name) on a cache miss"""
+        handle = self.handle_cache.get(name)
+        if handle is None:
+            handle = lookup(name)
+            self.handle_cache.set(name, handle)
+        return handle
+
     @abstractmethod
     def start_vm(self, vm_name):
         """Starts a vm.
@@ -101,6 +185,49 @@ class MgmtSystemAPIBase(object):
         """
         raise NotImplementedError('list_vm not implemented.')
 
+    def iter_vms(self, **kwargs):
+        """Yields the same vms as list_vm, without building a list first
+
+        Backends with paginated listings override this to fetch one page at a
+        time, so callers can act on the first vms while the rest are listed.
+
+        """
+        return iter(self.list_vm(**kwargs))
+
+    def iter_templates(self, **kwargs):
+        """Yields the same templates as list_template, without building a list first"""
+        return iter(self.list_template(**kwargs))
+
+    def iter_vm_records(self):
+        """Yields a :py:class:`VmRecord` for every vm and template
+
+        Records are compact tuples that don't hold on to any SDK object, so
+        caches can keep a lot of them around. Backends build them from the
+        same bulk queries as their listings; this default fills in the state
+        with one _vm_statuses call per ``record_batch_size`` vms and leaves
+        the ip and host unknown.
+
+        """
+        batch = []
+        for vm_name in self.iter_vms():
+            batch.append(vm_name)
+            if len(batch) == self.record_batch_size:
+                for record in self._vm_records(batch):
+                    yield record
+                batch = []
+        for record in self._vm_records(batch):
+            yield record
+        for template in self.iter_templates():
+            # EC2 lists image objects rather than names
+            template = getattr(template, 'id', template)
+            yield VmRecord(template, None, None, None, None, True, self.provider_name)
+
+    def _vm_records(self, vm_names):
+        statuses = self._vm_statuses(vm_names) if vm_names else {}
+        return [VmRecord(vm_name, None, statuses.get(vm_name), None, None, False,
+                         self.provider_name)
+                for vm_name in vm_names]
+
     @abstractmethod
     def list_template(self):
         """Returns a list of templates/images.
@@ -248,11 +375,350 @@ class MgmtSystemAPIBase(object):
         """
         raise NotImplementedError('get_ip_address not implemented.')
 
+    def wait_for_vm_state(self, vm_name, states, timeout=600):
+        """Blocks until a vm, or every vm in a list, reaches one of the states
+
+        :param vm_name: name of the vm, or a list of names to wait on together
+        :type  vm_name: str or list
+        :param states: one or more generic state names (keys of ``states``,
+                       e.g. 'running') or statuses as returned by vm_status
+        :type  states: str or list
+        :param timeout: number of seconds to wait before giving up
+        :type  timeout: int
+        :return: dict of vm name -> status the vm was found in
+        :rtype: dict
+        :raises: TimedOutError
+
+        """
+        if isinstance(vm_name, basestring):
+            vm_names = [vm_name]
+        else:
+            vm_names = list(vm_name)
+        wanted = self._expand_states(states)
+        reached = self._wait_for_vm_states(vm_names, wanted, timeout)
+        pending = set(vm_names) - set(reached)
+        if pending:
+            raise TimedOutError('Could not wait for %s to reach %s in time' %
+                (', '.join(sorted(pending)), ', '.join(sorted(wanted))))
+        return reached
+
+    def _expand_states(self, states):
+        if isinstance(states, basestring):
+            states = [states]
+        wanted = set()
+        for state in states:
+            wanted.update(self.states.get(state, (state,)))
+        return wanted
+
+    def _wait_for_vm_states(self, vm_names, states, timeout, missing=None):
+        """Returns a dict of vm name -> status for the vms that reached states
+
+        Vms that didn't make it before the timeout are left out of the result.
+        Backends that look the vms up before waiting add those that don't
+        exist to the ``missing`` set, or raise if it isn't given.
+
+        """
+        # Default strategy, poll all pending vms at once backing off
+        # exponentially; backends with a change feed override this
+        start = time.time()
+        delay = self.state_poll_min_delay
+        pending = set(vm_names)
+        reached = {}
+        while True:
+            for name, status in self._vm_statuses(pending).iteritems():
+                if status in states:
+                    reached[name] = status
+                    pending.discard(name)
+            remaining = timeout - (time.time() - start)
+            if not pending or remaining <= 0:
+                return reached
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, self.state_poll_max_delay)
+
+    def _vm_statuses(self, vm_names):
+        """Returns a dict of vm name -> vm_status for the given vms
+
+        Backends override this to fetch all the statuses in one call.
+
+        """
+        return dict((name, self.vm_status(name)) for name in vm_names)
+
+    @staticmethod
+    def _report_missing(vm_names, missing):
+        """Adds vms that don't exist to missing, or raises as _get_vm would without it"""
+        if not vm_names:
+            return
+        if missing is None:
+            raise Exception('Could not find a VM named %s.' % sorted(vm_names)[0])
+        missing.update(vm_names)
+
+    def start_vms(self, vm_names, timeout=600):
+        """Starts several vms, submitting every start before waiting on any
+
+        :param vm_names: names of the vms to be started
+        :type  vm_names: list
+        :param timeout: number of seconds to wait for all of them
+        :type  timeout: int
+        :return: dict of vm name -> whether the vm was started
+        :rtype: dict
+
+        """
+        return self._batch_action(vm_names, self._submit_start, 'running', timeout)
+
+    def stop_vms(self, vm_names, timeout=600):
+        """Stops several vms, submitting every stop before waiting on any
+
+        :param vm_names: names of the vms to be stopped
+        :type  vm_names: list
+        :param timeout: number of seconds to wait for all of them
+        :type  timeout: int
+        :return: dict of vm name -> whether the vm was stopped
+        :rtype: dict
+
+        """
+        return self._batch_action(vm_names, self._submit_stop, 'stopped', timeout)
+
+    def delete_vms(self, vm_names, timeout=600):
+        """Deletes several vms
+
+        Backends that can delete asynchronously submit every delete before
+        waiting on any; the default deletes one vm after the other.
+
+        :param vm_names: names of the vms to be deleted
+        :type  vm_names: list
+        :param timeout: number of seconds to wait for all of them
+        :type  timeout: int
+        :return: dict of vm name -> whether the vm was deleted
+        :rtype: dict
+
+        """
+        results = {}
+        for vm_name in vm_names:
+            try:
+                results[vm_name] = self.delete_vm(vm_name)
+            except Exception:
+                results[vm_name] = False
+        return results
+
+    def _submit_start(self, vm_name):
+        """Initiates a start without waiting for it, blocking by default"""
+        self.start_vm(vm_name)
+
+    def _submit_stop(self, vm_name):
+        """Initiates a stop without waiting for it, blocking by default"""
+        self.stop_vm(vm_name)
+
+    def _batch_action(self, vm_names, submit, state, timeout):
+        results = {}
+        submitted = []
+        for vm_name in vm_names:
+            try:
+                submit(vm_name)
+                submitted.append(vm_name)
+            except Exception:
+                results[vm_name] = False
+        if submitted:
+            reached = self._wait_for_vm_states(submitted, self._expand_states(state), timeout)
+            for vm_name in submitted:
+                results[vm_name] = vm_name in reached
+        return results
+
+    def deploy_templates(self, template, vm_names, timeout=900, **kwargs):
+        """Deploys several vms from a template together, yielding their progress
+
+        Every deploy is submitted before waiting on any and they are all
+        tracked together. Each vm is started as soon as its deploy finishes,
+        and the IP addresses of running vms are resolved in parallel. Events
+        are yielded as they happen, so the first vms can be used while the
+        others are still deploying.
+
+        For each vm the stages are 'deployed', 'running' and 'ready', the last
+        carrying the vm's ip. A 'failed' event with the error replaces the rest
+        of a vm's stages if anything goes wrong or it runs out of time.
+
+        :param template: name of the template to deploy
+        :param vm_names: names of the vms to create
+        :param timeout: seconds to wait for all of them to be ready
+        :return: generator of :py:class:`DeployEvent`
+
+        Other keyword arguments are passed along as for deploy_template.
+
+        """
+        start = time.time()
+        deploying = {}
+        starting = set()
+        resolving = {}
+        for vm_name in vm_names:
+            try:
+                deploying[vm_name] = self._submit_deploy(template, vm_name, **kwargs)
+            except Exception as e:
+                yield DeployEvent(vm_name, 'failed', None, e)
+
+        ip_pool = ThreadPool(max(min(len(vm_names), self.deploy_ip_threads), 1))
+        running_states = self._expand_states('running')
+        try:
+            while deploying or starting or resolving:
+                remaining = timeout - (time.time() - start)
+                if remaining <= 0:
+                    break
+                wait = min(remaining, self.deploy_poll_interval)
+
+                if deploying:
+                    finished = self._finished_deploys(deploying, wait)
+                    for vm_name, error in finished.iteritems():
+                        del deploying[vm_name]
+                        if error is not None:
+                            yield DeployEvent(vm_name, 'failed', None, error)
+                        else:
+                            yield DeployEvent(vm_name, 'deployed', None, None)
+                    deployed = [vm_name for vm_name, error in finished.iteritems()
+                                if error is None]
+                    # Deploys may leave vms running already
+                    statuses = self._vm_statuses(deployed) if deployed else {}
+                    for vm_name in deployed:
+                        if vm_name not in statuses:
+                            yield DeployEvent(vm_name, 'failed', None,
+                                Exception('Could not find a VM named %s.' % vm_name))
+                            continue
+                        try:
+                            if statuses[vm_name] not in running_states:
+                                self._submit_start(vm_name)
+                            starting.add(vm_name)
+                        except Exception as e:
+                            yield DeployEvent(vm_name, 'failed', None, e)
+
+                if starting:
+                    wait = 0 if deploying else wait
+                    missing = set()
+                    running = self._wait_for_vm_states(starting, running_states, wait, missing)
+                    for vm_name in running:
+                        starting.discard(vm_name)
+                        yield DeployEvent(vm_name, 'running', None, None)
+                        resolving[vm_name] = ip_pool.apply_async(
+                            self._resolve_ip, (vm_name, start + timeout - time.time()))
+                    for vm_name in sorted(missing):
+                        # Deleted behind our back while starting
+                        starting.discard(vm_name)
+                        yield DeployEvent(vm_name, 'failed', None,
+                            Exception('Could not find a VM named %s.' % vm_name))
+
+                for vm_name, result in resolving.items():
+                    if result.ready():
+                        del resolving[vm_name]
+                        try:
+                            yield DeployEvent(vm_name, 'ready', result.get(), None)
+                        except Exception as e:
+                            yield DeployEvent(vm_name, 'failed', None, e)
+                if resolving and not (deploying or starting):
+                    time.sleep(min(self.state_poll_min_delay, remaining))
+        finally:
+            ip_pool.close()
+
+        for vm_name in sorted(set(deploying) | starting | set(resolving)):
+            yield DeployEvent(vm_name, 'failed', None,
+                TimedOutError('Could not deploy %s in time' % vm_name))
+
+    def _submit_deploy(self, template, vm_name, **kwargs):
+        """Initiates a deploy without waiting for it, blocking by default
+
+        :return: a handle for _finished_deploys, if the backend needs one
+
+        """
+        self.deploy_template(template, vm_name=vm_name, **kwargs)
+
+    def _finished_deploys(self, handles, timeout):
+        """Waits up to timeout for deploys to finish
+
+        :param handles: dict of vm name -> what _submit_deploy returned
+        :return: dict of vm name -> None, or the error the deploy failed with,
+                 for the deploys that finished
+
+        """
+        states = self._expand_states(['stopped', 'running'])
+        return dict((vm_name, None)
+                    for vm_name in self._wait_for_vm_states(handles.keys(), states, timeout))
+
+    def _resolve_ip(self, vm_name, timeout):
+        """Waits for a freshly started vm to report an ip address"""
+        ip, elapsed = wait_for(lambda: self.get_ip_address(vm_name), num_sec=max(timeout, 0),
+                               fail_condition=None, handle_exception=True,
+                               delay=self.deploy_poll_interval,
+                               message='get the ip address of %s' % vm_name)
+        return ip
+
+    def inventory_since(self, token=None):
+        """Returns what changed in the inventory since ``token`` was handed out
+
+        Objects are identified by ``(kind, name)`` tuples, kind being one of
+        'vm', 'template', 'host' or 'datastore'. A vm whose power state changed
+        is reported as modified. Pass the returned token to the next call to get
+        the changes since this one. Without a token, or with one this client no
+        longer remembers, every object is reported as added and ``full`` is set.
+
+        :param token: token returned by a previous call
+        :type  token: basestring
+        :return: changes since token, and the token to pass next time
+        :rtype: :py:class:`InventoryDelta`
+
+        """
+        if self._inventory_tokens is None:
+            self._inventory_tokens = OrderedDict()
+        previous = self._inventory_tokens.get(token)
+        state = self._inventory_changes(self._inventory_state)
+        self._inventory_state = state
+
+        new_token = uuid.uuid4().hex
+        self._inventory_tokens[new_token] = state
+        while len(self._inventory_tokens) > self.inventory_token_history:
+            self._inventory_tokens.popitem(last=False)
+
+        if previous is None:
+            return InventoryDelta(set(state), set(), set(), new_token, True)
+        added = set(key for key in state if key not in previous)
+        removed = set(key for key in previous if key not in state)
+        modified = set(key for key, value in state.iteritems()
+                       if key in previous and previous[key] != value)
+        return InventoryDelta(added, removed, modified, new_token, False)
+
+    def _inventory_changes(self, previous):
+        """Returns the current inventory state as a dict of (kind, name) -> hash
+
+        Implementors with a way to ask the backend for changes only should
+        override this to update ``previous``. The returned dict is kept as is
+        for later tokens, so ``previous`` itself must not be modified.
+
+        This default hashes a complete rescan of the provider.
+
+        """
+        state = {}
+        for record in self.iter_vm_records():
+            kind = 'template' if record.template else 'vm'
+            state[(kind, record.name)] = hash(record.state)
+        for kind, lister in (('host', 'list_host'), ('datastore', 'list_datastore')):
+            try:
+                names = getattr(self, lister)()
+            except (AttributeError, NotImplementedError):
+                continue
+            for name in names:
+                state[(kind, name)] = hash(None)
+        return state
+
     def stats(self, *requested_stats):
-        '''Returns all available stats, if none are explicitly requested'''
+        '''Returns all available stats, if none are explicitly requested
+
+        Each stat in ``_stats_available`` names the backend query it is computed
+        from in ``_stats_queries``. Every query needed is run once and stats
+        sharing a query are all computed from the same result.
+        '''
 
         requested_stats = requested_stats or self._stats_available
-        return {stat: self._stats_available[stat](self) for stat in requested_stats}
+        queries = set(self._stats_available[stat][0] for stat in requested_stats)
+        results = dict((query, self._stats_queries[query](self)) for query in queries)
+        stats = {}
+        for stat in requested_stats:
+            query, reducer = self._stats_available[stat]
+            stats[stat] = reducer(results[query])
+        return stats
 
 
 class VMWareSystem(MgmtSystemAPIBase):
@@ -267,82 +733,662 @@ class VMWareSystem(MgmtSystemAPIBase):
 
     """
 
+    _stats_queries = {
+        'inventory': lambda self: self.inventory_snapshot(refresh=True).values(),
+        'topology': lambda self: self.topology(refresh=True),
+    }
+
+    # VMs and templates are both counted from one inventory traversal, hosts,
+    # clusters and datastores from one topology
     _stats_available = {
-        'num_vm': lambda self: len(self.list_vm()),
-        'num_host': lambda self: len(self.list_host()),
-        'num_cluster': lambda self: len(self.list_cluster()),
-        'num_template': lambda self: len(self.list_template()),
-        'num_datastore': lambda self: len(self.list_datastore()),
+        'num_vm': ('inventory', lambda vms: len([vm for vm in vms if not vm['template']])),
+        'num_host': ('topology', lambda topology: len(topology.find(kind='host'))),
+        'num_cluster': ('topology', lambda topology: len(topology.find(kind='cluster'))),
+        'num_template': ('inventory', lambda vms: len([vm for vm in vms if vm['template']])),
+        'num_datastore': ('topology', lambda topology: len(topology.find(kind='datastore'))),
+    }
+
+    # VM properties pulled in a single property collector traversal
+    # when building an inventory snapshot
+    _inventory_properties = ['name', 'config.template', 'runtime.powerState',
+                             'runtime.question', 'runtime.host', 'guest.net',
+                             'datastore']
+
+    # Maps vsphere power states to the status strings pysphere reports
+    _power_states = {
+        'poweredOn': 'POWERED ON',
+        'poweredOff': 'POWERED OFF',
+        'suspended': 'SUSPENDED',
+    }
+
+    # Number of seconds an inventory snapshot is used to answer per-vm queries.
+    # 0 fetches a new one for every query, so statuses are always current;
+    # raise it to batch many queries that can live with slightly stale state.
+    inventory_ttl = 0
+
+    # Properties followed by the property collector behind inventory_since
+    _change_properties = {
+        MORTypes.VirtualMachine: ['name', 'config.template', 'runtime.powerState'],
+        MORTypes.HostSystem: ['name'],
+        MORTypes.Datastore: ['name'],
+    }
+
+    _change_collector = None
+
+    # Objects per page of property collector results in iter_vms and iter_templates
+    retrieve_page_size = 500
+
+    # Properties of the placement objects fetched to build a topology, every
+    # type gets name and parent on top of these
+    _topology_properties = {
+        MORTypes.Folder: [],
+        MORTypes.Datacenter: [],
+        MORTypes.ComputeResource: [],
+        MORTypes.HostSystem: ['summary.hardware.memorySize',
+                              'summary.quickStats.overallMemoryUsage'],
+        MORTypes.ResourcePool: ['runtime.memory.unreservedForPool'],
+        MORTypes.Datastore: ['summary.freeSpace'],
+    }
+
+    # Kinds of TopologyNode for each managed object type
+    _topology_kinds = {
+        MORTypes.Folder: 'folder',
+        MORTypes.Datacenter: 'datacenter',
+        MORTypes.ClusterComputeResource: 'cluster',
+        MORTypes.ComputeResource: 'compute_resource',
+        MORTypes.HostSystem: 'host',
+        MORTypes.ResourcePool: 'resource_pool',
+        MORTypes.VirtualApp: 'resource_pool',
+        MORTypes.Datastore: 'datastore',
+    }
+
+    # Number of seconds a topology is used before walking the inventory again
+    topology_ttl = 60
+
+    _topology = None
+    _topology_time = 0
+
+    states = {
+        'running': ('POWERED ON',),
+        'stopped': ('POWERED OFF',),
+        'suspended': ('SUSPENDED',),
     }
 
     def __init__(self, hostname, username, password, **kwargs):
         self.api = VIServer()
         self.api.connect(hostname, username, password)
+        self._inventory = None
+        self._inventory_time = 0
+
+    # Managed object references don't change for the life of a vm
+    handle_cache_ttl = 300
 
     def _get_vm(self, vm_name=None):
         if vm_name is None:
             raise Exception('Could not find a VM named %s.' % vm_name)
         else:
-            try:
-                vm = self.api.get_vm_by_name(vm_name)
-                return vm
-            except VIException as ex:
-                raise Exception(ex)
+            return self._cached_handle(vm_name, self._lookup_vm)
+
+    def _lookup_vm(self, vm_name):
+        try:
+            return self.api.get_vm_by_name(vm_name)
+        except VIException as ex:
+            raise Exception(ex)
 
     def does_vm_exist(self, name):
         try:
-            self._get_vm(name)
+            self._get_vm_properties(name)
             return True
         except Exception:
             return False
 
-    def _get_resource_pool(self, resource_pool_name=None):
-        rps = self.api.get_resource_pools()
-        for mor, path in rps.iteritems():
-            if re.match('.*%s' % resource_pool_name, path):
-                return mor
-        # Just pick the first
-        return rps.keys()[0]
+    def inventory_snapshot(self, refresh=False):
+        """Returns the properties of every vm and template on the system
 
-    def get_ip_address(self, vm_name):
-        vm = self._get_vm(vm_name)
-        maxwait = 600
-        net_info = None
-        waitcount = 0
-        while net_info is None:
-            if waitcount > maxwait:
-                break
-            net_info = vm.get_property('net', False)
-            waitcount += 5
-            time.sleep(5)
-        if net_info:
-            ipv4_re = r'\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}'
-            for ip in net_info[0]['ip_addresses']:
-                if re.match(ipv4_re, ip) and ip != '127.0.0.1':
-                    return ip
-        return None
+        All VMs are fetched with one property collector traversal, plus one
+        name lookup each for hosts and datastores. The snapshot is reused
+        until it is older than ``inventory_ttl`` seconds, or until an action
+        method invalidates it.
 
-    def _get_list_vms(self, get_template=False):
-        template_or_vm_list = []
-
-        props = self.api._retrieve_properties_traversal(property_names=['name', 'config.template'],
-                                                        from_node=None,
-                                                        obj_type=MORTypes.VirtualMachine)
-        for prop in props:
-            vm = None
-            template = None
+        :param refresh: fetch a new snapshot even if the current one is fresh
+        :type  refresh: boolean
+        :return: dict of vm name -> dict of name, power_state, template,
+                 ip_addresses, host and datastores
+        :rtype: dict
+
+        """
+        age = time.time() - self._inventory_time
+        if refresh or self._inventory is None or age > self.inventory_ttl:
+            self._inventory = self._get_inventory()
+            self._inventory_time = time.time()
+        return self._inventory
+
+    def _invalidate_inventory(self):
+        self._inventory = None
+
+    def _get_inventory(self):
+        props = self.api._retrieve_properties_traversal(
+            property_names=self._inventory_properties,
+            from_node=None,
+            obj_type=MORTypes.VirtualMachine)
+        hosts = self.api.get_hosts()
+        datastores = self.api.get_datastores()
+
+        inventory = {}
+        for prop in props or []:
+            vm = {
+                'name': None,
+                'power_state': None,
+                'template': None,
+                'ip_addresses': [],
+                'host': None,
+                'datastores': [],
+            }
             for elem in prop.PropSet:
-                if elem.Name == "name":
-                    vm = elem.Val
-                elif elem.Name == "config.template":
-                    template = elem.Val
-            if vm is None or template is None:
+                if elem.Name == 'name':
+                    vm['name'] = elem.Val
+                elif elem.Name == 'config.template':
+                    vm['template'] = elem.Val
+                elif elem.Name == 'runtime.powerState':
+                    vm['power_state'] = self._power_states.get(elem.Val, 'UNKNOWN')
+                elif elem.Name == 'runtime.question':
+                    vm['question'] = True
+                elif elem.Name == 'runtime.host':
+                    vm['host'] = hosts.get(elem.Val)
+                elif elem.Name == 'guest.net':
+                    vm['ip_addresses'] = self._guest_ip_addresses(elem.Val)
+                elif elem.Name == 'datastore':
+                    for ds in getattr(elem.Val, 'ManagedObjectReference', []):
+                        vm['datastores'].append(datastores.get(ds))
+            if vm['name'] is None or vm['template'] is None:
+                # Inaccessible or half-registered vm, skip it
                 continue
-            if template == bool(get_template):
-                template_or_vm_list.append(vm)
-        return template_or_vm_list
+            if vm.pop('question', False):
+                vm['power_state'] = 'BLOCKED ON MSG'
+            inventory[vm['name']] = vm
+        return inventory
+
+    @staticmethod
+    def _guest_ip_addresses(guest_net):
+        ip_addresses = []
+        for nic in getattr(guest_net, 'GuestNicInfo', []):
+            ip_addresses.extend(getattr(nic, 'IpAddress', []))
+        return ip_addresses
+
+    @staticmethod
+    def _first_ipv4(ip_addresses):
+        ipv4_re = r'\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}'
+        for ip in ip_addresses:
+            if re.match(ipv4_re, ip) and ip != '127.0.0.1':
+                return ip
+
+    def _wait_for_vm_states(self, vm_names, states, timeout, missing=None):
+        # Map the raw powerState values back to vm_status strings on the way
+        def reached(name, value):
+            return self._power_states.get(value, 'UNKNOWN') in states
+        mors = self._vm_mors(vm_names)
+        self._report_missing(set(vm_names) - set(mors), missing)
+        if not mors:
+            return {}
+        result = self._wait_for_updates(mors, MORTypes.VirtualMachine,
+                                        'runtime.powerState', reached, timeout)
+        self._invalidate_inventory()
+        return dict((name, self._power_states.get(value, 'UNKNOWN'))
+                    for name, value in result.iteritems())
+
+    def _vm_mors(self, vm_names):
+        """Returns a dict of vm name -> managed object reference, for the vms that exist
+
+        They are all looked up with one property collector retrieval. Cached
+        handles aren't used, a filter on a vm deleted since would fail.
+
+        """
+        vm_names = set(vm_names)
+        return dict((props['name'], mor) for mor, props
+                    in self._iter_properties({MORTypes.VirtualMachine: ['name']})
+                    if props.get('name') in vm_names)
+
+    def _vm_statuses(self, vm_names):
+        # One traversal covers them all, vms that don't exist are left out
+        inventory = self.inventory_snapshot(refresh=True)
+        return dict((vm_name, inventory[vm_name]['power_state'])
+                    for vm_name in vm_names if vm_name in inventory)
+
+    def _wait_for_tasks(self, tasks, timeout):
+        """Waits for several VITasks to finish, on a single property filter
+
+        :param tasks: dict of key -> VITask
+        :return: dict of key -> final task state, for the tasks that finished
+
+        """
+        def finished(key, state):
+            return state in (VITask.STATE_SUCCESS, VITask.STATE_ERROR)
+        mors = dict((key, task._mor) for key, task in tasks.iteritems())
+        return self._wait_for_updates(mors, MORTypes.Task, 'info.state', finished, timeout)
+
+    def _wait_for_updates(self, mors, obj_type, property_name, condition, timeout):
+        """Waits on property collector updates until condition holds for every object
+
+        A property filter is registered for property_name on all the objects
+        and WaitForUpdatesEx blocks server side until something changes, so
+        there is no polling and one call covers the whole batch. The first
+        call returns the current values.
+
+        Every wait gets a property collector of its own, destroyed along with
+        its filter afterwards, so that waits running in other threads neither
+        cancel its WaitForUpdatesEx nor consume its updates. With a timeout of
+        0, the current values are fetched once without blocking.
+
+        :param mors: dict of key -> managed object reference to watch
+        :param obj_type: managed object type of the references
+        :param condition: callable taking (key, property value)
+        :return: dict of key -> property value that satisfied condition,
+                 objects that didn't before the timeout are left out
+
+        """
+        keys_by_mor = dict((str(mor), key) for key, mor in mors.iteritems())
+        collector = self._create_property_collector()
+        try:
+            property_filter = self._create_property_filter(collector, mors.values(), obj_type,
+                                                           property_name)
+            start = time.time()
+            version = ''
+            polled = False
+            reached = {}
+            while len(reached) < len(mors):
+                remaining = timeout - (time.time() - start)
+                if remaining <= 0 and polled:
+                    break
+                polled = True
+                max_wait = int(min(remaining, 60)) or 1 if remaining > 0 else 0
+                update_set = self._wait_for_updates_ex(collector, version, max_wait)
+                if update_set is None:
+                    # maxWaitSeconds passed without any change
+                    continue
+                version = update_set.Version
+                for filter_update in update_set.FilterSet:
+                    if str(filter_update.Filter) != str(property_filter):
+                        continue
+                    for object_update in filter_update.ObjectSet:
+                        key = keys_by_mor.get(str(object_update.Obj))
+                        if key is None:
+                            continue
+                        for change in getattr(object_update, 'ChangeSet', []):
+                            if change.Name != property_name:
+                                continue
+                            value = getattr(change, 'Val', None)
+                            if condition(key, value):
+                                reached[key] = value
+                            else:
+                                reached.pop(key, None)
+        finally:
+            self._destroy_property_collector(collector)
+        return reached
+
+    def _create_property_collector(self):
+        """Creates a property collector private to the caller"""
+        request = VI.CreatePropertyCollectorRequestMsg()
+        _this = request.new__this(self.api._do_service_content.PropertyCollector)
+        _this.set_attribute_type(MORTypes.PropertyCollector)
+        request.set_element__this(_this)
+        return self.api._proxy.CreatePropertyCollector(request)._returnval
+
+    def _destroy_property_collector(self, collector):
+        """Destroys a property collector from _create_property_collector, and its filters"""
+        request = VI.DestroyPropertyCollectorRequestMsg()
+        _this = request.new__this(collector)
+        _this.set_attribute_type(MORTypes.PropertyCollector)
+        request.set_element__this(_this)
+        self.api._proxy.DestroyPropertyCollector(request)
+
+    def _create_property_filter(self, collector, mors, obj_type, property_name):
+        """Registers a filter for one property of the given objects on a collector"""
+        request = VI.CreateFilterRequestMsg()
+        _this = request.new__this(collector)
+        _this.set_attribute_type(MORTypes.PropertyCollector)
+        request.set_element__this(_this)
+        spec = request.new_spec()
+        prop_set = spec.new_propSet()
+        prop_set.set_element_type(obj_type)
+        prop_set.set_element_pathSet([property_name])
+        spec.set_element_propSet([prop_set])
+        obj_sets = []
+        for mor in mors:
+            obj_set = spec.new_objectSet()
+            obj = obj_set.new_obj(mor)
+            obj.set_attribute_type(obj_type)
+            obj_set.set_element_obj(obj)
+            obj_set.set_element_skip(False)
+            obj_sets.append(obj_set)
+        spec.set_element_objectSet(obj_sets)
+        request.set_element_spec(spec)
+        request.set_element_partialUpdates(False)
+        return self.api._proxy.CreateFilter(request)._returnval
+
+    def _wait_for_updates_ex(self, collector, version, max_wait):
+        """Returns the property collector updates since version, or None if there are none"""
+        request = VI.WaitForUpdatesExRequestMsg()
+        _this = request.new__this(collector)
+        _this.set_attribute_type(MORTypes.PropertyCollector)
+        request.set_element__this(_this)
+        request.set_element_version(version)
+        options = request.new_options()
+        options.set_element_maxWaitSeconds(max_wait)
+        request.set_element_options(options)
+        return self.api._proxy.WaitForUpdatesEx(request)._returnval
+
+    def _inventory_changes(self, previous):
+        # A property filter on every vm, host and datastore stays registered on a
+        # private collector, so asking it for updates since the last version only
+        # returns what changed. The first call returns everything.
+        if self._change_collector is None:
+            self._change_collector = self._create_change_collector()
+            self._change_version = ''
+            self._change_objects = {}
+        changed = False
+        try:
+            while True:
+                update_set = self._wait_for_updates_ex(self._change_collector,
+                                                       self._change_version, 0)
+                if update_set is None:
+                    break
+                changed = True
+                self._change_version = update_set.Version
+                for filter_update in update_set.FilterSet:
+                    for object_update in filter_update.ObjectSet:
+                        self._apply_object_update(object_update)
+                if not getattr(update_set, 'Truncated', False):
+                    break
+        except Exception:
+            # The collector goes away with the session, start over next time
+            self._change_collector = None
+            raise
+        if previous is not None and not changed:
+            return previous
+
+        state = {}
+        for obj_type, props in self._change_objects.itervalues():
+            name = props.get('name')
+            if name is None:
+                continue
+            if obj_type == MORTypes.VirtualMachine:
+                kind = 'template' if props.get('config.template') else 'vm'
+                state[(kind, name)] = hash(props.get('runtime.powerState'))
+            elif obj_type == MORTypes.HostSystem:
+                state[('host', name)] = hash(None)
+            else:
+                state[('datastore', name)] = hash(None)
+        return state
+
+    def _apply_object_update(self, object_update):
+        mor = str(object_update.Obj)
+        if object_update.Kind == 'leave':
+            self._change_objects.pop(mor, None)
+            return
+        obj_type, props = self._change_objects.setdefault(
+            mor, (object_update.Obj.get_attribute_type(), {}))
+        for change in getattr(object_update, 'ChangeSet', []):
+            props[change.Name] = getattr(change, 'Val', None)
+
+    def _create_change_collector(self):
+        """Creates a property collector filtering on everything in _change_properties"""
+        # Its own collector keeps these updates apart from _wait_for_updates
+        collector = self._create_property_collector()
+
+        view = self._create_container_view(self._change_properties.keys())
+        request = VI.CreateFilterRequestMsg()
+        _this = request.new__this(collector)
+        _this.set_attribute_type(MORTypes.PropertyCollector)
+        request.set_element__this(_this)
+        spec = request.new_spec()
+        self._set_view_spec(spec, view, self._change_properties)
+        request.set_element_spec(spec)
+        request.set_element_partialUpdates(True)
+        self.api._proxy.CreateFilter(request)
+        return collector
+
+    def _create_container_view(self, obj_types):
+        """Creates a view of every object of the given types in the inventory"""
+        content = self.api._do_service_content
+        request = VI.CreateContainerViewRequestMsg()
+        _this = request.new__this(content.ViewManager)
+        _this.set_attribute_type(MORTypes.ViewManager)
+        request.set_element__this(_this)
+        container = request.new_container(content.RootFolder)
+        container.set_attribute_type(MORTypes.Folder)
+        request.set_element_container(container)
+        request.set_element_type(obj_types)
+        request.set_element_recursive(True)
+        return self.api._proxy.CreateContainerView(request)._returnval
+
+    def _destroy_view(self, view):
+        request = VI.DestroyViewRequestMsg()
+        _this = request.new__this(view)
+        _this.set_attribute_type(MORTypes.ContainerView)
+        request.set_element__this(_this)
+        self.api._proxy.DestroyView(request)
+
+    def _set_view_spec(self, spec, view, properties):
+        """Fills a PropertyFilterSpec selecting properties of every object in a view
+
+        :param properties: dict of object type -> list of property names
+
+        """
+        prop_sets = []
+        for obj_type, path_set in properties.iteritems():
+            prop_set = spec.new_propSet()
+            prop_set.set_element_type(obj_type)
+            prop_set.set_element_pathSet(path_set)
+            prop_sets.append(prop_set)
+        spec.set_element_propSet(prop_sets)
+        obj_set = spec.new_objectSet()
+        obj = obj_set.new_obj(view)
+        obj.set_attribute_type(MORTypes.ContainerView)
+        obj_set.set_element_obj(obj)
+        obj_set.set_element_skip(True)
+        traverse_view = VI.ns0.TraversalSpec_Def('traverseView').pyclass()
+        traverse_view.set_element_name('traverseView')
+        traverse_view.set_element_type(MORTypes.ContainerView)
+        traverse_view.set_element_path('view')
+        traverse_view.set_element_skip(False)
+        obj_set.set_element_selectSet([traverse_view])
+        spec.set_element_objectSet([obj_set])
+
+    def _iter_properties(self, properties):
+        """Yields (managed object reference, dict of property name -> value) for every object
+
+        Objects are retrieved retrieve_page_size at a time with
+        RetrievePropertiesEx, so memory use doesn't grow with the inventory.
+
+        :param properties: dict of object type -> list of property names
+
+        """
+        collector = self.api._do_service_content.PropertyCollector
+        view = self._create_container_view(properties.keys())
+        token = None
+        try:
+            request = VI.RetrievePropertiesExRequestMsg()
+            _this = request.new__this(collector)
+            _this.set_attribute_type(MORTypes.PropertyCollector)
+            request.set_element__this(_this)
+            spec = request.new_specSet()
+            self._set_view_spec(spec, view, properties)
+            request.set_element_specSet([spec])
+            options = request.new_options()
+            options.set_element_maxObjects(self.retrieve_page_size)
+            request.set_element_options(options)
+            result = self.api._proxy.RetrievePropertiesEx(request)._returnval
+            while result is not None:
+                token = getattr(result, 'Token', None)
+                for obj in getattr(result, 'Objects', []):
+                    yield obj.Obj, dict((prop.Name, getattr(prop, 'Val', None))
+                                        for prop in getattr(obj, 'PropSet', []))
+                if token is None:
+                    break
+                request = VI.ContinueRetrievePropertiesExRequestMsg()
+                _this = request.new__this(collector)
+                _this.set_attribute_type(MORTypes.PropertyCollector)
+                request.set_element__this(_this)
+                request.set_element_token(token)
+                result = self.api._proxy.ContinueRetrievePropertiesEx(request)._returnval
+                token = None
+        finally:
+            if token is not None:
+                # The caller stopped early, let the server drop the remaining pages
+                request = VI.CancelRetrievePropertiesExRequestMsg()
+                _this = request.new__this(collector)
+                _this.set_attribute_type(MORTypes.PropertyCollector)
+                request.set_element__this(_this)
+                request.set_element_token(token)
+                self.api._proxy.CancelRetrievePropertiesEx(request)
+            self._destroy_view(view)
+
+    def iter_vms(self):
+        """Yields the names of the vms, fetching them a page at a time"""
+        for mor, props in self._iter_properties(
+                {MORTypes.VirtualMachine: ['name', 'config.template']}):
+            if props.get('config.template') is False:
+                yield props['name']
+
+    def iter_templates(self):
+        """Yields the names of the templates, fetching them a page at a time"""
+        for mor, props in self._iter_properties(
+                {MORTypes.VirtualMachine: ['name', 'config.template']}):
+            if props.get('config.template') is True:
+                yield props['name']
+
+    def iter_vm_records(self):
+        hosts = self.list_host()
+        properties = ['name', 'config.template', 'runtime.powerState', 'runtime.host',
+                      'guest.ipAddress']
+        for mor, props in self._iter_properties({MORTypes.VirtualMachine: properties}):
+            if props.get('name') is None or props.get('config.template') is None:
+                # Inaccessible or half-registered vm, skip it
+                continue
+            yield VmRecord(
+                props['name'], str(mor),
+                self._power_states.get(props.get('runtime.powerState'), 'UNKNOWN'),
+                props.get('guest.ipAddress'), hosts.get(props.get('runtime.host')),
+                props['config.template'], self.provider_name)
+
+    def _get_vm_properties(self, vm_name):
+        inventory = self.inventory_snapshot()
+        if vm_name not in inventory:
+            # The vm may have been created since the snapshot was taken
+            inventory = self.inventory_snapshot(refresh=True)
+        try:
+            return inventory[vm_name]
+        except KeyError:
+            raise Exception('Could not find a VM named %s.' % vm_name)
+
+    def topology(self, refresh=False):
+        """Returns the placement topology of the system
+
+        Datacenters, folders, clusters, hosts, resource pools and datastores
+        are all fetched in one paged property collector retrieval. The
+        topology is reused until it is older than ``topology_ttl`` seconds.
+
+        :param refresh: walk the inventory again even if the topology is fresh
+        :type  refresh: boolean
+        :return: :py:class:`VMWareTopology`
+
+        """
+        age = time.time() - self._topology_time
+        if refresh or self._topology is None or age > self.topology_ttl:
+            self._topology = self._get_topology()
+            self._topology_time = time.time()
+        return self._topology
+
+    def _get_topology(self):
+        properties = dict((obj_type, ['name', 'parent'] + names)
+                          for obj_type, names in self._topology_properties.iteritems())
+        objects = {}
+        for mor, props in self._iter_properties(properties):
+            objects[str(mor)] = (mor.get_attribute_type(), props)
+
+        paths = {}
+
+        def path(mor):
+            # The root folder isn't in the view, so its children are top level
+            if mor not in objects:
+                return ''
+            if mor not in paths:
+                obj_type, props = objects[mor]
+                paths[mor] = '%s/%s' % (path(str(props.get('parent'))), props.get('name'))
+            return paths[mor]
+
+        nodes = []
+        for mor, (obj_type, props) in objects.iteritems():
+            parent = props.get('parent')
+            parent = str(parent) if parent is not None else None
+            if obj_type == MORTypes.HostSystem:
+                total = props.get('summary.hardware.memorySize')
+                used = props.get('summary.quickStats.overallMemoryUsage')
+                free = total - used * 1024 * 1024 if None not in (total, used) else None
+            elif obj_type in (MORTypes.ResourcePool, MORTypes.VirtualApp):
+                free = props.get('runtime.memory.unreservedForPool')
+            elif obj_type == MORTypes.Datastore:
+                free = props.get('summary.freeSpace')
+            else:
+                free = None
+            nodes.append(TopologyNode(mor, self._topology_kinds.get(obj_type, obj_type),
+                                      props.get('name'), path(mor), parent, free))
+
+        # Clusters have as much free memory as their hosts put together
+        host_free = {}
+        for node in nodes:
+            if node.kind == 'host' and node.free is not None:
+                host_free[node.parent] = host_free.get(node.parent, 0) + node.free
+        nodes = [node._replace(free=host_free.get(node.mor))
+                 if node.kind in ('cluster', 'compute_resource') else node
+                 for node in nodes]
+        return VMWareTopology(nodes)
+
+    def _get_resource_pool(self, resource_pool_name=None):
+        """Returns the resource pool for a name or path, or the least loaded one
+
+        Pools are looked up by their full path first, then by name, and then
+        by matching the end of their path as this used to do.
+
+        """
+        topology = self.topology()
+        if resource_pool_name:
+            node = topology.get(resource_pool_name)
+            if node is None or node.kind != 'resource_pool':
+                pools = topology.named(resource_pool_name, kind='resource_pool')
+                if not pools:
+                    pools = [pool for pool in topology.find(kind='resource_pool')
+                             if re.match('.*%s' % resource_pool_name, pool.path)]
+                node = pools[0] if pools else None
+            if node is not None:
+                return node.mor
+        node = topology.least_loaded('resource_pool')
+        if node is None:
+            raise Exception('Could not find a resource pool.')
+        return node.mor
+
+    def get_ip_address(self, vm_name, timeout=600):
+        ip_addresses = self._get_vm_properties(vm_name)['ip_addresses']
+        if not ip_addresses:
+            # Guest tools haven't reported yet, wait for guest.net to change
+            def reported(name, guest_net):
+                return bool(self._guest_ip_addresses(guest_net))
+            result = self._wait_for_updates({vm_name: self._get_vm(vm_name)._mor},
+                MORTypes.VirtualMachine, 'guest.net', reported, timeout)
+            if vm_name not in result:
+                return None
+            self._invalidate_inventory()
+            ip_addresses = self._guest_ip_addresses(result[vm_name])
+        return self._first_ipv4(ip_addresses)
+
+    def _get_list_vms(self, get_template=False):
+        # Names and template flags are all it takes, which one retrieval has
+        if get_template:
+            return list(self.iter_templates())
+        return list(self.iter_vms())
 
     def start_vm(self, vm_name):
+        self._invalidate_inventory()
         vm = self._get_vm(vm_name)
         if vm.is_powered_on():
             return True
@@ -354,6 +1400,7 @@ class VMWareSystem(MgmtSystemAPIBase):
         return False
 
     def stop_vm(self, vm_name):
+        self._invalidate_inventory()
         vm = self._get_vm(vm_name)
         if vm.is_powered_off():
             return True
@@ -365,11 +1412,22 @@ class VMWareSystem(MgmtSystemAPIBase):
         return False
 
     def delete_vm(self, vm_name):
+        self._invalidate_inventory()
         vm = self._get_vm(vm_name)
 
         if vm.is_powered_on():
             self.stop_vm(vm_name)
 
+        task = self._destroy_task(vm)
+        status = task.wait_for_state([task.STATE_SUCCESS, task.STATE_ERROR])
+        self._invalidate_inventory()
+        self.handle_cache.invalidate(vm_name)
+        if status == task.STATE_SUCCESS:
+            return True
+        else:
+            return False
+
+    def _destroy_task(self, vm):
         # When pysphere moves up to 0.1.8, we can just do:
         # vm.destroy()
         request = VI.Destroy_TaskRequestMsg()
@@ -377,13 +1435,65 @@ class VMWareSystem(MgmtSystemAPIBase):
         _this.set_attribute_type(vm._mor.get_attribute_type())
         request.set_element__this(_this)
         rtn = self.api._proxy.Destroy_Task(request)._returnval
+        return VITask(rtn, self.api)
 
-        task = VITask(rtn, self.api)
-        status = task.wait_for_state([task.STATE_SUCCESS, task.STATE_ERROR])
-        if status == task.STATE_SUCCESS:
-            return True
-        else:
-            return False
+    def start_vms(self, vm_names, timeout=600):
+        inventory = self.inventory_snapshot(refresh=True)
+
+        def submit(vm_name):
+            if inventory[vm_name]['power_state'] != 'POWERED ON':
+                return self._get_vm(vm_name).power_on(sync_run=False)
+        return self._run_vm_tasks(vm_names, submit, timeout)
+
+    def stop_vms(self, vm_names, timeout=600):
+        inventory = self.inventory_snapshot(refresh=True)
+
+        def submit(vm_name):
+            if inventory[vm_name]['power_state'] != 'POWERED OFF':
+                return self._get_vm(vm_name).power_off(sync_run=False)
+        return self._run_vm_tasks(vm_names, submit, timeout)
+
+    def delete_vms(self, vm_names, timeout=600):
+        inventory = self.inventory_snapshot(refresh=True)
+        running = [vm_name for vm_name in vm_names if vm_name in inventory and
+                   inventory[vm_name]['power_state'] == 'POWERED ON']
+        if running:
+            self.stop_vms(running, timeout)
+
+        def submit(vm_name):
+            if vm_name not in inventory:
+                raise Exception('Could not find a VM named %s.' % vm_name)
+            return self._destroy_task(self._get_vm(vm_name))
+        results = self._run_vm_tasks(vm_names, submit, timeout)
+        for vm_name, deleted in results.iteritems():
+            if deleted:
+                self.handle_cache.invalidate(vm_name)
+        return results
+
+    def _run_vm_tasks(self, vm_names, submit, timeout):
+        """Submits a task per vm with submit(vm_name), then waits on all of them
+
+        submit returns a VITask, or None when there is nothing to be done.
+
+        """
+        results = {}
+        tasks = {}
+        for vm_name in vm_names:
+            try:
+                task = submit(vm_name)
+            except Exception:
+                results[vm_name] = False
+                continue
+            if task is None:
+                results[vm_name] = True
+            else:
+                tasks[vm_name] = task
+        if tasks:
+            states = self._wait_for_tasks(tasks, timeout)
+            for vm_name in tasks:
+                results[vm_name] = states.get(vm_name) == VITask.STATE_SUCCESS
+        self._invalidate_inventory()
+        return results
 
     def create_vm(self, vm_name):
         raise NotImplementedError('This function has not yet been implemented.')
@@ -404,22 +1514,40 @@ class VMWareSystem(MgmtSystemAPIBase):
         raise NotImplementedError('This function is not supported on this platform.')
 
     def list_host(self):
-        return self.api.get_hosts()
+        return self._topology_names('host')
 
     def list_datastore(self):
-        return self.api.get_datastores()
+        return self._topology_names('datastore')
 
     def list_cluster(self):
-        return self.api.get_clusters()
+        return self._topology_names('cluster')
+
+    def _topology_names(self, kind):
+        """Returns a dict of managed object reference -> name, like pysphere does
+
+        The list methods always walk the inventory again, only placement
+        lookups reuse a cached topology.
+
+        """
+        return dict((node.mor, node.name)
+                    for node in self.topology(refresh=True).find(kind=kind))
 
     def info(self):
         return '%s %s' % (self.api.get_server_type(), self.api.get_api_version())
 
+    def is_session_alive(self):
+        # info() is answered from the connect-time service content, so ask
+        # the server for its time instead to catch expired sessions
+        try:
+            return self.api.is_connected() and self.api.keep_session_alive()
+        except Exception:
+            return False
+
     def disconnect(self):
         self.api.disconnect()
 
     def vm_status(self, vm_name):
-        state = self._get_vm(vm_name).get_status()
+        state = self._get_vm_properties(vm_name)['power_state']
         print "vm " + vm_name + " status is " + state
         return state
 
@@ -441,11 +1569,33 @@ class VMWareSystem(MgmtSystemAPIBase):
             raise Exception('Could not suspend %s because it\'s not running.' % vm_name)
         else:
             vm.suspend()
+            self._invalidate_inventory()
             return self.is_vm_suspended(vm_name)
 
     def clone_vm(self):
         raise NotImplementedError('clone_vm not implemented.')
 
+    def _submit_start(self, vm_name):
+        self._invalidate_inventory()
+        self._get_vm(vm_name).power_on(sync_run=False)
+
+    def _submit_deploy(self, template, vm_name, **kwargs):
+        task = self._get_vm(template).clone(vm_name, sync_run=False,
+            resourcepool=self._get_resource_pool(kwargs.get('resourcepool')))
+        self.handle_cache.invalidate(vm_name)
+        return task
+
+    def _finished_deploys(self, tasks, timeout):
+        finished = {}
+        for vm_name, state in self._wait_for_tasks(tasks, timeout).iteritems():
+            if state == VITask.STATE_SUCCESS:
+                finished[vm_name] = None
+            else:
+                finished[vm_name] = Exception(tasks[vm_name].get_error_message())
+        if finished:
+            self._invalidate_inventory()
+        return finished
+
     def deploy_template(self, template, *args, **kwargs):
         if 'resourcepool' not in kwargs:
             kwargs['resourcepool'] = None
@@ -453,6 +1603,8 @@ class VMWareSystem(MgmtSystemAPIBase):
         if vm:
             vm.clone(kwargs['vm_name'], sync_run=True,
                 resourcepool=self._get_resource_pool(kwargs['resourcepool']))
+            self._invalidate_inventory()
+            self.handle_cache.invalidate(kwargs['vm_name'])
             return kwargs['vm_name']
         else:
             raise Exception('Could not clone %s' % template)
@@ -494,6 +1646,8 @@ class RHEVMSystem(MgmtSystemAPIBase):
 
      This problem should be attributed to how RHEVM api was designed rather
      than how ovirtsdk handles RHEVM api responses.
+     The list methods here avoid it altogether by compiling their filters
+     to engine side search queries instead.
 
     - Obj. are not updated after action calls.
       - E.G.
@@ -507,14 +1661,44 @@ class RHEVMSystem(MgmtSystemAPIBase):
         vm.status.get_state() # returns 'up'
     """
 
+    _stats_queries = {
+        'vms': lambda self: self.list_vm(),
+        'hosts': lambda self: self.list_host(),
+        'clusters': lambda self: self.list_cluster(),
+        'templates': lambda self: self.list_template(),
+        'datastores': lambda self: self.list_datastore(),
+    }
+
     _stats_available = {
-        'num_vm': lambda self: len(self.list_vm()),
-        'num_host': lambda self: len(self.list_host()),
-        'num_cluster': lambda self: len(self.list_cluster()),
-        'num_template': lambda self: len(self.list_template()),
-        'num_datastore': lambda self: len(self.list_datastore()),
+        'num_vm': ('vms', len),
+        'num_host': ('hosts', len),
+        'num_cluster': ('clusters', len),
+        'num_template': ('templates', len),
+        'num_datastore': ('datastores', len),
+    }
+
+    states = {
+        'running': ('up',),
+        'stopped': ('down',),
+        'suspended': ('suspended',),
     }
 
+    # Number of vm names combined into one search query
+    search_batch_size = 50
+
+    # Number of results fetched per page of a search
+    search_page_size = 100
+
+    # Filters of the list methods compiled to search queries, they are all
+    # keywords of the engine's search dialect. Others are matched client side.
+    _search_filters = {
+        'vms': ('name', 'status', 'cluster', 'template', 'host'),
+        'templates': ('name', 'status', 'cluster'),
+        'hosts': ('name', 'status', 'cluster'),
+    }
+
+    _inventory_event = None
+
     def __init__(self, hostname, username, password, **kwargs):
         # generate URL from hostname
 
@@ -525,15 +1709,28 @@ class RHEVMSystem(MgmtSystemAPIBase):
 
         self.api = API(url=url, username=username, password=password, insecure=True)
 
+    # Brokers go stale after actions (see above), so only vm ids are cached
+    handle_cache_ttl = 300
+
     def _get_vm(self, vm_name=None):
         if vm_name is None:
             raise Exception('Could not find a VM named %s.' % vm_name)
         else:
-            vm = self.api.vms.get(name=vm_name)
+            vm_id = self._cached_handle(vm_name, self._lookup_vm_id)
+            # Fetching by id is a single GET instead of a name search
+            vm = self.api.vms.get(id=vm_id)
             if vm is None:
-                raise Exception('Could not find a VM named %s.' % vm_name)
+                # Deleted or recreated behind our back, look it up again
+                self.handle_cache.invalidate(vm_name)
+                vm = self.api.vms.get(id=self._cached_handle(vm_name, self._lookup_vm_id))
             return vm
 
+    def _lookup_vm_id(self, vm_name):
+        vm = self.api.vms.get(name=vm_name)
+        if vm is None:
+            raise Exception('Could not find a VM named %s.' % vm_name)
+        return vm.id
+
     def get_ip_address(self, vm_name):
         vm = self._get_vm(vm_name)
         return vm.get_guest_info().get_ips().get_ip()[0].get_address()
@@ -570,11 +1767,36 @@ class RHEVMSystem(MgmtSystemAPIBase):
         if vm.status.get_state() == 'up':
             self.stop_vm(vm_name)
         ack = vm.delete()
+        self.handle_cache.invalidate(vm_name)
         if ack == '':
             return True
         else:
             return False
 
+    def _submit_start(self, vm_name):
+        vm = self._get_vm(vm_name)
+        if vm.status.get_state() != 'up':
+            vm.start()
+
+    def _submit_stop(self, vm_name):
+        vm = self._get_vm(vm_name)
+        if vm.status.get_state() != 'down':
+            vm.stop()
+
+    def delete_vms(self, vm_names, timeout=600):
+        statuses = self._vm_statuses(vm_names)
+        running = [vm_name for vm_name, status in statuses.iteritems() if status == 'up']
+        if running:
+            self.stop_vms(running, timeout)
+        results = {}
+        for vm_name in vm_names:
+            try:
+                results[vm_name] = self._get_vm(vm_name).delete() == ''
+                self.handle_cache.invalidate(vm_name)
+            except Exception:
+                results[vm_name] = False
+        return results
+
     def create_vm(self, vm_name):
         raise NotImplementedError('This function has not yet been implemented.')
     # Heres the code but don't have a need and no time to test it to get it right
@@ -616,15 +1838,26 @@ class RHEVMSystem(MgmtSystemAPIBase):
             return self.start_vm(vm_name)
 
     def list_vm(self, **kwargs):
-        # list vm based on kwargs can be buggy
-        # i.e. you can't return a list of powered on vm
-        # but you can return a vm w/ a matched name
-        vm_list = self.api.vms.list(**kwargs)
-        return [vm.name for vm in vm_list]
+        """Returns the names of the vms matching all the given filters
+
+        Filters are name, status, cluster, template and host. Each takes a
+        value or a list of values, any of which may match. Names may contain
+        ``*`` wildcards. ``name_regex`` matches names against a regex.
+
+        Filters are compiled to search queries run on the engine, see
+        :py:meth:`_find`, so only the matching vms are transferred.
+
+        """
+        return list(self.iter_vms(**kwargs))
+
+    def iter_vms(self, **kwargs):
+        """Yields the names of the vms matching the list_vm filters, a page at a time"""
+        for vm in self._find('vms', **kwargs):
+            yield vm.name
 
     def list_host(self, **kwargs):
-        host_list = self.api.hosts.list(**kwargs)
-        return [host.name for host in host_list]
+        """Returns the names of the hosts matching the given name, status and cluster filters"""
+        return [host.name for host in self._find('hosts', **kwargs)]
 
     def list_datastore(self, **kwargs):
         datastore_list = self.api.storagedomains.list(**kwargs)
@@ -637,9 +1870,118 @@ class RHEVMSystem(MgmtSystemAPIBase):
     def list_template(self, **kwargs):
         '''
         CFME ignores the 'Blank' template, so we do too
+
+        Takes the name, status and cluster filters, as list_vm does
         '''
-        template_list = self.api.templates.list(**kwargs)
-        return [template.name for template in template_list if template.name != "Blank"]
+        return list(self.iter_templates(**kwargs))
+
+    def iter_templates(self, **kwargs):
+        """Yields the names of the templates matching the list_template filters"""
+        for template in self._find('templates', **kwargs):
+            if template.name != "Blank":
+                yield template.name
+
+    def iter_vm_records(self):
+        hosts = dict((host.id, host.name) for host in self._find('hosts'))
+        for vm in self._find('vms'):
+            host = vm.get_host()
+            yield VmRecord(vm.name, vm.id, vm.get_status().get_state(), self._guest_ip(vm),
+                           hosts.get(host.get_id()) if host is not None else None, False,
+                           self.provider_name)
+        for template in self._find('templates'):
+            if template.name != "Blank":
+                yield VmRecord(template.name, template.id, template.get_status().get_state(),
+                               None, None, True, self.provider_name)
+
+    @staticmethod
+    def _guest_ip(vm):
+        guest_info = vm.get_guest_info()
+        if guest_info is None or guest_info.get_ips() is None:
+            return None
+        ips = guest_info.get_ips().get_ip()
+        return ips[0].get_address() if ips else None
+
+    def _find(self, collection, name_regex=None, **filters):
+        """Yields the objects of a collection matching all the given filters
+
+        Every combination of the values of list filters gets its own query,
+        values within a query are and-ed, so queries never depend on operator
+        precedence. A ``name_regex`` can't be expressed in the search dialect;
+        its literal prefix, if anchored, narrows the query and the regex itself
+        is matched here, as are filters the search dialect doesn't have.
+
+        """
+        # Filters the search dialect doesn't have are matched here, against
+        # the objects' attributes, as ovirtsdk's list(**kwargs) used to
+        local = dict((key, filters.pop(key)) for key in list(filters)
+                     if key not in self._search_filters[collection])
+        if name_regex is not None and filters.get('name') is None and '|' not in name_regex:
+            prefix = re.match(r'\^([\w-]+)(?![*+?{])', name_regex)
+            if prefix:
+                filters['name'] = prefix.group(1) + '*'
+
+        combinations = [[]]
+        for key, values in sorted(filters.iteritems()):
+            if values is None:
+                continue
+            if isinstance(values, basestring):
+                values = [values]
+            combinations = [terms + ['%s=%s' % (key, self._search_value(value))]
+                            for terms in combinations for value in values]
+        seen = set()
+        for terms in combinations:
+            query = ' and '.join(terms) or None
+            for obj in self._search(collection, query):
+                if obj.id in seen:
+                    continue
+                seen.add(obj.id)
+                if name_regex is not None and not re.match(name_regex, obj.name):
+                    continue
+                if all(self._attribute_matches(obj, key, values)
+                       for key, values in local.iteritems()):
+                    yield obj
+
+    @staticmethod
+    def _attribute_matches(obj, key, values):
+        """Whether an attribute of obj matches a value, or any of a list of values
+
+        Strings are matched as regexes, as ovirtsdk does, anything else by equality.
+
+        """
+        if isinstance(values, basestring) or not isinstance(values, (list, tuple, set)):
+            values = [values]
+        attribute = getattr(obj, key, None)
+        for value in values:
+            if isinstance(value, basestring) and isinstance(attribute, basestring):
+                if re.match(value, attribute):
+                    return True
+            elif attribute == value:
+                return True
+        return False
+
+    # Words of the search syntax, which values are quoted not to be taken for
+    _search_keywords = set(['and', 'or', 'page', 'sortby', 'asc', 'desc'])
+
+    @classmethod
+    def _search_value(cls, value):
+        value = str(value)
+        if re.search(r'[\s"]', value) or value.lower() in cls._search_keywords:
+            return '"%s"' % value.replace('"', '\\"')
+        return value
+
+    def _search(self, collection, query=None):
+        """Yields the results of a search query, fetching one page at a time"""
+        page = 1
+        while True:
+            # Paging needs a query, and every object has a name
+            paged_query = '%s page %d' % (query or 'name=*', page)
+            results = getattr(self.api, collection).list(query=paged_query,
+                                                         max=self.search_page_size)
+            for obj in results:
+                yield obj
+            if len(results) < self.search_page_size:
+                break
+            page += 1
 
     def list_flavor(self):
         raise NotImplementedError('This function is not supported on this platform.')
@@ -648,6 +1990,12 @@ class RHEVMSystem(MgmtSystemAPIBase):
         # and we got nothing!
         pass
 
+    def is_session_alive(self):
+        try:
+            return self.api.test()
+        except Exception:
+            return False
+
     def disconnect(self):
         self.api.disconnect()
 
@@ -679,17 +2027,148 @@ class RHEVMSystem(MgmtSystemAPIBase):
         raise NotImplementedError('This function has not yet been implemented.')
 
     def deploy_template(self, template, *args, **kwargs):
-        self.api.vms.add(params.VM(
-            name=kwargs['vm_name'],
-            cluster=self.api.clusters.get(kwargs['cluster_name']),
-            template=self.api.templates.get(template)))
-        while self.api.vms.get(kwargs['vm_name']).status.state != 'down':
-            time.sleep(5)
+        timeout = kwargs.pop('timeout', 900)
+        self._submit_deploy(template, **kwargs)
+        self.wait_for_vm_state(kwargs['vm_name'], 'stopped', timeout)
         self.start_vm(kwargs['vm_name'])
-        while not self.is_vm_running(kwargs['vm_name']):
-            time.sleep(5)
+        self.wait_for_vm_state(kwargs['vm_name'], 'running', timeout)
         return kwargs['vm_name']
 
+    def _submit_deploy(self, template, vm_name, cluster_name, **kwargs):
+        self.handle_cache.invalidate(vm_name)
+        self.api.vms.add(params.VM(
+            name=vm_name,
+            cluster=self.api.clusters.get(cluster_name),
+            template=self.api.templates.get(template)))
+
+    def _vm_statuses(self, vm_names):
+        return dict((name, vm.get_status().get_state())
+                    for name, vm in self._search_vms(vm_names).iteritems())
+
+    def _search_vms(self, vm_names):
+        """Returns a dict of vm name -> vm for the vms that exist, in one search per batch"""
+        vm_names = list(vm_names)
+        vms = {}
+        for i in range(0, len(vm_names), self.search_batch_size):
+            batch = vm_names[i:i + self.search_batch_size]
+            query = ' or '.join('name=%s' % self._search_value(name) for name in batch)
+            for vm in self.api.vms.list(query=query):
+                # A * in a name is still a wildcard, drop whatever else it matched
+                if vm.name in batch:
+                    vms[vm.name] = vm
+        return vms
+
+    def _inventory_changes(self, previous):
+        # The engine's event feed tells which objects changed since the last
+        # call and only those are read again. The first call lists everything.
+        if previous is None or self._inventory_event is None:
+            self._inventory_event = self._latest_event_id()
+            state = {}
+            for kind in ('vm', 'template', 'host', 'datastore'):
+                self._rescan_inventory(state, kind)
+            return state
+        events, self._inventory_event = self._events_since(self._inventory_event)
+        if not events:
+            return previous
+
+        vm_ids = set()
+        kinds = set()
+        for event in events:
+            if event.get_vm() is not None:
+                vm_ids.add(event.get_vm().get_id())
+            if event.get_template() is not None:
+                kinds.add('template')
+            if event.get_host() is not None:
+                kinds.add('host')
+            if event.get_storage_domain() is not None:
+                kinds.add('datastore')
+        if len(vm_ids) > self.search_batch_size:
+            # Cheaper to list them all again than to get each one
+            kinds.add('vm')
+            vm_ids = set()
+
+        state = dict(previous)
+        for vm_id in vm_ids:
+            state.pop(self._inventory_vm_ids.pop(vm_id, None), None)
+            vm = self.api.vms.get(id=vm_id)
+            if vm is not None:
+                self._inventory_vm_ids[vm_id] = ('vm', vm.name)
+                state[('vm', vm.name)] = hash(vm.get_status().get_state())
+        for kind in kinds:
+            self._rescan_inventory(state, kind)
+        return state
+
+    def _rescan_inventory(self, state, kind):
+        """Replaces every object of the given kind in state with a fresh listing"""
+        for key in [key for key in state if key[0] == kind]:
+            del state[key]
+        if kind == 'vm':
+            self._inventory_vm_ids = {}
+            for vm in self.api.vms.list():
+                self._inventory_vm_ids[vm.id] = ('vm', vm.name)
+                state[('vm', vm.name)] = hash(vm.get_status().get_state())
+            return
+        listers = {
+            'template': self.list_template,
+            'host': self.list_host,
+            'datastore': self.list_datastore,
+        }
+        for name in listers[kind]():
+            state[(kind, name)] = hash(None)
+
+    def _latest_event_id(self):
+        # An empty feed has nothing before event 0
+        events = self.api.events.list(max=1)
+        return events[0].get_id() if events else '0'
+
+    def _events_since(self, event_id):
+        """Returns the events after event_id, a page at a time, and the latest event's id"""
+        events = []
+        while True:
+            page = self.api.events.list(from_event_id=event_id, max=self.search_page_size)
+            events.extend(page)
+            if page:
+                event_id = max(page, key=lambda e: int(e.get_id())).get_id()
+            if len(page) < self.search_page_size:
+                return events, event_id
+
+    def _wait_for_vm_states(self, vm_names, states, timeout, missing=None):
+        # Follow the engine's event feed and only re-read vm statuses
+        # when an event mentions one of the vms still pending
+        start = time.time()
+        delay = self.state_poll_min_delay
+        last_event = self._latest_event_id()
+        pending = set(vm_names)
+        ids = {}
+        reached = {}
+        changed = set(pending)
+        while True:
+            if changed:
+                vms = self._search_vms(changed)
+                gone = changed - set(vms)
+                pending.difference_update(gone)
+                self._report_missing(gone, missing)
+                for name, vm in vms.iteritems():
+                    ids[vm.id] = name
+                    status = vm.get_status().get_state()
+                    if status in states:
+                        reached[name] = status
+                        pending.discard(name)
+            remaining = timeout - (time.time() - start)
+            if not pending or remaining <= 0:
+                return reached
+            time.sleep(min(delay, remaining))
+            events, last_event = self._events_since(last_event)
+            changed = set()
+            for event in events:
+                vm = event.get_vm()
+                if vm is not None and ids.get(vm.get_id()) in pending:
+                    changed.add(ids[vm.get_id()])
+            if events:
+                delay = self.state_poll_min_delay
+            else:
+                delay = min(delay * 2, self.state_poll_max_delay)
+
 
 class EC2System(MgmtSystemAPIBase):
     """EC2 Management System, powered by boto
@@ -708,9 +2187,14 @@ class EC2System(MgmtSystemAPIBase):
 
     """
 
+    _stats_queries = {
+        'vms': lambda self: self.list_vm(),
+        'templates': lambda self: self.list_template(),
+    }
+
     _stats_available = {
-        'num_vm': lambda self: len(self.list_vm()),
-        'num_template': lambda self: len(self.list_template()),
+        'num_vm': ('vms', len),
+        'num_template': ('templates', len),
     }
 
     states = {
@@ -722,12 +2206,31 @@ class EC2System(MgmtSystemAPIBase):
 
     can_suspend = False
 
+    # Instances in these states are re-described on every incremental refresh
+    _transitional_states = ['pending', 'stopping', 'shutting-down']
+
+    # Seconds before the instance index is rebuilt from scratch
+    index_ttl = 300
+
+    # Seconds between incremental refreshes of the instance index
+    index_refresh_interval = 10
+
+    # Reservations fetched per describe call while building the index
+    describe_page_size = 1000
+
+    _instances_by_id = None
+    _instance_ids_by_name = None
+    _index_time = 0
+    _index_refresh_time = 0
+    _index_lock_guard = threading.Lock()
+
     def __init__(self, **kwargs):
         username = kwargs.get('username')
         password = kwargs.get('password')
 
         region = get_region(kwargs.get('region'))
         self.api = EC2Connection(username, password, region=region)
+        self.endpoint = self.api.host
 
     def disconnect(self):
         """Disconnect from the EC2 API -- NOOP
@@ -752,6 +2255,32 @@ class EC2System(MgmtSystemAPIBase):
         combined_images = list(set(private_images) | set(shared_images))
         return combined_images
 
+    def iter_vms(self):
+        """Yields instance IDs a page of reservations at a time, bypassing the index"""
+        for instance in self._describe_instances():
+            yield instance.id
+
+    def iter_vm_records(self):
+        # Instance IDs are the names here, see the class docstring
+        for instance in self._describe_instances():
+            yield VmRecord(instance.id, instance.id, instance.state, instance.ip_address,
+                           instance.placement, False, self.provider_name)
+        for image in self.iter_templates():
+            yield VmRecord(image.id, image.id, image.state, None, None, True,
+                           self.provider_name)
+
+    def iter_templates(self):
+        """Yields the private images, then the shared ones"""
+        # DescribeImages isn't paginated, but the shared images are
+        # only fetched once the private ones have been consumed
+        seen = set()
+        for owner_filter in ({'owners': ['self']}, {'executable_by': ['self']}):
+            for image in self.api.get_all_images(filters={'image-type': 'machine'},
+                                                 **owner_filter):
+                if image.id not in seen:
+                    seen.add(image.id)
+                    yield image
+
     def list_flavor(self):
         raise NotImplementedError('This function is not supported on this platform.')
 
@@ -769,11 +2298,9 @@ class EC2System(MgmtSystemAPIBase):
 
         """
         instance_id = self._get_instance_id_by_name(instance_id)
-        reservations = self.api.get_all_instances([instance_id])
-        instances = self._get_instances_from_reservations(reservations)
-        for instance in instances:
-            if instance.id == instance_id:
-                return instance.state
+        instance = self._describe_instance(instance_id)
+        if instance is not None:
+            return instance.state
 
     def create_vm(self):
         raise NotImplementedError('create_vm not implemented.')
@@ -790,6 +2317,7 @@ class EC2System(MgmtSystemAPIBase):
         instance_id = self._get_instance_id_by_name(instance_id)
         try:
             self.api.terminate_instances([instance_id])
+            self._mark_changed([instance_id])
             self._block_until(instance_id, self.states['deleted'])
             return True
         except ActionTimedOutError:
@@ -807,6 +2335,7 @@ class EC2System(MgmtSystemAPIBase):
         instance_id = self._get_instance_id_by_name(instance_id)
         try:
             self.api.start_instances([instance_id])
+            self._mark_changed([instance_id])
             self._block_until(instance_id, self.states['running'])
             return True
         except ActionTimedOutError:
@@ -824,11 +2353,76 @@ class EC2System(MgmtSystemAPIBase):
         instance_id = self._get_instance_id_by_name(instance_id)
         try:
             self.api.stop_instances([instance_id])
+            self._mark_changed([instance_id])
             self._block_until(instance_id, self.states['stopped'])
             return True
         except ActionTimedOutError:
             return False
 
+    def start_vms(self, instance_ids, timeout=600):
+        """Start several instances with a single API call
+
+        :param  instance_ids: IDs or names of the instances to act on
+        :type   instance_ids: list
+        :return: Instance ID or name -> whether the instance was started
+        :rtype:  dict
+
+        """
+        return self._batch_instance_action(instance_ids, self.api.start_instances,
+                                           self.states['running'], timeout)
+
+    def stop_vms(self, instance_ids, timeout=600):
+        """Stop several instances with a single API call
+
+        :param  instance_ids: IDs or names of the instances to act on
+        :type   instance_ids: list
+        :return: Instance ID or name -> whether the instance was stopped
+        :rtype:  dict
+
+        """
+        return self._batch_instance_action(instance_ids, self.api.stop_instances,
+                                           self.states['stopped'], timeout)
+
+    def delete_vms(self, instance_ids, timeout=600):
+        """Terminate several instances with a single API call
+
+        :param  instance_ids: IDs or names of the instances to act on
+        :type   instance_ids: list
+        :return: Instance ID or name -> whether the instance was terminated
+        :rtype:  dict
+
+        """
+        return self._batch_instance_action(instance_ids, self.api.terminate_instances,
+                                           self.states['deleted'], timeout)
+
+    def _batch_instance_action(self, instance_names, action, expected, timeout):
+        results = {}
+        ids = {}
+        for instance_name in instance_names:
+            try:
+                ids[instance_name] = self._get_instance_id_by_name(instance_name)
+            except Exception:
+                results[instance_name] = False
+        if not ids:
+            return results
+        try:
+            action(ids.values())
+        except EC2ResponseError:
+            # EC2 rejects the whole batch when any one instance can't take the
+            # action, so find out which by acting on them one at a time
+            for instance_name, instance_id in ids.items():
+                try:
+                    action([instance_id])
+                except EC2ResponseError:
+                    results[instance_name] = False
+                    del ids[instance_name]
+        if ids:
+            self._mark_changed(ids.values())
+            reached = self._wait_for_vm_states(ids.values(), set(expected), timeout)
+            for instance_name, instance_id in ids.iteritems():
+                results[instance_name] = instance_id in reached
+        return results
+
     def restart_vm(self, instance_id):
         """Restart an instance
 
@@ -913,21 +2507,53 @@ class EC2System(MgmtSystemAPIBase):
             'min_count': 1,
             'max_count': 1,
         })
-        reservation = self.api.run_instances(template, *args, **kwargs)
-        instances = self._get_instances_from_reservations([reservation])
+        timeout = kwargs.pop('timeout', 900)
+        instances = [self._run_instance(template, *args, **kwargs)]
         # Should have only made one VM; return its ID for use in other methods
-        while not self.is_vm_running(instances[0].id):
-            time.sleep(5)
+        self.wait_for_vm_state(instances[0].id, 'running', timeout)
         return instances[0].id
 
+    def _run_instance(self, template, *args, **kwargs):
+        reservation = self.api.run_instances(template, *args, **kwargs)
+        instance = self._get_instances_from_reservations([reservation])[0]
+        self._index_instance(instance)
+        return instance
+
+    def _submit_deploy(self, template, vm_name, **kwargs):
+        # Instances are named by their Name tag, see _get_instance_id_by_name
+        kwargs.update({
+            'min_count': 1,
+            'max_count': 1,
+        })
+        instance = self._run_instance(template, **kwargs)
+        self.api.create_tags([instance.id], {'Name': vm_name})
+        instance.tags['Name'] = vm_name
+        self._index_instance(instance)
+
     def _get_instance_by_id(self, instance_id):
-        inst_list = self._get_all_instances()
-        for instance in inst_list:
+        """Returns the indexed instance with the given ID, or None if EC2 doesn't know it"""
+        with self._index_lock:
+            self._refresh_index()
+            instance = self._instances_by_id.get(instance_id)
+        if instance is None:
+            instance = self._describe_instance(instance_id)
+        return instance
+
+    def _describe_instance(self, instance_id):
+        """Fetches a fresh copy of a single instance and updates the index with it"""
+        try:
+            instances = list(self._describe_instances(instance_ids=[instance_id]))
+        except EC2ResponseError:
+            # EC2 refuses to describe IDs it has never seen
+            return None
+        for instance in instances:
+            self._index_instance(instance)
             if instance.id == instance_id:
                 return instance
 
     def get_ip_address(self, id):
-        return str(self._get_instance_by_id(id).ip_address)
+        instance_id = self._get_instance_id_by_name(id)
+        return str(self._describe_instance(instance_id).ip_address)
 
     def _get_instance_id_by_name(self, instance_name):
         # Quick validation that the instance name isn't actually an ID
@@ -937,28 +2563,31 @@ class EC2System(MgmtSystemAPIBase):
             # This is already an instance id, return it!
             return instance_name
 
-        # Filter by the 'Name' tag
-        filters = {
-            'tag:Name': instance_name,
-        }
-        reservations = self.api.get_all_instances(filters=filters)
-        instances = self._get_instances_from_reservations(reservations)
-        if not instances:
+        with self._index_lock:
+            self._refresh_index()
+            instance_ids = set(self._instance_ids_by_name.get(instance_name, ()))
+        if not instance_ids:
+            # Tagged since the index was built, ask EC2 for just this name
+            for instance in self._describe_instances(filters={'tag:Name': instance_name}):
+                self._index_instance(instance)
+            with self._index_lock:
+                instance_ids = set(self._instance_ids_by_name.get(instance_name, ()))
+        if not instance_ids:
             raise Exception('Instance with name "%s" not found.' % instance_name)
-        elif len(instances) > 1:
+        elif len(instance_ids) > 1:
             raise MultipleInstancesError('Instance name "%s" is not unique' % instance_name)
         else:
             # We have an instance! return its ID
-            return instances[0].id
+            return list(instance_ids)[0]
 
     def does_vm_exist(self, name):
         try:
-            self._get_instance_id_by_name(name)
-            return True
+            instance_id = self._get_instance_id_by_name(name)
         except MultipleInstancesError:
             return True
         except Exception:
-            return True
+            return False
+        return self._get_instance_by_id(instance_id) is not None
 
     def _get_instances_from_reservations(self, reservations):
         """Takes a sequence of reservations and returns their instances"""
@@ -970,11 +2599,117 @@ class EC2System(MgmtSystemAPIBase):
 
     def _get_all_instances(self):
         """Gets all instances that EC2 can see"""
-        reservations = self.api.get_all_instances()
-        instances = self._get_instances_from_reservations(reservations)
-        return instances
+        with self._index_lock:
+            self._refresh_index()
+            return self._instances_by_id.values()
+
+    def _describe_instances(self, instance_ids=None, filters=None):
+        """Yields the instances matching the given IDs and filters, a page at a time
+
+        EC2 won't page a describe call that names its instances, so those are
+        fetched in a single call. An empty list of IDs matches no instances, rather
+        than every instance as boto would make of it.
+
+        """
+        if instance_ids is not None and not instance_ids:
+            return
+        kwargs = {'instance_ids': instance_ids, 'filters': filters}
+        if instance_ids is None:
+            kwargs['max_results'] = self.describe_page_size
+        while True:
+            reservations = self.api.get_all_reservations(**kwargs)
+            for instance in self._get_instances_from_reservations(reservations):
+                yield instance
+            next_token = getattr(reservations, 'next_token', None)
+            if not next_token:
+                break
+            kwargs['next_token'] = next_token
+
+    def _refresh_index(self, full=False):
+        """Brings the name and ID index of instances up to date
+
+        The index is rebuilt from a single paginated describe call when it is older than
+        ``index_ttl``. In between, only the instances in a transitional state and those
+        acted upon since the last refresh are described again.
+
+        The index is shared by every thread using this client, it is only read
+        or changed under ``_index_lock``. Refreshing holds the lock throughout, so
+        threads needing a refresh at the same time wait for a single one.
+
+        """
+        with self._index_lock:
+            now = time.time()
+            if full or self._instances_by_id is None or now - self._index_time > self.index_ttl:
+                self._rebuild_index()
+            elif now - self._index_refresh_time > self.index_refresh_interval:
+                changed_ids = self._changed_ids | set(
+                    instance.id for instance in self._instances_by_id.itervalues()
+                    if instance.state in self._transitional_states)
+                changed = list(self._describe_instances(
+                    filters={'instance-state-name': self._transitional_states}))
+                if changed_ids:
+                    try:
+                        changed.extend(self._describe_instances(instance_ids=list(changed_ids)))
+                    except EC2ResponseError:
+                        # Some of them have expired out of EC2 completely
+                        self._rebuild_index()
+                        return
+                for instance in changed:
+                    self._index_instance(instance)
+                self._changed_ids.clear()
+                self._index_refresh_time = now
+
+    @property
+    def _index_lock(self):
+        lock = self.__dict__.get('_index_rlock')
+        if lock is None:
+            with self._index_lock_guard:
+                lock = self.__dict__.setdefault('_index_rlock', threading.RLock())
+        return lock
+
+    def _rebuild_index(self):
+        with self._index_lock:
+            self._instances_by_id = {}
+            self._instance_ids_by_name = {}
+            self._changed_ids = set()
+            for instance in self._describe_instances():
+                self._index_instance(instance)
+            self._index_time = self._index_refresh_time = time.time()
+
+    def _index_instance(self, instance):
+        with self._index_lock:
+            if self._instances_by_id is None:
+                # Nothing to update until the index is first needed
+                return
+            previous = self._instances_by_id.get(instance.id)
+            if previous is not None:
+                previous_name = previous.tags.get('Name')
+                if previous_name in self._instance_ids_by_name:
+                    self._instance_ids_by_name[previous_name].discard(instance.id)
+                    if not self._instance_ids_by_name[previous_name]:
+                        del self._instance_ids_by_name[previous_name]
+            self._instances_by_id[instance.id] = instance
+            name = instance.tags.get('Name')
+            if name:
+                self._instance_ids_by_name.setdefault(name, set()).add(instance.id)
+
+    def _mark_changed(self, instance_ids):
+        with self._index_lock:
+            if self._instances_by_id is not None:
+                self._changed_ids.update(instance_ids)
+
+    def _vm_statuses(self, instance_names):
+        if not instance_names:
+            return {}
+        # One describe call covers every instance being waited on
+        ids = dict((self._get_instance_id_by_name(name), name) for name in instance_names)
+        statuses = {}
+        for instance in self._describe_instances(instance_ids=ids.keys()):
+            self._index_instance(instance)
+            if instance.id in ids:
+                statuses[ids[instance.id]] = instance.state
+        return statuses
 
-    # Prime candidate for a wait_for
     def _block_until(self, instance_id, expected, timeout=90):
         """Blocks until the given instance is in one of the expected states
 
@@ -982,11 +2717,12 @@ class EC2System(MgmtSystemAPIBase):
         (probably a bad idea). The timeout has a sane default.
 
         """
-        start = time.time()
-        while self.vm_status(instance_id) not in expected:
-            if timeout is not None and time.time() - start > timeout:
-                raise ActionTimedOutError
-            time.sleep(3)
+        if timeout is None:
+            timeout = float('inf')
+        try:
+            self.wait_for_vm_state(instance_id, expected, timeout)
+        except TimedOutError:
+            raise ActionTimedOutError
 
 
 class OpenstackSystem(MgmtSystemAPIBase):
@@ -996,9 +2732,14 @@ class OpenstackSystem(MgmtSystemAPIBase):
 
     """
 
+    _stats_queries = {
+        'vms': lambda self: self.list_vm(),
+        'templates': lambda self: self.list_template(),
+    }
+
     _stats_available = {
-        'num_vm': lambda self: len(self.list_vm()),
-        'num_template': lambda self: len(self.list_template()),
+        'num_vm': ('vms', len),
+        'num_template': ('templates', len),
     }
 
     states = {
@@ -1009,12 +2750,18 @@ class OpenstackSystem(MgmtSystemAPIBase):
 
     can_suspend = True
 
+    # Servers fetched per page by iter_vms
+    list_page_size = 100
+
+    _floating_ip_pools = None
+
     def __init__(self, **kwargs):
         tenant = kwargs['tenant']
         username = kwargs['username']
         password = kwargs['password']
         auth_url = kwargs['auth_url']
         self.api = osclient.Client(username, password, tenant, auth_url, service_type="compute")
+        self.endpoint = auth_url
 
     def start_vm(self, instance_name):
         if self.is_vm_running(instance_name):
@@ -1022,7 +2769,7 @@ class OpenstackSystem(MgmtSystemAPIBase):
 
         instance = self._find_instance_by_name(instance_name)
         instance.start()
-        wait_for(self.is_vm_running, [instance_name])
+        self.wait_for_vm_state(instance_name, 'running', 120)
         return True
 
     def stop_vm(self, instance_name):
@@ -1031,7 +2778,7 @@ class OpenstackSystem(MgmtSystemAPIBase):
 
         instance = self._find_instance_by_name(instance_name)
         instance.stop()
-        wait_for(self.is_vm_stopped, [instance_name])
+        self.wait_for_vm_state(instance_name, 'stopped', 120)
         return True
 
     def create_vm(self):
@@ -1040,8 +2787,42 @@ class OpenstackSystem(MgmtSystemAPIBase):
     def delete_vm(self, instance_name):
         instance = self._find_instance_by_name(instance_name)
         instance.delete()
+        self.handle_cache.invalidate(instance_name)
         return self.does_vm_exist(instance_name)
 
+    def _submit_start(self, instance_name):
+        instance = self._find_instance_by_name(instance_name)
+        if instance.status not in self.states['running']:
+            instance.start()
+
+    def _submit_stop(self, instance_name):
+        instance = self._find_instance_by_name(instance_name)
+        if instance.status not in self.states['stopped']:
+            instance.stop()
+
+    def delete_vms(self, instance_names, timeout=600):
+        results = {}
+        deleted = set()
+        for instance_name in instance_names:
+            try:
+                self._find_instance_by_name(instance_name).delete()
+                self.handle_cache.invalidate(instance_name)
+                deleted.add(instance_name)
+            except Exception:
+                results[instance_name] = False
+
+        # One listing per poll tells which of the instances are still around
+        def gone():
+            return not deleted & set(instance.name for instance in self._get_all_instances())
+        try:
+            wait_for(gone, num_sec=timeout, delay=5)
+        except TimedOutError:
+            pass
+        remaining = set(instance.name for instance in self._get_all_instances())
+        for instance_name in deleted:
+            results[instance_name] = instance_name not in remaining
+        return results
+
     def restart_vm(self, instance_name):
         return self.stop_vm(instance_name) and self.start_vm(instance_name)
 
@@ -1094,7 +2875,7 @@ class OpenstackSystem(MgmtSystemAPIBase):
 
         instance = self._find_instance_by_name(instance_name)
         instance.suspend()
-        wait_for(self.is_vm_suspended, [instance_name])
+        self.wait_for_vm_state(instance_name, 'suspended', 120)
 
     def resume_vm(self, instance_name):
         if self.is_vm_running(instance_name):
@@ -1102,7 +2883,7 @@ class OpenstackSystem(MgmtSystemAPIBase):
 
         instance = self._find_instance_by_name(instance_name)
         instance.resume()
-        wait_for(self.is_vm_running, [instance_name])
+        self.wait_for_vm_state(instance_name, 'running', 120)
 
     def clone_vm(self, source_name, vm_name):
         raise NotImplementedError('clone_vm not implemented.')
@@ -1121,10 +2902,8 @@ class OpenstackSystem(MgmtSystemAPIBase):
         if 'vm_name' not in kwargs:
             kwargs['vm_name'] = 'new_instance_name'
 
-        image = self.api.images.find(name=template)
-        flavour = self.api.flavors.find(name=kwargs['flavour_name'])
-        instance = self.api.servers.create(kwargs['vm_name'], image, flavour, *args, **kwargs)
-        wait_for(self.is_vm_running, [kwargs['vm_name']])
+        instance = self._create_instance(template, *args, **kwargs)
+        self.wait_for_vm_state(kwargs['vm_name'], 'running', 120)
 
         if 'assign_floating_ip' in kwargs and kwargs['assign_floating_ip'] is not None:
                 ip = self.api.floating_ips.create(kwargs['assign_floating_ip'])
@@ -1132,12 +2911,39 @@ class OpenstackSystem(MgmtSystemAPIBase):
 
         return kwargs['vm_name']
 
+    def _create_instance(self, template, *args, **kwargs):
+        image = self.api.images.find(name=template)
+        flavour = self.api.flavors.find(name=kwargs['flavour_name'])
+        instance = self.api.servers.create(kwargs['vm_name'], image, flavour, *args, **kwargs)
+        self.handle_cache.set(kwargs['vm_name'], instance.id)
+        return instance
+
+    def _submit_deploy(self, template, vm_name, **kwargs):
+        kwargs.setdefault('flavour_name', 'm1.tiny')
+        kwargs['vm_name'] = vm_name
+        self._create_instance(template, **kwargs)
+        if kwargs.get('assign_floating_ip') is not None:
+            # Floating ips can only be added once the instance is active
+            if self._floating_ip_pools is None:
+                self._floating_ip_pools = {}
+            self._floating_ip_pools[vm_name] = kwargs['assign_floating_ip']
+
+    def _resolve_ip(self, vm_name, timeout):
+        pool = (self._floating_ip_pools or {}).pop(vm_name, None)
+        if pool is not None:
+            ip = self.api.floating_ips.create(pool)
+            self._find_instance_by_name(vm_name).add_floating_ip(ip)
+        return super(OpenstackSystem, self)._resolve_ip(vm_name, timeout)
+
     def _get_instance_networks(self, name):
         instance = self._find_instance_by_name(name)
         return instance._info['addresses']
 
     def get_ip_address(self, name):
-        networks = self._get_instance_networks(name)
+        return self._floating_ip(self._get_instance_networks(name))
+
+    @staticmethod
+    def _floating_ip(networks):
         for network in networks.keys():
             for nic in networks[network]:
                 if nic['OS-EXT-IPS:type'] == 'floating':
@@ -1147,17 +2953,61 @@ class OpenstackSystem(MgmtSystemAPIBase):
         instances = self.api.servers.list(True, {'all_tenants': True})
         return instances
 
+    def iter_vms(self):
+        """Yields instance names, listing the servers a page at a time"""
+        for instance in self._iter_instances():
+            yield instance.name
+
+    def iter_vm_records(self):
+        for instance in self._iter_instances():
+            yield VmRecord(instance.name, instance.id, instance.status,
+                           self._floating_ip(instance._info.get('addresses', {})),
+                           getattr(instance, 'OS-EXT-SRV-ATTR:host', None), False,
+                           self.provider_name)
+        for image in self.api.images.list():
+            yield VmRecord(image.name, image.id, image.status, None, None, True,
+                           self.provider_name)
+
+    def _iter_instances(self):
+        marker = None
+        while True:
+            page = self.api.servers.list(True, {'all_tenants': True}, marker=marker,
+                                         limit=self.list_page_size)
+            for instance in page:
+                yield instance
+            if len(page) < self.list_page_size:
+                break
+            marker = page[-1].id
+
+    def _vm_statuses(self, vm_names):
+        if len(vm_names) == 1:
+            # A single cached GET is cheaper than listing every tenant
+            return super(OpenstackSystem, self)._vm_statuses(vm_names)
+        return dict((instance.name, instance.status) for instance in self._get_all_instances()
+                    if instance.name in vm_names)
+
     def _find_instance_by_name(self, name):
         """
         OpenStack Nova Client does have a find method, but it doesn't
         allow the find method to be used on other tenants. The list()
         method is the only one that allows an all_tenants=True keyword
+
+        The instance id found by listing is cached, so subsequent lookups
+        are a single GET of that server instead of a listing of every tenant.
         """
+        instance_id = self._cached_handle(name, self._find_instance_id_by_name)
+        try:
+            return self.api.servers.get(instance_id)
+        except osexceptions.NotFound:
+            # Deleted behind our back, the name may have been reused
+            self.handle_cache.invalidate(name)
+            return self.api.servers.get(self._cached_handle(name, self._find_instance_id_by_name))
 
+    def _find_instance_id_by_name(self, name):
         instances = self._get_all_instances()
         for instance in instances:
             if instance.name == name:
-                return instance
+                return instance.id
         else:
             raise Exception('Invalid instance ID: %s' % name)
 
@@ -1169,10 +3019,524 @@ class OpenstackSystem(MgmtSystemAPIBase):
             return False
 
 
+class FakeSystem(MgmtSystemAPIBase):
+    """In-process simulated provider, for measuring client code without hardware
+
+    The inventory lives in memory and every method counts as one API call,
+    which can be made slow or unreliable. Power operations, deploys and
+    deletes go through a transitional status for ``task_delay`` seconds
+    before they complete, like tasks on a real provider.
+
+    Registered as the 'fake' provider type, so a cfme_data entry with
+    ``type: fake`` and any of the arguments below works with provider_factory.
+
+    Args:
+        num_vm, num_template, num_host, num_datastore: Size of the generated
+            inventory; every other vm starts up
+        latency: Seconds each API call takes
+        failure_rate: Fraction of API calls raising :py:class:`FakeSystemError`
+        task_delay: Seconds a power operation, deploy or delete takes to complete
+        seed: Seed for the failure injection
+
+    Calls are counted per method on the ``calls`` attribute.
+
+    """
+
+    _stats_queries = {
+        'vms': lambda self: self.list_vm(),
+        'hosts': lambda self: self.list_host(),
+        'templates': lambda self: self.list_template(),
+        'datastores': lambda self: self.list_datastore(),
+    }
+
+    _stats_available = {
+        'num_vm': ('vms', len),
+        'num_host': ('hosts', len),
+        'num_template': ('templates', len),
+        'num_datastore': ('datastores', len),
+    }
+
+    states = {
+        'running': ('up',),
+        'stopped': ('down',),
+        'suspended': ('suspended',),
+    }
+
+    # Polling memory is cheap, keep waits close to task_delay
+    state_poll_min_delay = .01
+    state_poll_max_delay = 1
+
+    def __init__(self, num_vm=1000, num_template=10, num_host=10, num_datastore=10,
+                 latency=0, failure_rate=0, task_delay=0, seed=None, **kwargs):
+        self.latency = float(latency)
+        self.failure_rate = float(failure_rate)
+        self.task_delay = float(task_delay)
+        self.endpoint = kwargs.get('hostname')
+        self.calls = Counter()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._hosts = ['host%d' % i for i in range(int(num_host))]
+        self._datastores = ['datastore%d' % i for i in range(int(num_datastore))]
+        self._templates = ['template%d' % i for i in range(int(num_template))]
+        self._vms = {}
+        for i in range(int(num_vm)):
+            self._add_vm('vm%d' % i, 'up' if i % 2 else 'down')
+
+    def _add_vm(self, vm_name, status, pending=None):
+        i = len(self._vms)
+        self._vms[vm_name] = {
+            'status': status,
+            'pending': pending,
+            'host': self._hosts[i % len(self._hosts)] if self._hosts else None,
+            'datastore': (self._datastores[i % len(self._datastores)]
+                          if self._datastores else None),
+            'ip_address': '10.%d.%d.%d' % (i >> 16 & 255, i >> 8 & 255, i & 255),
+        }
+
+    def _api_call(self, method):
+        with self._lock:
+            self.calls[method] += 1
+            failed = self._random.random() < self.failure_rate
+        if self.latency:
+            time.sleep(self.latency)
+        if failed:
+            raise FakeSystemError('Injected failure calling %s' % method)
+
+    def _settle(self, vm_name):
+        """Completes the pending task of a vm if it's due, returns None once deleted
+
+        The lock must be held by the caller.
+
+        """
+        vm = self._vms.get(vm_name)
+        if vm is not None and vm['pending'] is not None and time.time() >= vm['pending'][1]:
+            status = vm['pending'][0]
+            if status is None:
+                del self._vms[vm_name]
+                return None
+            vm['status'] = status
+            vm['pending'] = None
+        return vm
+
+    def _get_vm(self, vm_name):
+        vm = self._settle(vm_name)
+        if vm is None:
+            raise Exception('Could not find a VM named %s.' % vm_name)
+        return vm
+
+    def _start_task(self, vm_name, transitional, final, allowed=None):
+        with self._lock:
+            vm = self._get_vm(vm_name)
+            if allowed is not None and vm['status'] not in allowed:
+                raise Exception('Could not act on %s because it is %s.' %
+                                (vm_name, vm['status']))
+            vm['status'] = transitional
+            vm['pending'] = (final, time.time() + self.task_delay)
+
+    def _submit_start(self, vm_name):
+        self._api_call('start_vm')
+        if self.vm_status(vm_name) != 'up':
+            self._start_task(vm_name, 'powering_up', 'up', ('down', 'suspended'))
+
+    def _submit_stop(self, vm_name):
+        self._api_call('stop_vm')
+        if self.vm_status(vm_name) != 'down':
+            self._start_task(vm_name, 'powering_down', 'down', ('up', 'suspended'))
+
+    def start_vm(self, vm_name):
+        self._submit_start(vm_name)
+        self.wait_for_vm_state(vm_name, 'running')
+        return True
+
+    def stop_vm(self, vm_name):
+        self._submit_stop(vm_name)
+        self.wait_for_vm_state(vm_name, 'stopped')
+        return True
+
+    def create_vm(self, vm_name):
+        raise NotImplementedError('This function has not yet been implemented.')
+
+    def delete_vm(self, vm_name):
+        self._api_call('delete_vm')
+        self._start_task(vm_name, 'removing', None)
+        wait_for(lambda: not self.does_vm_exist(vm_name), num_sec=600,
+                 delay=self.state_poll_min_delay, message='delete %s' % vm_name)
+        return True
+
+    def restart_vm(self, vm_name):
+        return self.stop_vm(vm_name) and self.start_vm(vm_name)
+
+    def list_vm(self, **kwargs):
+        self._api_call('list_vm')
+        with self._lock:
+            return [vm_name for vm_name in self._vms.keys() if self._settle(vm_name)]
+
+    def list_template(self):
+        self._api_call('list_template')
+        return list(self._templates)
+
+    def list_flavor(self):
+        raise NotImplementedError('This function is not supported on this platform.')
+
+    def list_host(self):
+        self._api_call('list_host')
+        return list(self._hosts)
+
+    def list_datastore(self):
+        self._api_call('list_datastore')
+        return list(self._datastores)
+
+    def info(self):
+        self._api_call('info')
+        return 'FakeSystem with %d vms' % len(self._vms)
+
+    def disconnect(self):
+        pass
+
+    def vm_status(self, vm_name):
+        self._api_call('vm_status')
+        with self._lock:
+            return self._get_vm(vm_name)['status']
+
+    def _vm_statuses(self, vm_names):
+        self._api_call('vm_statuses')
+        statuses = {}
+        with self._lock:
+            for vm_name in vm_names:
+                vm = self._settle(vm_name)
+                if vm is not None:
+                    statuses[vm_name] = vm['status']
+        return statuses
+
+    def is_vm_running(self, vm_name):
+        return self.vm_status(vm_name) in self.states['running']
+
+    def is_vm_stopped(self, vm_name):
+        return self.vm_status(vm_name) in self.states['stopped']
+
+    def is_vm_suspended(self, vm_name):
+        return self.vm_status(vm_name) in self.states['suspended']
+
+    def suspend_vm(self, vm_name):
+        self._api_call('suspend_vm')
+        self._start_task(vm_name, 'suspending', 'suspended', ('up',))
+        self.wait_for_vm_state(vm_name, 'suspended')
+        return True
+
+    def clone_vm(self, source_name, vm_name):
+        self._api_call('clone_vm')
+        with self._lock:
+            self._get_vm(source_name)
+            if self._settle(vm_name) is not None:
+                raise Exception('A VM named %s already exists.' % vm_name)
+            self._add_vm(vm_name, 'image_locked', ('down', time.time() + self.task_delay))
+        self.wait_for_vm_state(vm_name, 'stopped')
+        return vm_name
+
+    def does_vm_exist(self, name):
+        self._api_call('does_vm_exist')
+        with self._lock:
+            return self._settle(name) is not None
+
+    def deploy_template(self, template, *args, **kwargs):
+        timeout = kwargs.pop('timeout', 900)
+        vm_name = kwargs['vm_name']
+        self._submit_deploy(template, vm_name)
+        self.wait_for_vm_state(vm_name, 'stopped', timeout)
+        self._submit_start(vm_name)
+        self.wait_for_vm_state(vm_name, 'running', timeout)
+        return vm_name
+
+    def _submit_deploy(self, template, vm_name, **kwargs):
+        self._api_call('deploy_template')
+        with self._lock:
+            if template not in self._templates:
+                raise Exception('Could not find a template named %s.' % template)
+            if self._settle(vm_name) is not None:
+                raise Exception('A VM named %s already exists.' % vm_name)
+            self._add_vm(vm_name, 'image_locked', ('down', time.time() + self.task_delay))
+
+    def get_ip_address(self, vm_name):
+        self._api_call('get_ip_address')
+        with self._lock:
+            vm = self._get_vm(vm_name)
+            if vm['status'] == 'up':
+                return vm['ip_address']
+
+    def iter_vm_records(self):
+        self._api_call('list_vm')
+        with self._lock:
+            records = []
+            for vm_name in self._vms.keys():
+                vm = self._settle(vm_name)
+                if vm is not None:
+                    records.append(VmRecord(
+                        vm_name, vm_name, vm['status'],
+                        vm['ip_address'] if vm['status'] == 'up' else None,
+                        vm['host'], False, self.provider_name))
+        for record in records:
+            yield record
+        for template in self.list_template():
+            yield VmRecord(template, template, None, None, None, True, self.provider_name)
+
+
+class ConcurrentMgmtSystem(object):
+    """Calls a management system without blocking the caller
+
+    Wraps an :py:class:`EC2System`, an :py:class:`OpenstackSystem` or any other
+    implementor of :py:class:`MgmtSystemAPIBase` and keeps its methods, but every
+    public method returns a :py:class:`multiprocessing.pool.AsyncResult` right away.
+
+    Calls run on a thread pool shared by every wrapper of a client for the same
+    ``endpoint``. The size of that pool caps the requests in flight to the endpoint,
+    so a single worker can watch hundreds of instances without flooding the API.
+
+    Call :py:meth:`close` once done, or use the wrapper as a context manager; the
+    pool of an endpoint is closed along with the last wrapper using it.
+
+    Usage::
+
+        with ConcurrentMgmtSystem(EC2System(**credentials)) as ec2:
+            running = dict((name, ec2.is_vm_running(name)) for name in names)
+            running = dict((name, result.get()) for name, result in running.iteritems())
+
+    """
+    # Default number of requests in flight per endpoint
+    max_in_flight = 20
+
+    # Endpoint -> [thread pool, number of wrappers using it]
+    _pools = {}
+    _pools_lock = threading.Lock()
+
+    def __init__(self, client, max_in_flight=None):
+        self.client = client
+        # Clients that don't report an endpoint get a limit of their own
+        self.endpoint = client.endpoint or id(client)
+        self._pool = self._acquire_pool(self.endpoint, max_in_flight or self.max_in_flight)
+
+    @classmethod
+    def _acquire_pool(cls, endpoint, size):
+        # The first wrapper for an endpoint sets its limit
+        with cls._pools_lock:
+            if endpoint not in cls._pools:
+                cls._pools[endpoint] = [ThreadPool(size), 0]
+            cls._pools[endpoint][1] += 1
+            return cls._pools[endpoint][0]
+
+    def close(self):
+        """Stops using the endpoint's pool, closing it if no other wrapper uses it
+
+        Calls already submitted are finished first.
+
+        """
+        if self._pool is None:
+            return
+        pool, self._pool = self._pool, None
+        with self._pools_lock:
+            entry = self._pools[self.endpoint]
+            entry[1] -= 1
+            if entry[1]:
+                return
+            del self._pools[self.endpoint]
+        pool.close()
+        pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args, **kwargs):
+        self.close()
+
+    def __getattr__(self, name):
+        attr = getattr(self.client, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+
+        def submit(*args, **kwargs):
+            if self._pool is None:
+                raise ValueError('%s was called after close()' % name)
+            return self._pool.apply_async(attr, args, kwargs)
+        submit.__name__ = name
+        submit.__doc__ = attr.__doc__
+        return submit
+
+    def map(self, method, items, timeout=None):
+        """Calls a method once for each item concurrently and waits for all of them
+
+        :param method: name of the wrapped client's method, e.g. 'vm_status'
+        :param items: first argument of each call
+        :param timeout: seconds to wait for each result, None waits forever
+        :return: results in the same order as items
+        :rtype: list
+        :raises: the first error raised by a call
+
+        """
+        results = [getattr(self, method)(item) for item in items]
+        return [result.get(timeout) for result in results]
+
+
+class HandleCache(object):
+    """Size bounded, thread safe LRU cache of object names to provider handles
+
+    A handle is whatever a provider needs to act on an object without looking
+    it up by name again: a pysphere vm, a RHEV vm id, an instance id, etc.
+
+    Args:
+        ttl: Number of seconds an entry is valid for, 0 disables caching
+        size: Maximum number of entries, least recently used are evicted first
+
+    Hits and misses are counted on the ``hits`` and ``misses`` attributes.
+
+    """
+    def __init__(self, ttl, size):
+        self.ttl = ttl
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._handles = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, name):
+        """Returns the cached handle for name, or None if absent or expired"""
+        with self._lock:
+            try:
+                handle, expires = self._handles.pop(name)
+            except KeyError:
+                self.misses += 1
+                return None
+            if time.time() > expires:
+                self.misses += 1
+                return None
+            # Re-insert to mark this entry as the most recently used
+            self._handles[name] = (handle, expires)
+            self.hits += 1
+            return handle
+
+    def set(self, name, handle):
+        if not self.ttl or not self.size:
+            return
+        with self._lock:
+            self._handles.pop(name, None)
+            self._handles[name] = (handle, time.time() + self.ttl)
+            while len(self._handles) > self.size:
+                self._handles.popitem(last=False)
+
+    def invalidate(self, name=None):
+        """Drops the handle for name, or every handle if name is None"""
+        with self._lock:
+            if name is None:
+                self._handles.clear()
+            else:
+                self._handles.pop(name, None)
+
+    def __len__(self):
+        return len(self._handles)
+
+
+# An object in a VMWareTopology. kind is one of 'folder', 'datacenter',
+# 'cluster', 'compute_resource', 'host', 'resource_pool' or 'datastore', parent
+# is the reference of the parent object and free the unreserved memory in bytes
+# of hosts, clusters and pools or the free space in bytes of datastores.
+TopologyNode = namedtuple('TopologyNode', ['mor', 'kind', 'name', 'path', 'parent', 'free'])
+
+
+class VMWareTopology(object):
+    """Placement objects of a vsphere inventory, indexed by path
+
+    Paths are inventory paths, like ``/dc1/host/cluster1/Resources/pool1``.
+    Path lookups and prefix queries are binary searches over the sorted
+    paths, so they cost O(log n) plus the number of results.
+
+    Args:
+        nodes: Iterable of :py:class:`TopologyNode`
+
+    """
+    def __init__(self, nodes):
+        nodes = sorted(nodes, key=lambda node: node.path)
+        self.nodes = dict((node.mor, node) for node in nodes)
+        self._paths = [node.path for node in nodes]
+        self._path_nodes = nodes
+        self._children = {}
+        self._names = {}
+        for node in nodes:
+            self._children.setdefault(node.parent, []).append(node)
+            self._names.setdefault(node.name, []).append(node)
+
+    def __len__(self):
+        return len(self._path_nodes)
+
+    def get(self, path):
+        """Returns the node at path, or None"""
+        i = bisect.bisect_left(self._paths, path)
+        if i < len(self._paths) and self._paths[i] == path:
+            return self._path_nodes[i]
+
+    def find(self, prefix='', kind=None):
+        """Returns the nodes whose path starts with prefix, in path order
+
+        End prefix with a slash to only get the objects below a node.
+
+        """
+        nodes = []
+        for i in xrange(bisect.bisect_left(self._paths, prefix), len(self._paths)):
+            if not self._paths[i].startswith(prefix):
+                break
+            if kind is None or self._path_nodes[i].kind == kind:
+                nodes.append(self._path_nodes[i])
+        return nodes
+
+    def named(self, name, kind=None):
+        """Returns the nodes called name"""
+        return [node for node in self._names.get(name, []) if kind is None or node.kind == kind]
+
+    def children(self, node):
+        return list(self._children.get(node.mor, []))
+
+    def parent(self, node, kind=None):
+        """Returns the closest ancestor of node, of the given kind if any"""
+        node = self.nodes.get(node.parent)
+        while node is not None and kind is not None and node.kind != kind:
+            node = self.nodes.get(node.parent)
+        return node
+
+    def least_loaded(self, kind, prefix=''):
+        """Returns the node of the given kind with the most free capacity, or None"""
+        nodes = [node for node in self.find(prefix, kind) if node.free is not None]
+        if nodes:
+            return max(nodes, key=lambda node: node.free)
+
+
+class VmRecord(namedtuple('VmRecord',
+        ['name', 'id', 'state', 'ip', 'host', 'template', 'provider'])):
+    """Compact description of a vm or template, as yielded by ``iter_vm_records``
+
+    ``state`` is what vm_status reports, ``template`` is a boolean and
+    ``provider`` is the name of the provider in cfme_data, if known. Fields a
+    backend can't fill in cheaply are None.
+
+    """
+    __slots__ = ()
+
+
+# Progress of a vm deployed by deploy_templates. stage is one of 'deployed',
+# 'running', 'ready' or 'failed'; ip is set on 'ready' and error on 'failed'.
+DeployEvent = namedtuple('DeployEvent', ['vm_name', 'stage', 'ip', 'error'])
+
+
+# Changes to a provider inventory, as returned by inventory_since. added, removed
+# and modified are sets of (kind, name) tuples, token is passed to the next call and
+# full is set when the changes are relative to an empty inventory.
+InventoryDelta = namedtuple('InventoryDelta', ['added', 'removed', 'modified', 'token', 'full'])
+
+
 class ActionTimedOutError(Exception):
     pass
 
 
+class FakeSystemError(Exception):
+    pass
+
+
 class MultipleInstancesError(Exception):
     def __init__(self, value):
         self.value = value
@@ -1,3 +1,10 @@
+import re
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+
 from utils import conf, mgmt_system
 
 
@@ -17,8 +24,11 @@ provider_type_map = dict(
     infra_provider_type_map.items() + cloud_provider_type_map.items()
 )
 
+# In-process simulated provider, for exercising client code without hardware
+provider_type_map['fake'] = mgmt_system.FakeSystem
 
-def provider_factory(provider_name, providers=None, credentials=None):
+
+def _provider_config(provider_name, providers=None, credentials=None):
     if providers is None:
         providers = conf.cfme_data['management_systems']
 
@@ -27,9 +37,284 @@ def provider_factory(provider_name, providers=None, credentials=None):
     if credentials is None:
         credentials = conf.credentials[provider['credentials']]
 
+    return provider, credentials
+
+
+def provider_factory(provider_name, providers=None, credentials=None):
+    provider, credentials = _provider_config(provider_name, providers, credentials)
+
     # Munge together provider dict and creds,
     # Let the provider do whatever they need with them
     provider_kwargs = provider.copy()
     provider_kwargs.update(credentials)
     provider_instance = provider_type_map[provider['type']](**provider_kwargs)
+    provider_instance.provider_name = provider_name
     return provider_instance
+
+
+class ProviderPool(object):
+    """Process wide pool of connected provider clients
+
+    Clients are keyed by provider name and credentials. A client is handed
+    out to one caller at a time; when it comes back it is kept for the next
+    caller instead of being disconnected, so fixtures and scripts don't pay
+    the login latency again.
+
+    Args:
+        idle_timeout: Seconds an unused client is kept before it's disconnected
+        check_interval: Seconds after which a client's session is checked with
+            ``is_session_alive`` before it's handed out again; dead sessions are
+            replaced by a freshly logged in client
+
+    Usage:
+
+        with provider_pool.checkout('vsphere5') as provider:
+            provider.list_vm()
+
+    """
+    def __init__(self, idle_timeout=600, check_interval=60):
+        self.idle_timeout = idle_timeout
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        # key -> list of [client, last used, last checked]
+        self._idle = {}
+        # id(client) -> key for clients currently checked out
+        self._checked_out = {}
+
+    @staticmethod
+    def _key(provider_name, credentials):
+        return provider_name, tuple(sorted(credentials.items()))
+
+    def get(self, provider_name, providers=None, credentials=None):
+        """Checks out a connected client, which must be returned with :py:meth:`put`"""
+        provider, credentials = _provider_config(provider_name, providers, credentials)
+        key = self._key(provider_name, credentials)
+        self.expire()
+        client = None
+        while client is None:
+            with self._lock:
+                idle = self._idle.get(key)
+                if not idle:
+                    break
+                client, last_used, last_checked = idle.pop()
+            if time.time() - last_checked >= self.check_interval:
+                if client.is_session_alive():
+                    last_checked = time.time()
+                else:
+                    # Session timed out, drop the client and log in again
+                    self._disconnect(client)
+                    client = None
+        if client is None:
+            client = provider_factory(provider_name, providers, credentials)
+            last_checked = time.time()
+        with self._lock:
+            self._checked_out[id(client)] = (key, last_checked)
+        return client
+
+    def put(self, client):
+        """Returns a checked out client to the pool"""
+        with self._lock:
+            key, last_checked = self._checked_out.pop(id(client))
+            self._idle.setdefault(key, []).append([client, time.time(), last_checked])
+
+    def discard(self, client):
+        """Drops a checked out client that shouldn't be reused"""
+        with self._lock:
+            self._checked_out.pop(id(client), None)
+        self._disconnect(client)
+
+    @contextmanager
+    def checkout(self, provider_name, providers=None, credentials=None):
+        """Checks out a client for the duration of a with block
+
+        The client goes back to the pool when the block is done. If the block
+        raised, it is only dropped if its session was lost along the way; an
+        ordinary API error, like a vm not being found, leaves it usable.
+
+        """
+        client = self.get(provider_name, providers, credentials)
+        try:
+            yield client
+        except Exception:
+            if self._is_alive(client):
+                self.put(client)
+            else:
+                self.discard(client)
+            raise
+        else:
+            self.put(client)
+
+    def expire(self):
+        """Disconnects the idle clients that haven't been used for idle_timeout"""
+        expired = []
+        deadline = time.time() - self.idle_timeout
+        with self._lock:
+            for key, clients in self._idle.items():
+                expired.extend(client for client, last_used, _ in clients if last_used < deadline)
+                self._idle[key] = [entry for entry in clients if entry[1] >= deadline]
+        for client in expired:
+            self._disconnect(client)
+
+    def clear(self):
+        """Disconnects all the idle clients"""
+        with self._lock:
+            clients = [entry[0] for entries in self._idle.values() for entry in entries]
+            self._idle.clear()
+        for client in clients:
+            self._disconnect(client)
+
+    @staticmethod
+    def _is_alive(client):
+        try:
+            return client.is_session_alive()
+        except Exception:
+            return False
+
+    @staticmethod
+    def _disconnect(client):
+        try:
+            client.disconnect()
+        except Exception:
+            pass
+
+
+provider_pool = ProviderPool()
+
+
+# Outcome of running an action against one provider in a fanout
+FanoutResult = namedtuple('FanoutResult', ['provider_name', 'result', 'error', 'elapsed'])
+
+
+def _fanout_call(provider_name, action, args, kwargs, clients):
+    start = time.time()
+    try:
+        client = clients.get(provider_name)
+        if client is None:
+            if action is None:
+                # Connecting only, the caller returns the client to the pool
+                result = provider_pool.get(provider_name)
+                return FanoutResult(provider_name, result, None, time.time() - start)
+            with provider_pool.checkout(provider_name) as client:
+                result = _fanout_action(client, action, args, kwargs)
+        else:
+            result = _fanout_action(client, action, args, kwargs)
+        return FanoutResult(provider_name, result, None, time.time() - start)
+    except Exception as e:
+        return FanoutResult(provider_name, None, e, time.time() - start)
+
+
+def _fanout_action(client, action, args, kwargs):
+    if action is None:
+        return client
+    elif callable(action):
+        return action(client, *args, **kwargs)
+    else:
+        return getattr(client, action)(*args, **kwargs)
+
+
+def provider_fanout(action, provider_names=None, args=(), kwargs=None, clients=None):
+    """Runs an action against several providers at the same time
+
+    Each provider is acted on in its own thread with a client checked out of
+    :py:data:`provider_pool` (unless one is passed in ``clients``), so the
+    whole fanout takes as long as the slowest provider instead of the sum
+    of all of them.
+
+    Args:
+        action: Name of a provider client method (e.g. 'list_vm'), a callable
+            taking the client as its first argument, or None to just connect
+        provider_names: Names of providers in cfme_data, defaults to all of them
+        args: Positional arguments passed to the action
+        kwargs: Keyword arguments passed to the action
+        clients: Optional dict of provider name -> already connected client
+
+    Returns:
+        A dict of provider name -> :py:class:`FanoutResult`; exceptions are
+        not raised but returned on the result's ``error`` attribute.
+
+    """
+    if provider_names is None:
+        provider_names = conf.cfme_data['management_systems'].keys()
+    provider_names = list(provider_names)
+    kwargs = kwargs or {}
+    clients = clients or {}
+    if not provider_names:
+        return {}
+
+    pool = ThreadPool(len(provider_names))
+    try:
+        results = pool.map(
+            lambda name: _fanout_call(name, action, args, kwargs, clients), provider_names)
+    finally:
+        pool.close()
+        pool.join()
+    return dict((result.provider_name, result) for result in results)
+
+
+def connect_providers(provider_names=None):
+    """Checks out clients for several providers concurrently
+
+    The clients come from :py:data:`provider_pool` and should be given back
+    with ``provider_pool.put`` once they're no longer needed.
+
+    Returns:
+        A dict of provider name -> provider client
+
+    Raises:
+        The first connection error encountered, if any
+
+    """
+    results = provider_fanout(None, provider_names)
+    for result in results.itervalues():
+        if result.error is not None:
+            for other in results.itervalues():
+                if other.error is None:
+                    provider_pool.put(other.result)
+            raise result.error
+    return dict((name, result.result) for name, result in results.iteritems())
+
+
+def provider_stats(requested_stats=(), provider_names=None, clients=None):
+    """Collects stats from several providers at the same time
+
+    Each provider computes all of its requested stats in a single pass, see
+    :py:meth:`utils.mgmt_system.MgmtSystemAPIBase.stats`.
+
+    Args:
+        requested_stats: Names of the stats to collect, defaults to all available
+        provider_names: Names of providers in cfme_data, defaults to all of them
+        clients: Optional dict of provider name -> already connected client
+
+    Returns:
+        A dict of provider name -> dict of stat name -> value
+
+    Raises:
+        The first error encountered, if any
+
+    """
+    results = provider_fanout('stats', provider_names, args=tuple(requested_stats),
+                              clients=clients)
+    for result in results.itervalues():
+        if result.error is not None:
+            raise result.error
+    return dict((name, result.result) for name, result in results.iteritems())
+
+
+def delete_vms_matching(provider, pattern):
+    """Deletes every vm on provider whose name matches the regex pattern
+
+    Usable as a fanout action, e.g. for cleanup sweeps::
+
+        provider_fanout(delete_vms_matching, args=('^test_',))
+
+    The matches are deleted with one delete_vms batch, so that providers
+    which can delete several vms at once make a single request.
+
+    Returns:
+        A dict of vm name -> whether the vm was deleted
+
+    """
+    vm_names = [vm_name for vm_name in provider.list_vm() if re.match(pattern, vm_name)]
+    if not vm_names:
+        return {}
+    return provider.delete_vms(vm_names)
@@ -0,0 +1,198 @@
+"""Bulk removal of metrics and other test artefacts from the appliance database
+
+Rows are deleted straight from the partitions the appliance keeps them in,
+and from their parent tables, a chunk at a time so that no table stays locked
+for long. Tables that are emptied completely are truncated instead on
+postgres, and the affected tables can be vacuumed afterwards. Emptying the
+events, tasks and requests completely wipes the appliance's history, so it
+has to be asked for with ``purge_all``.
+
+Example, reset everything older than a day and report what was removed::
+
+    from utils import purge
+    results = purge.purge(db.engine, before=datetime.datetime.utcnow() -
+                          datetime.timedelta(days=1), vacuum=True)
+    print purge.format_report(results)
+
+"""
+import datetime
+import time
+from collections import namedtuple
+
+from sqlalchemy import and_, func, or_, select, text
+
+import db
+
+# What each purge target removes: the mapped classes, the column holding the
+# resource id (or a dict of resource type -> column) and the timestamp column.
+# Tasks and requests don't belong to a resource, so a resource filter skips them.
+# The parents of the metrics partitions come first; only their own rows are
+# removed from them, the partitions' rows are handled one partition at a time.
+TARGETS = {
+    'metrics': [('Metric', 'resource_id', 'timestamp')] +
+               [('Metric%02d' % hour, 'resource_id', 'timestamp') for hour in range(24)],
+    'rollups': [('MetricRollup', 'resource_id', 'timestamp')] +
+               [('MetricRollup%02d' % month, 'resource_id', 'timestamp')
+                for month in range(1, 13)],
+    'events': [('EmEvent', {'VmOrTemplate': 'vm_or_template_id', 'Host': 'host_id',
+                            'EmsCluster': 'ems_cluster_id'}, 'timestamp')],
+    'tasks': [('MiqTask', None, 'created_on')],
+    'requests': [('MiqRequestTask', None, 'created_on'), ('MiqRequest', None, 'created_on')],
+}
+
+# Targets whose rows are the appliance's history, which other tests rely on
+HISTORY_TARGETS = ('events', 'tasks', 'requests')
+
+# Rows deleted per statement
+CHUNK_SIZE = 10000
+
+# What was done to one table: method is 'truncate', 'delete' or 'vacuum' and
+# rows is None for a vacuum
+PurgeResult = namedtuple('PurgeResult', ['table', 'method', 'rows', 'seconds'])
+
+
+def purge(engine, targets=None, resources=None, resource_type='VmOrTemplate',
+          after=None, before=None, vacuum=False, chunk_size=CHUNK_SIZE, purge_all=False):
+    """Removes the rows of the given targets for some resources or a time window
+
+    Every chunk is deleted in its own transaction, so this needs an engine
+    rather than a session; commit the session first.
+
+    Args:
+        engine: A SQLAlchemy engine
+        targets: Names of TARGETS to purge, all of them by default
+        resources: Ids of the resources whose rows are removed, all by default
+        resource_type: Type of the resources, as the metrics tables name them,
+            or None for resources of any type
+        after: Only remove rows from this datetime on, in UTC
+        before: Only remove rows older than this datetime, in UTC
+        vacuum: VACUUM ANALYZE the tables rows were removed from, on postgres
+        chunk_size: Rows deleted per statement
+        purge_all: Allow emptying the HISTORY_TARGETS completely, when no
+            resources or window are given
+
+    Returns:
+        A list of :py:class:`PurgeResult`, one per table touched
+
+    Raises:
+        ValueError: If HISTORY_TARGETS would be emptied without purge_all
+
+    """
+    targets = targets or sorted(TARGETS)
+    unfiltered = resources is None and after is None and before is None
+    history = sorted(set(targets) & set(HISTORY_TARGETS))
+    if unfiltered and history and not purge_all:
+        raise ValueError('Purging all of %s needs purge_all=True' % ', '.join(history))
+    postgres = engine.dialect.name == 'postgresql'
+    results = []
+    for target in targets:
+        for class_name, resource_column, time_column in TARGETS[target]:
+            if not _in_window(class_name, after, before):
+                # A partition that can't hold any rows of the window
+                continue
+            if resources is not None and resource_column is None:
+                continue
+            table = _table(class_name)
+            conditions = []
+            if resources is not None:
+                condition = _resource_condition(table, resource_column, resources,
+                                                resource_type)
+                if condition is None:
+                    continue
+                conditions.append(condition)
+            if after is not None:
+                conditions.append(table.c[time_column] >= after)
+            if before is not None:
+                conditions.append(table.c[time_column] < before)
+
+            start = time.time()
+            if not conditions and postgres:
+                rows = engine.execute(select([func.count()]).select_from(table).with_hint(
+                    table, 'ONLY', 'postgresql')).scalar()
+                engine.execute(text('TRUNCATE TABLE ONLY %s' % table.name).execution_options(
+                    autocommit=True))
+                results.append(PurgeResult(table.name, 'truncate', rows, time.time() - start))
+            else:
+                rows = _delete_chunks(engine, table, conditions, chunk_size)
+                results.append(PurgeResult(table.name, 'delete', rows, time.time() - start))
+
+    if vacuum and postgres:
+        connection = engine.connect().execution_options(isolation_level='AUTOCOMMIT')
+        try:
+            for table_name in [result.table for result in results if result.rows]:
+                start = time.time()
+                connection.execute('VACUUM ANALYZE %s' % table_name)
+                results.append(PurgeResult(table_name, 'vacuum', None, time.time() - start))
+        finally:
+            connection.close()
+    return results
+
+
+def format_report(results):
+    """Lays out purge results as a table, with totals"""
+    lines = ['%-32s %-8s %10s %9s' % ('table', 'method', 'rows', 'seconds')]
+    for result in results:
+        lines.append('%-32s %-8s %10s %9.2f' % (result.table, result.method,
+            '' if result.rows is None else result.rows, result.seconds))
+    lines.append('%-32s %-8s %10d %9.2f' % ('total', '',
+        sum(result.rows or 0 for result in results),
+        sum(result.seconds for result in results)))
+    return '\n'.join(lines)
+
+
+def _table(class_name):
+    return getattr(db, class_name).__table__
+
+
+def _resource_condition(table, column, resources, resource_type):
+    if isinstance(column, dict):
+        if resource_type is None:
+            return or_(*[table.c[name].in_(resources) for name in sorted(column.values())])
+        if resource_type not in column:
+            return None
+        return table.c[column[resource_type]].in_(resources)
+    if resource_type is None:
+        return table.c[column].in_(resources)
+    return and_(table.c[column].in_(resources), table.c.resource_type == resource_type)
+
+
+def _in_window(class_name, after, before):
+    """Whether a metrics partition can hold rows between after and before
+
+    Realtime metrics are partitioned by hour of the day and rollups by month,
+    so windows shorter than a day or a year only touch some partitions.
+
+    """
+    if after is None or before is None or not class_name[-2:].isdigit():
+        return True
+    if class_name.startswith('MetricRollup'):
+        month = int(class_name[len('MetricRollup'):])
+        months = (before.year - after.year) * 12 + before.month - after.month
+        return months >= 11 or (month - after.month) % 12 <= months
+    elif class_name.startswith('Metric'):
+        hour = int(class_name[len('Metric'):])
+        if before - after >= datetime.timedelta(days=1):
+            return True
+        hours = int((before - after.replace(minute=0, second=0, microsecond=0)
+                     ).total_seconds() // 3600)
+        return (hour - after.hour) % 24 <= hours
+    return True
+
+
+def _delete_chunks(engine, table, conditions, chunk_size):
+    """Deletes the matching rows chunk_size at a time, each chunk committed on its own
+
+    On postgres only the table's own rows are deleted, not those of the
+    tables inheriting from it.
+
+    """
+    ids = select([table.c.id]).with_hint(table, 'ONLY', 'postgresql').limit(chunk_size)
+    if conditions:
+        ids = ids.where(and_(*conditions))
+    delete = table.delete().with_hint('ONLY', dialect_name='postgresql')
+    deleted = 0
+    while True:
+        rows = engine.execute(delete.where(table.c.id.in_(ids))).rowcount
+        deleted += rows
+        if rows < chunk_size:
+            return deleted
@@ -0,0 +1,123 @@
+import threading
+import time
+
+import pytest
+from sqlalchemy import create_engine
+from unittestzero import Assert
+
+import db
+
+pytestmark = [
+    pytest.mark.nondestructive,
+    pytest.mark.skip_selenium,
+]
+
+
+def appliance_db(path, head, *tables):
+    engine = create_engine('sqlite:///%s' % path)
+    engine.execute('CREATE TABLE schema_migrations (version VARCHAR)')
+    engine.execute("INSERT INTO schema_migrations VALUES ('%s')" % head)
+    for table in tables:
+        engine.execute('CREATE TABLE %s' % table)
+    return engine
+
+
+@pytest.yield_fixture
+def engines(tmpdir):
+    old = db.engine, db.schema_cache_dir
+    db.schema_cache_dir = str(tmpdir.join('cache'))
+    yield (
+        appliance_db(tmpdir.join('old.db'), '20130601',
+            'vms (id INTEGER PRIMARY KEY, name VARCHAR)',
+            'hosts_storages (host_id INTEGER, storage_id INTEGER)'),
+        appliance_db(tmpdir.join('new.db'), '20131001',
+            'vms (id INTEGER PRIMARY KEY, name VARCHAR, guid VARCHAR)',
+            'metrics_05 (id INTEGER PRIMARY KEY)',
+            'miq_policies (id INTEGER PRIMARY KEY)',
+            'miq_policy_contents (id INTEGER PRIMARY KEY)'),
+    )
+    db.engine, db.schema_cache_dir = old
+    for head in ('20130601', '20131001'):
+        db.schemas.pop(head, None)
+
+
+def test_classify():
+    # Names the tests already use, every word is singularized
+    for table_name, class_name in [
+            ('vms', 'Vm'), ('miq_policies', 'MiqPolicy'), ('metrics_05', 'Metric05'),
+            ('hosts_storages', 'HostStorage'), ('vmdb_indexes', 'VmdbIndex'),
+            ('ems_folders', 'EmFolder'), ('miq_ae_classes', 'MiqAeClasse')]:
+        Assert.equal(db.classify(table_name), class_name)
+
+
+def test_schema_versions_side_by_side(engines):
+    old_engine, new_engine = engines
+    db.engine = old_engine
+    OldVm = db.Vm
+    Assert.true(db.Vm is OldVm)
+    Assert.equal(sorted(OldVm.__table__.c.keys()), ['id', 'name'])
+    # Join tables map with all their columns as the primary key
+    Assert.equal(len(db.HostStorage.__mapper__.primary_key), 2)
+    Assert.false(hasattr(db, 'Metric05'))
+
+    db.engine = new_engine
+    Assert.equal(sorted(db.Vm.__table__.c.keys()), ['guid', 'id', 'name'])
+    Assert.true(db.Vm is not OldVm)
+    Assert.equal(db.Metric05.__table__.name, 'metrics_05')
+    Assert.equal(db.complete('MiqPol'), ['MiqPolicy', 'MiqPolicyContent'])
+    Assert.true('MiqPolicyContent' in dir(db))
+
+
+def test_schema_cache(engines):
+    old_engine, new_engine = engines
+    db.engine = old_engine
+    path = db.reflect_all()
+    db.schemas.clear()
+    # The cached schema is used, not the database's
+    old_engine.execute('DROP TABLE hosts_storages')
+    Assert.true(db.load_schema())
+    Assert.equal(db.HostStorage.__table__.name, 'hosts_storages')
+    Assert.true(path.endswith('20130601.pickle'))
+
+
+def test_concurrent_lookups(engines, monkeypatch):
+    old_engine, new_engine = engines
+    db.engine = new_engine
+    loads = []
+    load_schema = db.load_schema
+
+    def slow_load_schema():
+        loads.append(threading.current_thread())
+        time.sleep(.05)
+        return load_schema()
+    monkeypatch.setattr(db, 'load_schema', slow_load_schema)
+    go = threading.Event()
+    classes = []
+    errors = []
+
+    def lookup():
+        go.wait()
+        try:
+            classes.append((db.Vm, db.schema.get('MiqPolicy'), db.Metric05))
+        except Exception as e:
+            errors.append(e)
+    threads = [threading.Thread(target=lookup) for i in range(20)]
+    for thread in threads:
+        thread.start()
+    go.set()
+    for thread in threads:
+        thread.join()
+    Assert.equal(errors, [])
+    # One schema was loaded, and every thread got the same classes
+    Assert.equal(len(loads), 1)
+    Assert.equal(len(set(classes)), 1)
+
+
+def test_no_io_without_engine():
+    old = db.engine
+    db.engine = None
+    try:
+        Assert.false(hasattr(db, 'Vm'))
+        Assert.false(hasattr(db, 'some_attribute'))
+    finally:
+        db.engine = old
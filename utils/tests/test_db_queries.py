@@ -0,0 +1,91 @@
+import pytest
+from sqlalchemy import Boolean, Column, Integer, String, create_engine, MetaData, Table, event
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import sessionmaker
+from unittestzero import Assert
+
+import db
+from utils import db_queries
+
+pytestmark = [
+    pytest.mark.nondestructive,
+    pytest.mark.skip_selenium,
+]
+
+Base = declarative_base()
+
+
+class Vm(Base):
+    __tablename__ = 'vms'
+    id = Column(Integer, primary_key=True)
+    name = Column(String)
+    guid = Column(String)
+    power_state = Column(String)
+    template = Column(Boolean)
+
+
+class PxeServer(Base):
+    __tablename__ = 'pxe_servers'
+    id = Column(Integer, primary_key=True)
+    name = Column(String)
+
+
+@pytest.yield_fixture
+def session():
+    # Looking the real classes up would reflect them, so just shadow them
+    db.Vm, db.PxeServer = Vm, PxeServer
+    engine = create_engine('sqlite://')
+    # As on postgres, LIKE is case sensitive
+    event.listen(engine, 'connect', lambda connection, record: connection.execute(
+        'PRAGMA case_sensitive_like = ON'))
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    session.add_all([
+        Vm(name='cfme-5.2-template', guid='guid-1', power_state='never', template=True),
+        Vm(name='auto-test-vm', guid='guid-2', power_state='on', template=False),
+        Vm(name='auto_test_vm', guid='guid-3', power_state='off', template=False),
+        PxeServer(name='pxe1'),
+        PxeServer(name='pxe2'),
+    ])
+    session.commit()
+    yield session
+    del db.Vm, db.PxeServer
+
+
+def test_find_vm(session):
+    template = db_queries.find_vm(session, 'CFME', template=True, columns=('guid',),
+                                  contains=True, ignore_case=True)
+    Assert.equal(tuple(template), ('guid-1',))
+    Assert.none(db_queries.find_vm(session, 'CFME', template=True, contains=True))
+    Assert.none(db_queries.find_vm(session, 'AUTO-TEST-VM'))
+    Assert.none(db_queries.find_vm(session, 'cfme', template=False, contains=True))
+    vm = db_queries.find_vm(session, 'auto-test-vm')
+    Assert.equal((vm.name, vm.power_state), ('auto-test-vm', 'on'))
+    Assert.none(db_queries.find_vm(session, 'auto-test'))
+    # Underscores are not wildcards, auto-test-vm comes first but doesn't match
+    Assert.equal(db_queries.find_vm(session, 'auto_test_vm').guid, 'guid-3')
+    Assert.equal(db_queries.find_vm(session, 'to_test', contains=True).guid, 'guid-3')
+    Assert.none(db_queries.find_vm(session, 'to%vm', contains=True))
+
+
+def test_find_pxe_server_and_latest_id(session):
+    Assert.equal(db_queries.find_pxe_server(session, 'pxe2').id, 2)
+    Assert.none(db_queries.find_pxe_server(session, 'pxe'))
+    Assert.equal(db_queries.latest_id(session, PxeServer), 2)
+    # The compiled statements were cached and reused
+    Assert.equal(db_queries.latest_id(session, PxeServer), 2)
+    Assert.greater(len(db_queries._compiled_caches[PxeServer.metadata]), 0)
+
+
+def test_statements_per_schema(session):
+    db_queries.find_pxe_server(session, 'pxe1')
+    # A newer schema version, whose pxe_servers has no name column
+    metadata = MetaData()
+    NewPxeServer = type('PxeServer', (declarative_base(metadata=metadata),), {
+        '__table__': Table('pxe_servers', metadata, Column('id', Integer, primary_key=True),
+                           Column('uri', String))})
+    Assert.equal(db_queries.latest_id(session, NewPxeServer), 2)
+    Assert.equal(db_queries.latest_id(session, PxeServer), 2)
+    statement = db_queries._statements[metadata][('latest_id', 'pxe_servers')]
+    Assert.true(statement is not
+                db_queries._statements[PxeServer.metadata][('latest_id', 'pxe_servers')])
@@ -0,0 +1,87 @@
+import threading
+
+import pytest
+from sqlalchemy import Column, Integer, String, create_engine, select
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import Query
+from unittestzero import Assert
+
+from utils.db_router import RouterError, SessionRouter
+
+pytestmark = [
+    pytest.mark.nondestructive,
+    pytest.mark.skip_selenium,
+]
+
+Base = declarative_base()
+
+
+class MiqRegion(Base):
+    __tablename__ = 'miq_regions'
+    id = Column(Integer, primary_key=True)
+    region = Column(Integer)
+    guid = Column(String)
+
+
+@pytest.yield_fixture
+def router(tmpdir):
+    engines = {}
+    for region in (1, 2):
+        engine = create_engine('sqlite:///%s' % tmpdir.join('region_%d.db' % region))
+        Base.metadata.create_all(engine)
+        engine.execute(MiqRegion.__table__.insert(), [
+            {'region': region, 'guid': 'guid-%d' % region},
+            {'region': 99, 'guid': 'replicated'}])
+        engines['region_%d' % region] = engine
+    router = SessionRouter(engines)
+    yield router
+    router.close()
+
+
+def test_query_merges_rows(router):
+    rows = router.query(Query([MiqRegion.region, MiqRegion.guid]).filter(
+        MiqRegion.region != 99))
+    Assert.equal([tuple(row) for row in rows],
+                 [('region_1', 1, 'guid-1'), ('region_2', 2, 'guid-2')])
+    Assert.equal(rows[1].appliance, 'region_2')
+    Assert.equal(rows[1].guid, 'guid-2')
+
+    rows = router.query(select([MiqRegion.__table__.c.guid]).where(
+        MiqRegion.__table__.c.region == 99))
+    Assert.equal([row.appliance for row in rows], ['region_1', 'region_2'])
+
+    rows = router.query(lambda session: session.query(MiqRegion).filter_by(region=99),
+                        appliances=['region_2'])
+    Assert.equal(len(rows), 1)
+    Assert.equal(rows[0].MiqRegion.guid, 'replicated')
+
+
+def test_query_errors(router):
+    router.engines['region_2'].execute('DROP TABLE miq_regions')
+    results = router.fanout(Query(MiqRegion.guid))
+    Assert.equal(len(results['region_1'].rows), 2)
+    Assert.not_none(results['region_2'].error)
+    with pytest.raises(RouterError) as error:
+        router.query(Query(MiqRegion.guid))
+    Assert.equal(error.value.errors.keys(), ['region_2'])
+
+
+def test_fanout_loads_db_schema_first(router, tmpdir, monkeypatch):
+    import db
+    engine = create_engine('sqlite:///%s' % tmpdir.join('db.db'))
+    engine.execute('CREATE TABLE schema_migrations (version VARCHAR)')
+    engine.execute("INSERT INTO schema_migrations VALUES ('20140101')")
+    monkeypatch.setattr(db, 'engine', engine)
+    monkeypatch.setattr(db, 'schema_cache_dir', str(tmpdir.join('cache')))
+    monkeypatch.setattr(db, 'schemas', {})
+    threads = []
+    reflect_all = db.reflect_all
+
+    def record_reflect_all():
+        threads.append(threading.current_thread())
+        return reflect_all()
+    monkeypatch.setattr(db, 'reflect_all', record_reflect_all)
+    results = router.fanout(lambda session: [db.SchemaMigration])
+    Assert.equal([result.error for result in results.itervalues()], [None, None])
+    # Loaded once, before the queries were handed to the pool
+    Assert.equal(threads, [threading.current_thread()])
@@ -0,0 +1,53 @@
+import threading
+import time
+
+import pytest
+from sqlalchemy import Column, Integer, String, create_engine
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.pool import StaticPool
+from unittestzero import Assert
+
+from utils import db_wait
+from utils.wait import TimedOutError
+
+pytestmark = [
+    pytest.mark.nondestructive,
+    pytest.mark.skip_selenium,
+]
+
+Base = declarative_base()
+
+
+class Vm(Base):
+    __tablename__ = 'vms'
+    id = Column(Integer, primary_key=True)
+    name = Column(String)
+    power_state = Column(String)
+
+
+@pytest.fixture
+def engine():
+    # One shared connection, so the in-memory database is seen by every thread
+    engine = create_engine('sqlite://', poolclass=StaticPool,
+                           connect_args={'check_same_thread': False})
+    Base.metadata.create_all(engine)
+    engine.execute(Vm.__table__.insert(), name='vm1', power_state='off')
+    return engine
+
+
+def test_wait_for_row_polls(engine):
+    def power_on():
+        time.sleep(.3)
+        engine.execute(Vm.__table__.update().values(power_state='on'))
+    threading.Thread(target=power_on).start()
+    start = time.time()
+    Assert.equal(db_wait.wait_for_row(Vm, 'power_state', 'name', 'vm1',
+                                      lambda state: state == 'on', 10, engine), 'on')
+    # Noticed on one of the first polls after the change
+    Assert.less(time.time() - start, 1.5)
+
+
+def test_wait_for_row_timeout(engine):
+    with pytest.raises(TimedOutError):
+        db_wait.wait_for_row(Vm, 'id', 'name', 'vm2', lambda vm_id: vm_id is not None,
+                             .5, engine)
@@ -0,0 +1,138 @@
+import datetime
+
+import pytest
+from sqlalchemy import Column, DateTime, Float, Integer, MetaData, String, Table, create_engine
+from unittestzero import Assert
+
+np = pytest.importorskip('numpy')
+from utils import metrics
+
+pytestmark = [
+    pytest.mark.nondestructive,
+    pytest.mark.skip_selenium,
+]
+
+
+@pytest.fixture
+def partitions(monkeypatch):
+    metadata = MetaData()
+    names = ['metrics_%02d' % hour for hour in range(24)]
+    names += ['metric_rollups_%02d' % month for month in range(1, 13)]
+    tables = dict((name, Table(name, metadata,
+        Column('id', Integer, primary_key=True),
+        Column('resource_id', Integer),
+        Column('resource_name', String),
+        Column('resource_type', String),
+        Column('timestamp', DateTime),
+        Column('capture_interval_name', String),
+        Column('cpu_usagemhz_rate_average', Float),
+        Column('derived_memory_used', Float))) for name in names)
+    engine = create_engine('sqlite://')
+    metadata.create_all(engine)
+    monkeypatch.setattr(metrics, '_partition_table', tables.get)
+    return engine
+
+
+def test_generators():
+    times = np.arange(0, 86400, 3600)
+    random = np.random.RandomState(0)
+    Assert.equal(metrics.constant(5)(times, random).tolist(), [5.0] * 24)
+    wave = metrics.sinusoid(100, 50, 86400)(times, random)
+    Assert.equal((wave.min() >= 50, wave.max() <= 150, round(wave[6])), (True, True, 150))
+    walk = metrics.random_walk(10, 5, low=0, high=20)(times, random)
+    Assert.equal((walk[0], walk.min() >= 0, walk.max() <= 20), (10, True, True))
+    Assert.equal(metrics.step([1, 2], 7200)(times, random).tolist()[:5], [1, 1, 2, 2, 1])
+
+
+def test_insert_metrics_partitions(partitions):
+    start = datetime.datetime(2013, 1, 31, 22)
+    counts = metrics.insert_metrics(partitions, {1: 'vm1', 2: 'vm2'}, 'hourly',
+        start, start + datetime.timedelta(hours=3), {
+            'cpu_usagemhz_rate_average': metrics.sinusoid(500, 100, 86400),
+            'derived_memory_used': 1024,
+        })
+    # Two hours of January and two of February for each vm
+    Assert.equal(counts, {'metric_rollups_01': 4, 'metric_rollups_02': 4})
+    rows = partitions.execute('SELECT resource_name, timestamp, derived_memory_used '
+                              'FROM metric_rollups_02 ORDER BY resource_id').fetchall()
+    Assert.equal(rows[0][0], 'vm1')
+    Assert.equal(rows[-1][2], 1024)
+
+    counts = metrics.insert_metrics(partitions, [1], 'realtime', start,
+        start + datetime.timedelta(minutes=59, seconds=40),
+        {'cpu_usagemhz_rate_average': metrics.random_walk(200, 10)}, seed=0)
+    Assert.equal(counts, {'metrics_22': 180})
+
+
+def test_insert_metrics_engine_commits(partitions, monkeypatch):
+    def write_rows(connection, name, column_names, columns, fixed, rows):
+        # Straight to the DBAPI cursor, like the COPY used on postgres
+        cursor = connection.connection.cursor()
+        cursor.executemany('INSERT INTO %s (resource_id) VALUES (?)' % name,
+                           [(resource_id,) for resource_id in columns['resource_id'].tolist()])
+        cursor.close()
+    monkeypatch.setattr(metrics, '_write_rows', write_rows)
+    start = datetime.datetime(2013, 1, 1)
+    metrics.insert_metrics(partitions, [1, 2], 'hourly', start,
+                           start + datetime.timedelta(hours=2), {'derived_memory_used': 1})
+    connection = partitions.connect()
+    try:
+        Assert.equal(connection.execute('SELECT count(*) FROM metric_rollups_01').scalar(), 6)
+    finally:
+        connection.close()
+
+
+def test_read_metrics(partitions, tmpdir):
+    start = datetime.datetime(2013, 3, 1, 22)
+    metrics.insert_metrics(partitions, [1, 2], 'realtime', start,
+        start + datetime.timedelta(hours=3), {
+            'cpu_usagemhz_rate_average': metrics.random_walk(200, 10),
+            'derived_memory_used': 1024,
+        }, seed=0)
+    window = (start + datetime.timedelta(hours=1), start + datetime.timedelta(hours=2))
+    series = metrics.read_metrics(partitions, 'realtime', ['cpu_usagemhz_rate_average'],
+                                  *window, resources=[2], cache_dir=str(tmpdir))
+    Assert.equal(len(series), 180)
+    Assert.equal(set(series.resource_ids.tolist()), set([2]))
+    Assert.equal((series.timestamps[0], series.timestamps[-1]),
+                 (np.datetime64(window[0], 's'), np.datetime64(window[1], 's') - 20))
+    Assert.true((np.diff(series.timestamps).astype(int) == 20).all())
+
+    # The second read comes from the cache
+    partitions.execute('DELETE FROM metrics_23')
+    cached = metrics.read_metrics(partitions, 'realtime', ['cpu_usagemhz_rate_average'],
+                                  *window, resources=[2], cache_dir=str(tmpdir))
+    Assert.equal(cached.columns['cpu_usagemhz_rate_average'].tolist(),
+                 series.columns['cpu_usagemhz_rate_average'].tolist())
+    Assert.equal(len(metrics.read_metrics(partitions, 'realtime',
+        ['cpu_usagemhz_rate_average'], *window, resources=[2])), 0)
+
+
+def test_verify_rollups(partitions):
+    start = datetime.datetime(2013, 3, 1, 22)
+    end = start + datetime.timedelta(hours=2)
+    # The end sample is inserted too, so stop short of the third hour
+    metrics.insert_metrics(partitions, [1, 2], 'realtime', start,
+        end - datetime.timedelta(seconds=20),
+        {'cpu_usagemhz_rate_average': metrics.random_walk(200, 10)}, seed=0)
+    realtime = metrics.read_metrics(partitions, 'realtime', ['cpu_usagemhz_rate_average'])
+    hourly = realtime.rollup('hourly')
+    Assert.equal(len(hourly), 4)
+    first_hour = realtime.resource(1).columns['cpu_usagemhz_rate_average'][:180]
+    Assert.equal(round(hourly.columns['cpu_usagemhz_rate_average'][0], 6),
+                 round(first_hour.mean(), 6))
+    Assert.equal(round(realtime.rollup('hourly', {'cpu_usagemhz_rate_average': 'max'}).columns[
+        'cpu_usagemhz_rate_average'][0], 6), round(first_hour.max(), 6))
+
+    for resource_id, timestamp, value in zip(hourly.resource_ids.tolist(),
+            hourly.timestamps.astype(datetime.datetime).tolist(),
+            hourly.columns['cpu_usagemhz_rate_average'].tolist()):
+        if resource_id == 2 and timestamp.hour == 23:
+            value += 50
+        metrics.insert_metrics(partitions, [resource_id], 'hourly', timestamp, timestamp,
+                               {'cpu_usagemhz_rate_average': value})
+    mismatches = metrics.verify_rollups(partitions, 'hourly', ['cpu_usagemhz_rate_average'],
+                                        start, end)
+    Assert.equal([(m.resource_id, m.timestamp) for m in mismatches],
+                 [(2, datetime.datetime(2013, 3, 1, 23))])
+    Assert.equal(round(mismatches[0].stored - mismatches[0].expected), 50)
@@ -0,0 +1,862 @@
+# -*- coding: utf-8 -*-
+# pylint: disable=W0621
+import fnmatch
+import threading
+import time
+import urllib2
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+import pytest
+from boto.exception import EC2ResponseError
+from unittestzero import Assert
+
+from utils.mgmt_system import (ConcurrentMgmtSystem, EC2System, FakeSystemError, HandleCache,
+    OpenstackSystem, RHEVMSystem, VMWareSystem)
+from utils.providers import provider_factory
+from utils.wait import TimedOutError
+
+pytestmark = [
+    pytest.mark.nondestructive,
+    pytest.mark.skip_selenium,
+]
+
+
+class Prop(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+def vm_content(name, template=False, power_state='poweredOn', ips=None):
+    prop_set = [
+        Prop(Name='name', Val=name),
+        Prop(Name='config.template', Val=template),
+        Prop(Name='runtime.powerState', Val=power_state),
+        Prop(Name='runtime.host', Val='host-1'),
+        Prop(Name='datastore', Val=Prop(ManagedObjectReference=['datastore-1'])),
+    ]
+    if ips is not None:
+        nic = Prop(IpAddress=ips)
+        prop_set.append(Prop(Name='guest.net', Val=Prop(GuestNicInfo=[nic])))
+    return Prop(PropSet=prop_set)
+
+
+class FakeVIServer(object):
+    def __init__(self, contents):
+        self.contents = contents
+        self.traversals = 0
+
+    def _retrieve_properties_traversal(self, **kwargs):
+        self.traversals += 1
+        return self.contents
+
+    def get_hosts(self):
+        return {'host-1': 'esx01'}
+
+    def get_datastores(self):
+        return {'datastore-1': 'datastore01'}
+
+
+class FakeMor(str):
+    def get_attribute_type(self):
+        return self.obj_type
+
+
+def topology_object(mor, obj_type, name, parent, **props):
+    mor = FakeMor(mor)
+    mor.obj_type = obj_type
+    props = dict((prop.replace('_', '.'), value) for prop, value in props.iteritems())
+    props.update(name=name, parent=parent)
+    return mor, props
+
+
+TOPOLOGY = [
+    topology_object('datacenter-1', 'Datacenter', 'dc1', 'group-d1'),
+    topology_object('group-h1', 'Folder', 'host', 'datacenter-1'),
+    topology_object('group-s1', 'Folder', 'datastore', 'datacenter-1'),
+    topology_object('domain-c1', 'ClusterComputeResource', 'cluster1', 'group-h1'),
+    topology_object('host-1', 'HostSystem', 'esx01', 'domain-c1',
+                    summary_hardware_memorySize=8 << 30,
+                    summary_quickStats_overallMemoryUsage=2048),
+    topology_object('resgroup-1', 'ResourcePool', 'Resources', 'domain-c1',
+                    runtime_memory_unreservedForPool=6 << 30),
+    topology_object('resgroup-2', 'ResourcePool', 'busy', 'resgroup-1',
+                    runtime_memory_unreservedForPool=1 << 30),
+    topology_object('resgroup-3', 'ResourcePool', 'idle', 'resgroup-1',
+                    runtime_memory_unreservedForPool=4 << 30),
+    topology_object('datastore-1', 'Datastore', 'datastore01', 'group-s1',
+                    summary_freeSpace=100 << 30),
+]
+
+
+@pytest.fixture
+def vsphere():
+    system = VMWareSystem.__new__(VMWareSystem)
+    system.api = FakeVIServer([
+        vm_content('vm%d' % i, power_state='poweredOff') for i in range(2000)
+    ] + [
+        vm_content('running', ips=['fe80::1', '127.0.0.1', '10.0.0.5']),
+        vm_content('template', template=True),
+    ])
+    system._inventory = None
+    system._inventory_time = 0
+    system.retrievals = 0
+
+    def iter_properties(properties):
+        system.retrievals += 1
+        if 'VirtualMachine' not in properties:
+            return iter(TOPOLOGY)
+        return iter([(FakeMor('vm-%d' % i), dict((prop.Name, prop.Val) for prop in vm.PropSet))
+                     for i, vm in enumerate(system.api.contents)])
+    system._iter_properties = iter_properties
+    return system
+
+
+def test_inventory_snapshot_single_traversal(vsphere):
+    # Per-vm queries only share a snapshot when caching is turned on
+    vsphere.inventory_ttl = 5
+    for i in range(2000):
+        Assert.true(vsphere.is_vm_stopped('vm%d' % i))
+    Assert.true(vsphere.is_vm_running('running'))
+    Assert.equal(vsphere.api.traversals, 1)
+
+
+def test_inventory_snapshot_not_stale_by_default(vsphere):
+    Assert.true(vsphere.is_vm_stopped('vm0'))
+    vsphere.api.contents[0] = vm_content('vm0')
+    Assert.true(vsphere.is_vm_running('vm0'))
+
+
+def test_list_vm_single_retrieval(vsphere):
+    Assert.equal(len(vsphere.list_vm()), 2001)
+    Assert.equal(vsphere.list_template(), ['template'])
+    Assert.equal((vsphere.retrievals, vsphere.api.traversals), (2, 0))
+
+
+def test_inventory_snapshot_properties(vsphere):
+    vm = vsphere.inventory_snapshot()['running']
+    Assert.equal(vm['host'], 'esx01')
+    Assert.equal(vm['datastores'], ['datastore01'])
+    Assert.equal(vsphere.get_ip_address('running'), '10.0.0.5')
+    Assert.contains('template', vsphere.list_template())
+    Assert.false('template' in vsphere.list_vm())
+
+
+def test_inventory_snapshot_missing_vm(vsphere):
+    Assert.false(vsphere.does_vm_exist('does_not_exist'))
+    # A miss forces a refresh in case the vm was just created
+    Assert.equal(vsphere.api.traversals, 2)
+
+
+def test_stats_share_queries(vsphere):
+    stats = vsphere.stats('num_vm', 'num_template', 'num_host')
+    Assert.equal(stats, {'num_vm': 2001, 'num_template': 1, 'num_host': 1})
+    # num_vm and num_template came from the same traversal
+    Assert.equal(vsphere.api.traversals, 1)
+
+
+def test_topology_index(vsphere):
+    Assert.equal(vsphere.list_host(), {'host-1': 'esx01'})
+    Assert.equal(vsphere.list_cluster(), {'domain-c1': 'cluster1'})
+    # The list methods are always live
+    Assert.equal(vsphere.retrievals, 2)
+    topology = vsphere.topology()
+    Assert.equal(len(topology), len(TOPOLOGY))
+    Assert.equal(topology.get('/dc1/host/cluster1/Resources/idle').mor, 'resgroup-3')
+    Assert.equal([node.name for node in topology.find('/dc1/host/cluster1/Resources/')],
+                 ['busy', 'idle'])
+    host = topology.get('/dc1/host/cluster1/esx01')
+    Assert.equal(host.free, 6 << 30)
+    Assert.equal(topology.parent(host, kind='datacenter').name, 'dc1')
+    Assert.equal(topology.get('/dc1/host/cluster1').free, 6 << 30)
+    Assert.equal(len(topology.children(topology.get('/dc1/host/cluster1/Resources'))), 2)
+
+    # Named pools are found as before, unnamed ones go to the least loaded
+    Assert.equal(vsphere._get_resource_pool('busy'), 'resgroup-2')
+    Assert.equal(vsphere._get_resource_pool('cluster1/Resources/busy'), 'resgroup-2')
+    Assert.equal(vsphere._get_resource_pool(), 'resgroup-1')
+    Assert.true(vsphere.topology() is topology)
+    Assert.equal(vsphere.retrievals, 2)
+
+
+def test_wait_for_tasks_private_collector(vsphere, monkeypatch):
+    collectors = []
+
+    def create_property_collector():
+        collectors.append('collector-%d' % len(collectors))
+        return collectors[-1]
+
+    def task_update(mor, state):
+        return object_update('modify', mor, 'Task', info_state=state)
+
+    updates = [
+        # A filter of a wait in another thread, and an object it doesn't watch
+        Prop(Version='1', FilterSet=[
+            Prop(Filter='filter-other', ObjectSet=[task_update('task-1', 'success')]),
+            Prop(Filter='filter-0', ObjectSet=[task_update('task-9', 'success')])]),
+        Prop(Version='2', FilterSet=[
+            Prop(Filter='filter-0', ObjectSet=[task_update('task-1', 'success'),
+                                               task_update('task-2', 'error')])]),
+    ]
+    versions = []
+
+    def wait_for_updates_ex(collector, version, max_wait):
+        Assert.equal(collector, 'collector-0')
+        versions.append(version)
+        return updates.pop(0) if updates else None
+
+    destroyed = []
+    monkeypatch.setattr(vsphere, '_create_property_collector', create_property_collector)
+    monkeypatch.setattr(vsphere, '_create_property_filter',
+                        lambda collector, mors, obj_type, name: 'filter-0')
+    monkeypatch.setattr(vsphere, '_wait_for_updates_ex', wait_for_updates_ex)
+    monkeypatch.setattr(vsphere, '_destroy_property_collector', destroyed.append)
+    tasks = {'a': Prop(_mor=FakeMor('task-1')), 'b': Prop(_mor=FakeMor('task-2'))}
+    Assert.equal(vsphere._wait_for_tasks(tasks, 5), {'a': 'success', 'b': 'error'})
+    # Neither update of the first set counted towards the wait
+    Assert.equal(versions, ['', '1'])
+    Assert.equal(destroyed, ['collector-0'])
+
+
+class FakeVCenter(FakeVIServer):
+    """Clones, power ons and property collector updates, each taking some time"""
+    def __init__(self, clone_delays, power_on_delay, vanishing=()):
+        FakeVIServer.__init__(self, [])
+        self.clone_delays = clone_delays
+        self.power_on_delay = power_on_delay
+        # Vms deleted behind the client's back when they are powered on
+        self.vanishing = vanishing
+        self.vms = {}
+        self.tasks = {}
+        self.filters = {}
+        self.collectors = 0
+        self.lock = threading.Lock()
+
+    def install(self, system, monkeypatch):
+        template = Prop(_mor=self._mor('vm-template', 'VirtualMachine'), clone=self.clone)
+        monkeypatch.setattr(system, 'api', self)
+        monkeypatch.setattr(system, '_lookup_vm', lambda name: template
+                            if name == 'template' else self._handle(name))
+        monkeypatch.setattr(system, '_iter_properties', self.iter_properties)
+        monkeypatch.setattr(system, '_create_property_collector', self.create_collector)
+        monkeypatch.setattr(system, '_create_property_filter', self.create_filter)
+        monkeypatch.setattr(system, '_wait_for_updates_ex', self.wait_for_updates_ex)
+        monkeypatch.setattr(system, '_destroy_property_collector', self.filters.pop)
+
+    @staticmethod
+    def _mor(mor, obj_type):
+        mor = FakeMor(mor)
+        mor.obj_type = obj_type
+        return mor
+
+    def clone(self, vm_name, sync_run, resourcepool):
+        with self.lock:
+            task = self._mor('task-%d' % len(self.tasks), 'Task')
+            self.tasks[task] = (vm_name, time.time() + self.clone_delays[vm_name])
+            return Prop(_mor=task)
+
+    def _handle(self, vm_name):
+        with self.lock:
+            if self._power_state(vm_name) is None:
+                raise Exception('Could not find a VM named %s.' % vm_name)
+        return Prop(_mor=self.vms[vm_name]['mor'],
+                    power_on=lambda sync_run: self.power_on(vm_name))
+
+    def power_on(self, vm_name):
+        with self.lock:
+            if vm_name in self.vanishing:
+                del self.vms[vm_name]
+            else:
+                self.vms[vm_name]['on_at'] = time.time() + self.power_on_delay
+
+    def _power_state(self, vm_name):
+        # Clones show up once their task is done
+        now = time.time()
+        for task, (name, done_at) in self.tasks.iteritems():
+            if name == vm_name and now >= done_at and name not in self.vms:
+                self.vms[name] = {'mor': self._mor('vm-%s' % name, 'VirtualMachine'),
+                                  'on_at': None}
+        if vm_name not in self.vms:
+            return None
+        on_at = self.vms[vm_name]['on_at']
+        return 'poweredOn' if on_at is not None and now >= on_at else 'poweredOff'
+
+    def _value(self, mor, property_name):
+        if property_name == 'info.state':
+            vm_name, done_at = self.tasks[mor]
+            return 'success' if time.time() >= done_at else 'running'
+        for vm_name, vm in self.vms.items():
+            if vm['mor'] == mor:
+                return self._power_state(vm_name)
+
+    def _retrieve_properties_traversal(self, **kwargs):
+        self.traversals += 1
+        with self.lock:
+            return [vm_content(vm_name, power_state=self._power_state(vm_name),
+                               ips=['10.0.0.%d' % i])
+                    for i, vm_name in enumerate(sorted(self.clone_delays))
+                    if self._power_state(vm_name) is not None]
+
+    def iter_properties(self, properties):
+        if 'VirtualMachine' not in properties:
+            return iter(TOPOLOGY)
+        with self.lock:
+            return [(vm['mor'], {'name': vm_name}) for vm_name, vm in self.vms.items()
+                    if self._power_state(vm_name) is not None]
+
+    def create_collector(self):
+        with self.lock:
+            self.collectors += 1
+            return 'collector-%d' % self.collectors
+
+    def create_filter(self, collector, mors, obj_type, property_name):
+        self.filters[collector] = (list(mors), property_name, {}, [0])
+        return 'filter-%s' % collector
+
+    def wait_for_updates_ex(self, collector, version, max_wait):
+        mors, property_name, sent, versions = self.filters[collector]
+        deadline = time.time() + max_wait
+        while True:
+            with self.lock:
+                changes = [(mor, self._value(mor, property_name)) for mor in mors]
+                changes = [(mor, value) for mor, value in changes if sent.get(mor) != value]
+                if changes:
+                    sent.update(changes)
+                    versions[0] += 1
+                    object_set = [Prop(Kind='modify', Obj=mor,
+                                       ChangeSet=[Prop(Name=property_name, Val=value)])
+                                  for mor, value in changes]
+                    return Prop(Version=str(versions[0]), FilterSet=[
+                        Prop(Filter='filter-%s' % collector, ObjectSet=object_set)])
+            if time.time() >= deadline:
+                return None
+            time.sleep(.01)
+
+
+def test_deploy_templates_vsphere(vsphere, monkeypatch):
+    clone_delays = dict(('clone%d' % i, .3 * (i + 1)) for i in range(4))
+    clone_delays['vanishing'] = .1
+    vcenter = FakeVCenter(clone_delays, .05, vanishing=['vanishing'])
+    vcenter.install(vsphere, monkeypatch)
+    vsphere.deploy_poll_interval = .05
+    events = [(event.vm_name, event.stage)
+              for event in vsphere.deploy_templates('template', sorted(clone_delays),
+                                                    timeout=10)]
+    stages = {}
+    for vm_name, stage in events:
+        stages.setdefault(vm_name, []).append(stage)
+    Assert.equal(stages.pop('vanishing'), ['deployed', 'failed'])
+    for vm_name in stages:
+        Assert.equal(stages[vm_name], ['deployed', 'running', 'ready'])
+    # The first clone was up while the last one was still being deployed
+    Assert.less(events.index(('clone0', 'running')), events.index(('clone3', 'deployed')))
+    Assert.equal(vcenter.filters, {})
+
+
+def test_handle_cache_lru():
+    cache = HandleCache(ttl=60, size=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    # Touch 'a' so that 'b' is the least recently used
+    Assert.equal(cache.get('a'), 1)
+    cache.set('c', 3)
+    Assert.none(cache.get('b'))
+    Assert.equal(cache.get('c'), 3)
+    Assert.equal(len(cache), 2)
+    Assert.equal((cache.hits, cache.misses), (2, 1))
+
+
+def test_handle_cache_ttl():
+    cache = HandleCache(ttl=0.05, size=10)
+    cache.set('a', 1)
+    time.sleep(0.1)
+    Assert.none(cache.get('a'))
+    cache.set('a', 1)
+    cache.invalidate('a')
+    Assert.none(cache.get('a'))
+
+
+class FakeServers(object):
+    def __init__(self):
+        self.servers = dict((str(i), Prop(id=str(i), name='instance%d' % i, status='ACTIVE',
+                                          _info={'addresses': {}}))
+                            for i in range(50))
+        self.lists = 0
+
+    def list(self, detailed=True, search_opts=None, marker=None, limit=None):
+        self.lists += 1
+        servers = sorted(self.servers.values(), key=lambda server: int(server.id))
+        if marker is not None:
+            servers = [server for server in servers if int(server.id) > int(marker)]
+        return servers[:limit]
+
+    def get(self, server_id):
+        return self.servers[server_id]
+
+
+def test_openstack_polls_reuse_handle():
+    system = OpenstackSystem.__new__(OpenstackSystem)
+    system.api = Prop(servers=FakeServers())
+    for i in range(10):
+        Assert.true(system.is_vm_running('instance7'))
+    Assert.equal(system.api.servers.lists, 1)
+    Assert.equal(system.handle_cache.hits, 9)
+
+
+def test_wait_for_vm_state_batch():
+    system = OpenstackSystem.__new__(OpenstackSystem)
+    system.api = Prop(servers=FakeServers())
+    names = ['instance%d' % i for i in range(5)]
+    for name in names:
+        system._find_instance_by_name(name).status = 'SHUTOFF'
+    result = system.wait_for_vm_state(names, 'stopped', timeout=5)
+    Assert.equal(result, dict((name, 'SHUTOFF') for name in names))
+    # All five instances were checked with a single listing
+    Assert.equal(system.api.servers.lists, 6)
+    Assert.raises(TimedOutError, system.wait_for_vm_state, names, 'running', timeout=0)
+
+
+class FakeReservations(list):
+    next_token = None
+
+
+class FakeEC2(object):
+    def __init__(self, count):
+        self.instances = dict(('i-%08d' % i, Prop(id='i-%08d' % i, state='stopped',
+                                                  tags={'Name': 'instance%d' % i},
+                                                  ip_address='10.0.%d.%d' % divmod(i, 256)))
+                              for i in range(count))
+        self.calls = []
+
+    def get_all_reservations(self, instance_ids=None, filters=None, max_results=None,
+                             next_token=None):
+        self.calls.append('get_all_reservations')
+        instances = [self.instances[i] for i in instance_ids or sorted(self.instances)]
+        for key, value in (filters or {}).iteritems():
+            if key == 'tag:Name':
+                instances = [i for i in instances if i.tags.get('Name') == value]
+            elif key == 'instance-state-name':
+                instances = [i for i in instances if i.state in value]
+        start = int(next_token or 0)
+        end = start + max_results if max_results else len(instances)
+        reservations = FakeReservations([Prop(instances=instances[start:end])])
+        if end < len(instances):
+            reservations.next_token = str(end)
+        return reservations
+
+    def start_instances(self, instance_ids):
+        self.calls.append('start_instances')
+        # Like EC2, reject the whole batch if any instance can't be started
+        for instance_id in instance_ids:
+            if self.instances[instance_id].state not in ('stopped', 'running'):
+                raise EC2ResponseError(400, 'Bad Request', 'IncorrectInstanceState')
+        for instance_id in instance_ids:
+            self.instances[instance_id].state = 'running'
+
+
+def test_ec2_start_vms_single_call():
+    system = EC2System.__new__(EC2System)
+    system.api = FakeEC2(200)
+    ids = sorted(system.api.instances)
+    results = system.start_vms(ids + ['missing-name'])
+    Assert.true(all(results[instance_id] for instance_id in ids))
+    Assert.false(results['missing-name'])
+    Assert.equal(system.api.calls.count('start_instances'), 1)
+
+
+def test_ec2_start_vms_batch_rejected():
+    system = EC2System.__new__(EC2System)
+    system.api = FakeEC2(5)
+    system.api.instances['i-00000002'].state = 'terminated'
+    ids = sorted(system.api.instances)
+    results = system.start_vms(ids, timeout=5)
+    Assert.equal(results, dict((instance_id, instance_id != 'i-00000002')
+                               for instance_id in ids))
+    # The rejected batch, then one call per instance
+    Assert.equal(system.api.calls.count('start_instances'), 6)
+
+
+def test_ec2_empty_id_list():
+    system = EC2System.__new__(EC2System)
+    system.api = FakeEC2(10)
+    Assert.equal(system._vm_statuses([]), {})
+    Assert.equal(list(system._describe_instances(instance_ids=[])), [])
+    # boto would have described every instance in the account
+    Assert.equal(system.api.calls, [])
+
+
+def test_ec2_instance_index():
+    system = EC2System.__new__(EC2System)
+    system.api = FakeEC2(2500)
+    for i in range(0, 2500, 25):
+        Assert.true(system.does_vm_exist('instance%d' % i))
+    # The whole index came from a single describe, paged in three
+    Assert.equal(system.api.calls.count('get_all_reservations'), 3)
+    Assert.equal(system.get_ip_address('instance300'), '10.0.1.44')
+    Assert.equal(system.api.calls.count('get_all_reservations'), 4)
+    Assert.false(system.does_vm_exist('does_not_exist'))
+    Assert.equal(system.api.calls.count('get_all_reservations'), 5)
+
+
+def test_ec2_instance_index_incremental_refresh():
+    system = EC2System.__new__(EC2System)
+    system.api = FakeEC2(10)
+    Assert.equal(len(system.list_vm()), 10)
+    system.api.instances['i-99999999'] = Prop(id='i-99999999', state='pending',
+                                              tags={'Name': 'launched'})
+    system._index_refresh_time = 0
+    Assert.contains('i-99999999', system.list_vm())
+    Assert.equal(system._get_instance_id_by_name('launched'), 'i-99999999')
+    # Picked up by the transitional state filter, without rebuilding the index
+    Assert.equal(system.api.calls.count('get_all_reservations'), 2)
+
+
+def test_inventory_since_snapshot_fallback():
+    system = OpenstackSystem.__new__(OpenstackSystem)
+    system.api = Prop(servers=FakeServers(),
+                      images=Prop(list=lambda: [Prop(name='image', id='1', status='ACTIVE')]))
+    delta = system.inventory_since()
+    Assert.true(delta.full)
+    Assert.equal(len(delta.added), 51)
+    Assert.contains(('template', 'image'), delta.added)
+
+    servers = system.api.servers.servers
+    servers['1'].status = 'SHUTOFF'
+    del servers['2']
+    servers['50'] = Prop(id='50', name='instance50', status='BUILD', _info={'addresses': {}})
+    delta = system.inventory_since(delta.token)
+    Assert.false(delta.full)
+    Assert.equal(delta.added, set([('vm', 'instance50')]))
+    Assert.equal(delta.removed, set([('vm', 'instance2')]))
+    Assert.equal(delta.modified, set([('vm', 'instance1')]))
+
+    # Unknown tokens start over
+    Assert.true(system.inventory_since('bogus').full)
+
+
+def object_update(kind, mor, obj_type, **changes):
+    mor = FakeMor(mor)
+    mor.obj_type = obj_type
+    change_set = [Prop(Name=name.replace('_', '.'), Val=value)
+                  for name, value in changes.iteritems()]
+    return Prop(Kind=kind, Obj=mor, ChangeSet=change_set)
+
+
+def test_inventory_since_property_collector(vsphere, monkeypatch):
+    updates = {
+        '': [
+            object_update('enter', 'vm-1', 'VirtualMachine', name='vm1',
+                          config_template=False, runtime_powerState='poweredOff'),
+            object_update('enter', 'vm-2', 'VirtualMachine', name='tpl',
+                          config_template=True, runtime_powerState='poweredOff'),
+            object_update('enter', 'host-1', 'HostSystem', name='esx01'),
+        ],
+        '1': [
+            object_update('modify', 'vm-1', 'VirtualMachine', runtime_powerState='poweredOn'),
+            object_update('leave', 'host-1', 'HostSystem'),
+        ],
+    }
+
+    def wait_for_updates_ex(collector, version, max_wait):
+        if version not in updates:
+            return None
+        next_version = str(int(version or 0) + 1)
+        return Prop(Version=next_version,
+                    FilterSet=[Prop(ObjectSet=updates.pop(version))])
+
+    monkeypatch.setattr(vsphere, '_create_change_collector', lambda: 'collector')
+    monkeypatch.setattr(vsphere, '_wait_for_updates_ex', wait_for_updates_ex)
+    delta = vsphere.inventory_since()
+    Assert.equal(delta.added, set([('vm', 'vm1'), ('template', 'tpl'), ('host', 'esx01')]))
+    delta = vsphere.inventory_since(delta.token)
+    Assert.equal(delta.modified, set([('vm', 'vm1')]))
+    Assert.equal(delta.removed, set([('host', 'esx01')]))
+    delta = vsphere.inventory_since(delta.token)
+    Assert.equal((delta.added, delta.removed, delta.modified), (set(), set(), set()))
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    in_flight = 0
+    max_in_flight = 0
+    lock = threading.Lock()
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        with self.server.lock:
+            self.server.in_flight += 1
+            self.server.max_in_flight = max(self.server.max_in_flight, self.server.in_flight)
+        time.sleep(.1)
+        with self.server.lock:
+            self.server.in_flight -= 1
+        self.send_response(200)
+        self.end_headers()
+        self.wfile.write('ACTIVE')
+
+    def log_message(self, *args):
+        pass
+
+
+class HTTPStubSystem(OpenstackSystem):
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+
+    def vm_status(self, vm_name):
+        return urllib2.urlopen('%s/servers/%s' % (self.endpoint, vm_name)).read()
+
+
+@pytest.yield_fixture
+def stub_server():
+    server = StubServer(('127.0.0.1', 0), StubHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield server
+    server.shutdown()
+
+
+def test_concurrent_mgmt_system_caps_in_flight(stub_server):
+    endpoint = 'http://127.0.0.1:%d' % stub_server.server_port
+    # Two wrappers for the same endpoint share its limit
+    first = ConcurrentMgmtSystem(HTTPStubSystem(endpoint), max_in_flight=5)
+    second = ConcurrentMgmtSystem(HTTPStubSystem(endpoint))
+    start = time.time()
+    results = [first.vm_status('vm%d' % i) for i in range(20)]
+    Assert.equal(second.map('vm_status', ['vm%d' % i for i in range(20)]), ['ACTIVE'] * 20)
+    Assert.equal([result.get() for result in results], ['ACTIVE'] * 20)
+    elapsed = time.time() - start
+    Assert.equal(stub_server.max_in_flight, 5)
+    Assert.greater_equal(elapsed, .8)
+    Assert.less(elapsed, 4, 'Requests should have run five at a time')
+
+    pool = first._pool
+    first.close()
+    Assert.true(ConcurrentMgmtSystem._pools[endpoint][0] is pool)
+    second.close()
+    Assert.false(endpoint in ConcurrentMgmtSystem._pools)
+    Assert.raises(ValueError, second.vm_status, 'vm0')
+
+
+def test_ec2_index_threads():
+    system = EC2System.__new__(EC2System)
+    system.api = FakeEC2(500)
+    system.index_refresh_interval = 0
+    errors = []
+
+    def use_index():
+        try:
+            for i in range(50):
+                system._refresh_index(full=(i % 10 == 0))
+                system._mark_changed(['i-%08d' % i])
+                Assert.true(system.does_vm_exist('instance%d' % (i * 7)))
+                Assert.equal(len(system.list_vm()), 500)
+        except Exception as e:
+            errors.append(e)
+    threads = [threading.Thread(target=use_index) for i in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    Assert.equal(errors, [])
+
+
+def test_fake_system_tasks():
+    system = provider_factory('fake', {'fake': {'type': 'fake', 'credentials': 'none',
+                                                'num_vm': 20000, 'task_delay': .05}}, {})
+    Assert.equal(len(system.list_vm()), 20000)
+    Assert.equal(system.stats('num_host', 'num_template'), {'num_host': 10, 'num_template': 10})
+    Assert.true(system.is_vm_stopped('vm0'))
+    system._submit_start('vm0')
+    Assert.equal(system.vm_status('vm0'), 'powering_up')
+    system.wait_for_vm_state('vm0', 'running', timeout=5)
+
+    Assert.equal(system.deploy_template('template1', vm_name='new_vm'), 'new_vm')
+    Assert.true(system.is_vm_running('new_vm'))
+    Assert.true(system.delete_vm('new_vm'))
+    Assert.false(system.does_vm_exist('new_vm'))
+    Assert.equal(system.calls['deploy_template'], 1)
+
+
+def test_deploy_templates_pipeline():
+    system = provider_factory('fake', {'fake': {'type': 'fake', 'credentials': 'none',
+                                                'task_delay': .2}}, {})
+    system.deploy_poll_interval = .05
+    vm_names = ['deployed%d' % i for i in range(10)]
+    status_lookups = []
+    vm_statuses = system._vm_statuses
+    system._vm_statuses = lambda names: status_lookups.append(list(names)) or vm_statuses(names)
+    start = time.time()
+    events = list(system.deploy_templates('template1', vm_names + ['vm0'], timeout=10))
+    # Deploys and starts overlap, so this takes about two task delays, not twenty
+    Assert.less(time.time() - start, 2)
+
+    stages = {}
+    for event in events:
+        stages.setdefault(event.vm_name, []).append(event.stage)
+    Assert.equal(stages.pop('vm0'), ['failed'])
+    for vm_name in vm_names:
+        Assert.equal(stages[vm_name], ['deployed', 'running', 'ready'])
+        Assert.true(system.is_vm_running(vm_name))
+    ips = [event.ip for event in events if event.stage == 'ready']
+    Assert.equal(len(set(ips)), len(vm_names))
+    # Statuses are only looked up for polls where deploys finished
+    Assert.true(status_lookups)
+    Assert.true(all(status_lookups))
+
+
+def test_fake_system_failure_injection():
+    system = provider_factory('fake', {'fake': {'type': 'fake', 'credentials': 'none',
+                                                'failure_rate': .5, 'seed': 1}}, {})
+    failures = 0
+    for i in range(100):
+        try:
+            system.vm_status('vm%d' % i)
+        except FakeSystemError:
+            failures += 1
+    Assert.greater(failures, 25)
+    Assert.less(failures, 75)
+
+
+class FakeRHEVMCollection(object):
+    def __init__(self, objects):
+        self.objects = objects
+        self.queries = []
+        self.transferred = 0
+
+    def list(self, query=None, max=None):
+        self.queries.append(query)
+        query, page = query.rsplit(' page ', 1)
+        matches = self.objects
+        for term in query.split(' and '):
+            key, value = term.split('=', 1)
+            matches = [obj for obj in matches if fnmatch.fnmatchcase(getattr(obj, key), value)]
+        start = (int(page) - 1) * max
+        self.transferred += len(matches[start:start + max])
+        return matches[start:start + max]
+
+
+@pytest.fixture
+def rhevm():
+    system = RHEVMSystem.__new__(RHEVMSystem)
+    vms = [Prop(id=str(i), name='vm%d' % i, status='up' if i % 250 == 0 else 'down',
+                cluster='cluster%d' % (i % 2)) for i in range(5000)]
+    system.api = Prop(vms=FakeRHEVMCollection(vms))
+    return system
+
+
+def test_rhevm_search_filters(rhevm):
+    Assert.equal(len(rhevm.list_vm(status='up')), 20)
+    Assert.equal(rhevm.api.vms.transferred, 20)
+    Assert.equal(rhevm.api.vms.queries, ['status=up page 1'])
+
+    Assert.equal(sorted(rhevm.list_vm(status=['up'], cluster=['cluster0', 'cluster1'])),
+                 sorted(rhevm.list_vm(status='up')))
+    Assert.equal(len(rhevm.list_vm(name='vm1*', cluster='cluster1')), 556)
+    # Filters the search dialect doesn't have are matched client side
+    Assert.equal(rhevm.list_vm(status='up', id=['250$', '5.*']), ['vm250', 'vm500'])
+    Assert.equal(rhevm.api.vms.queries[-1], 'status=up page 1')
+
+
+def test_rhevm_event_feed_pages(rhevm):
+    feed = [Prop(id=str(i), get_id=lambda i=i: str(i), get_vm=lambda: None)
+            for i in range(1, 251)]
+
+    def list_events(from_event_id=None, max=None):
+        if from_event_id is None:
+            return list(reversed(feed))[:max]
+        # Like the engine, an unknown or empty start gives everything after it
+        return [event for event in feed if int(event.id) > int(from_event_id)][:max]
+    rhevm.api.events = Prop(list=lambda **kwargs: [])
+    Assert.equal(rhevm._latest_event_id(), '0')
+    rhevm.api.events = Prop(list=list_events)
+    events, latest = rhevm._events_since('0')
+    # Three pages of a hundred, none of the burst missed
+    Assert.equal((len(events), latest), (250, '250'))
+    Assert.equal(rhevm._events_since(latest), ([], '250'))
+
+
+def test_rhevm_search_regex_and_paging(rhevm):
+    Assert.equal(rhevm.list_vm(name_regex=r'^vm49\d[05]$'), ['vm4900', 'vm4905', 'vm4910',
+        'vm4915', 'vm4920', 'vm4925', 'vm4930', 'vm4935', 'vm4940', 'vm4945', 'vm4950',
+        'vm4955', 'vm4960', 'vm4965', 'vm4970', 'vm4975', 'vm4980', 'vm4985', 'vm4990',
+        'vm4995'])
+    # The anchored prefix of the regex narrowed the search to 111 vms, two pages
+    Assert.equal(rhevm.api.vms.queries, ['name=vm49* page 1', 'name=vm49* page 2'])
+    Assert.equal(rhevm.api.vms.transferred, 111)
+    Assert.equal(len(rhevm.list_vm()), 5000)
+
+
+def test_rhevm_vm_statuses_quoted():
+    queries = []
+
+    def list_vms(query=None, max=None):
+        queries.append(query)
+        terms = [term.split('=', 1)[1] for term in query.split(' or ')]
+        values = [term[1:-1].replace('\\"', '"') if term.startswith('"') else term
+                  for term in terms]
+        return [vm for vm in vms if any(fnmatch.fnmatchcase(vm.name, value)
+                                        for value in values)]
+    vms = [Prop(name=name, get_status=lambda: Prop(get_state=lambda: 'up'))
+           for name in ['my vm', 'or', 'vm1', 'vm10', 'vm2']]
+    system = RHEVMSystem.__new__(RHEVMSystem)
+    system.api = Prop(vms=Prop(list=list_vms))
+    Assert.equal(system._vm_statuses(['my vm', 'or', 'vm1*']), {'my vm': 'up', 'or': 'up'})
+    Assert.equal(queries, ['name="my vm" or name="or" or name=vm1*'])
+
+
+def test_rhevm_wait_for_vm_states_single_search():
+    queries = []
+
+    def list_vms(query=None, max=None):
+        queries.append(query)
+        names = [term.split('=', 1)[1] for term in query.split(' or ')]
+        return [vm for vm in vms if vm.name in names]
+    vms = [Prop(id=str(i), name='vm%d' % i, get_status=lambda: Prop(get_state=lambda: 'up'))
+           for i in range(3)]
+    system = RHEVMSystem.__new__(RHEVMSystem)
+    system.api = Prop(vms=Prop(list=list_vms), events=Prop(list=lambda **kwargs: []))
+    missing = set()
+    Assert.equal(system._wait_for_vm_states(['vm0', 'vm2', 'gone'], set(['up']), 5, missing),
+                 {'vm0': 'up', 'vm2': 'up'})
+    Assert.equal(missing, set(['gone']))
+    # The ids and statuses of all three came from one search
+    Assert.equal(len(queries), 1)
+    Assert.raises(Exception, system._wait_for_vm_states, ['gone'], set(['up']), 5)
+
+
+def test_iter_vms_pages():
+    system = OpenstackSystem.__new__(OpenstackSystem)
+    system.api = Prop(servers=FakeServers())
+    system.list_page_size = 20
+    vms = system.iter_vms()
+    Assert.equal(next(vms), 'instance0')
+    # Only the first page was listed to get there
+    Assert.equal(system.api.servers.lists, 1)
+    Assert.equal(len(list(vms)), 49)
+    Assert.equal(system.api.servers.lists, 3)
+
+    ec2 = EC2System.__new__(EC2System)
+    ec2.api = FakeEC2(2500)
+    Assert.equal(sorted(ec2.iter_vms()), sorted(ec2.api.instances))
+    Assert.equal(ec2.api.calls.count('get_all_reservations'), 3)
+
+
+def test_vm_records():
+    system = provider_factory('fake', {'fake': {'type': 'fake', 'credentials': 'none',
+                                                'num_vm': 4, 'num_template': 1}}, {})
+    records = list(system.iter_vm_records())
+    Assert.equal(len(records), 5)
+    record = [r for r in records if r.name == 'vm1'][0]
+    Assert.equal(record.state, 'up')
+    Assert.equal(record.provider, 'fake')
+    Assert.false(record.template)
+    Assert.true(records[-1].template)
+
+    # The default builds them from listings and batched statuses
+    ec2 = EC2System.__new__(EC2System)
+    ec2.api = FakeEC2(250)
+    ec2.api.get_all_images = lambda **kwargs: []
+    records = list(super(EC2System, ec2).iter_vm_records())
+    Assert.equal(len(records), 250)
+    Assert.equal(set(record.state for record in records), set(['stopped']))
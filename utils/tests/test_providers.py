@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+import time
+
+import pytest
+from unittestzero import Assert
+
+from utils import providers
+from utils.providers import ProviderPool, delete_vms_matching, provider_fanout
+
+pytestmark = [
+    pytest.mark.nondestructive,
+    pytest.mark.skip_selenium,
+]
+
+
+class SlowProvider(object):
+    def __init__(self, name):
+        self.name = name
+
+    def list_vm(self):
+        time.sleep(.2)
+        return ['%s_vm' % self.name]
+
+    def delete_vm(self, vm_name):
+        raise Exception('no such vm %s' % vm_name)
+
+
+@pytest.fixture
+def clients():
+    return dict(('provider%d' % i, SlowProvider('provider%d' % i)) for i in range(8))
+
+
+def test_fanout_runs_concurrently(clients):
+    start = time.time()
+    results = provider_fanout('list_vm', clients.keys(), clients=clients)
+    Assert.less(time.time() - start, 1, 'Fanout should take about as long as one provider')
+    Assert.equal(sorted(results), sorted(clients))
+    for name, result in results.iteritems():
+        Assert.equal(result.result, ['%s_vm' % name])
+        Assert.none(result.error)
+        Assert.greater_equal(result.elapsed, .2)
+
+
+def test_fanout_collects_errors(clients):
+    results = provider_fanout('delete_vm', clients.keys(), args=('vm',), clients=clients)
+    for result in results.itervalues():
+        Assert.none(result.result)
+        Assert.contains('no such vm', str(result.error))
+
+
+def test_fanout_callable_action(clients):
+    results = provider_fanout(lambda client, suffix: client.name + suffix,
+        clients.keys(), args=('!',), clients=clients)
+    Assert.equal(results['provider3'].result, 'provider3!')
+
+
+def test_delete_vms_matching_batches():
+    batches = []
+    provider = SlowProvider('provider0')
+    provider.list_vm = lambda: ['test_1', 'keep', 'test_2']
+    provider.delete_vms = lambda vm_names: batches.append(vm_names) or dict(
+        (vm_name, True) for vm_name in vm_names)
+    Assert.equal(delete_vms_matching(provider, '^test_'), {'test_1': True, 'test_2': True})
+    Assert.equal(batches, [['test_1', 'test_2']])
+    Assert.equal(delete_vms_matching(provider, '^none_'), {})
+    Assert.equal(len(batches), 1)
+
+
+class PooledProvider(object):
+    connections = 0
+
+    def __init__(self, **kwargs):
+        PooledProvider.connections += 1
+        self.alive = True
+        self.disconnected = False
+
+    def is_session_alive(self):
+        return self.alive
+
+    def disconnect(self):
+        self.disconnected = True
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    monkeypatch.setitem(providers.provider_type_map, 'pooled', PooledProvider)
+    PooledProvider.connections = 0
+    return ProviderPool(idle_timeout=60, check_interval=0)
+
+
+pool_config = {
+    'providers': {'fake': {'type': 'pooled', 'credentials': 'fake'}},
+    'credentials': {'username': 'admin', 'password': 'secret'},
+}
+
+
+def test_pool_reuses_sessions(pool):
+    for i in range(5):
+        with pool.checkout('fake', **pool_config) as client:
+            pass
+    Assert.equal(PooledProvider.connections, 1)
+    # Two concurrent checkouts never share a client
+    first = pool.get('fake', **pool_config)
+    second = pool.get('fake', **pool_config)
+    Assert.true(first is not second)
+    Assert.equal(PooledProvider.connections, 2)
+
+
+def test_pool_relogin_on_dead_session(pool):
+    with pool.checkout('fake', **pool_config) as client:
+        client.alive = False
+    with pool.checkout('fake', **pool_config) as new_client:
+        Assert.true(new_client is not client)
+    Assert.true(client.disconnected)
+
+
+def test_pool_keeps_session_on_api_error(pool):
+    with pytest.raises(Exception):
+        with pool.checkout('fake', **pool_config) as client:
+            raise Exception('Could not find a VM named vm0.')
+    Assert.false(client.disconnected)
+    with pool.checkout('fake', **pool_config) as same_client:
+        Assert.true(same_client is client)
+
+    with pytest.raises(Exception):
+        with pool.checkout('fake', **pool_config) as client:
+            client.alive = False
+            raise Exception('Session expired')
+    Assert.true(client.disconnected)
+    Assert.equal(PooledProvider.connections, 1)
+
+
+def test_pool_idle_expiry(pool):
+    with pool.checkout('fake', **pool_config) as client:
+        pass
+    pool.idle_timeout = 0
+    time.sleep(.01)
+    pool.expire()
+    Assert.true(client.disconnected)
@@ -0,0 +1,80 @@
+import datetime
+
+import pytest
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, create_engine
+from unittestzero import Assert
+
+from utils import purge
+
+pytestmark = [
+    pytest.mark.nondestructive,
+    pytest.mark.skip_selenium,
+]
+
+
+@pytest.fixture
+def engine(monkeypatch):
+    metadata = MetaData()
+    tables = {}
+    for class_name, resource_column, time_column in sum(purge.TARGETS.values(), []):
+        columns = [Column('id', Integer, primary_key=True), Column(time_column, DateTime)]
+        if class_name.startswith('Metric'):
+            columns += [Column('resource_id', Integer), Column('resource_type', String)]
+        elif isinstance(resource_column, dict):
+            columns += [Column(column, Integer) for column in resource_column.values()]
+        tables[class_name] = Table(class_name.lower(), metadata, *columns)
+    engine = create_engine('sqlite://')
+    metadata.create_all(engine)
+    monkeypatch.setattr(purge, '_table', tables.get)
+
+    start = datetime.datetime(2013, 6, 1)
+    for hour in range(24):
+        engine.execute(tables['Metric%02d' % hour].insert(), [
+            {'resource_id': resource_id, 'resource_type': 'VmOrTemplate',
+             'timestamp': start + datetime.timedelta(days=day, hours=hour)}
+            for resource_id in (1, 2) for day in range(3)])
+    engine.execute(tables['EmEvent'].insert(), vm_or_template_id=1, timestamp=start)
+    engine.execute(tables['EmEvent'].insert(), host_id=1, timestamp=start)
+    return engine
+
+
+def test_purge_resources(engine):
+    results = purge.purge(engine, ['metrics', 'events', 'tasks'], resources=[1], chunk_size=2)
+    Assert.equal(sum(result.rows for result in results), 24 * 3 + 1)
+    Assert.equal(len([result for result in results if result.table == 'miqtask']), 0)
+    Assert.equal(engine.execute('SELECT count(*) FROM metric05').scalar(), 3)
+    # Host 1 isn't vm 1
+    Assert.equal(engine.execute('SELECT count(*) FROM emevent').scalar(), 1)
+    Assert.true(purge.format_report(results).endswith('%10d %9.2f' % (
+        73, sum(result.seconds for result in results))))
+
+
+def test_purge_window_targets_partitions(engine):
+    after = datetime.datetime(2013, 6, 2, 10, 30)
+    results = purge.purge(engine, ['metrics'], after=after,
+                          before=after + datetime.timedelta(hours=2))
+    Assert.equal([(result.table, result.rows) for result in results],
+                 [('metric', 0), ('metric10', 0), ('metric11', 2), ('metric12', 2)])
+
+
+def test_purge_any_resource_type_and_parent(engine):
+    engine.execute("INSERT INTO metric (resource_id, resource_type) VALUES (1, 'Host')")
+    engine.execute("INSERT INTO metric05 (resource_id, resource_type) VALUES (1, 'Host')")
+    purge.purge(engine, ['metrics'], resources=[1])
+    # Only the vm's rows went, and the parent table was included
+    Assert.equal(engine.execute('SELECT count(*) FROM metric').scalar(), 1)
+    purge.purge(engine, ['metrics', 'events'], resources=[1], resource_type=None)
+    Assert.equal(engine.execute('SELECT count(*) FROM metric').scalar(), 0)
+    Assert.equal(engine.execute('SELECT count(*) FROM metric05').scalar(), 3)
+    Assert.equal(engine.execute('SELECT count(*) FROM emevent').scalar(), 0)
+
+
+def test_purge_all_history_needs_flag(engine):
+    Assert.raises(ValueError, purge.purge, engine)
+    Assert.raises(ValueError, purge.purge, engine, ['tasks'])
+    Assert.equal(engine.execute('SELECT count(*) FROM emevent').scalar(), 2)
+    purge.purge(engine, ['events'], purge_all=True)
+    Assert.equal(engine.execute('SELECT count(*) FROM emevent').scalar(), 0)
+    # Metrics aren't history, they can be emptied without the flag
+    purge.purge(engine, ['metrics'])
+    Assert.equal(engine.execute('SELECT count(*) FROM metric05').scalar(), 0)